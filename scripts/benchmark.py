@@ -0,0 +1,287 @@
+"""
+Latency and throughput benchmark for ingestion, retrieval and time to first token
+
+Everything runs in-process: Qdrant in local mode (in memory, or on disk with --qdrant-path) and a
+stub LLM that waits a fixed time per 1k prompt tokens before streaming, so the numbers don't
+depend on a running server or on Ollama. For every dataset scale it reports:
+    ingest      chunks/s through embed.py's pipeline (embedding cache off)
+    embed       query embedding latency
+    search      Qdrant query_points latency and QPS for every --limits x --concurrency pair
+    sparse      BM25 search latency for every limit
+    ttft        embed + search + context assembly + stub LLM until the first token
+    memory      peak RSS of this process and of the embedding worker processes
+
+Latencies are reported as p50/p95/p99 in milliseconds. The result is JSON (--output), and
+--baseline prints the change of the headline numbers against an earlier result file.
+
+Usage:
+    python scripts/benchmark.py --scales tesla,four --output bench.json
+    python scripts/benchmark.py --scales all --limits 5,10,50 --concurrency 1,8 --baseline bench.json
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from qdrant_client import QdrantClient
+
+import embed
+from bm25 import load_index
+from companies import COMPANIES
+from context import count_tokens
+from embeddings import embed_queries, get_cache
+from rag import build_context, build_messages
+from vector_store import QdrantStore
+
+try:
+    import resource
+except ImportError:
+    # Windows, see peak_rss_mb
+    resource = None
+
+# Dataset sizes, from one ticker to every folder in dataset/
+SCALES = {
+    "tesla": ["*TSLA*.txt"],
+    "four": embed.DEFAULT_PATTERNS,
+    "all": ["*.txt"],
+}
+DEFAULT_LIMITS = (5, 10, 50)
+DEFAULT_CONCURRENCY = (1, 4, 8)
+QUERIES_PER_RUN = 200       # searches timed per limit/concurrency pair
+LLM_MS_PER_1K_TOKENS = 150  # stub prompt processing time
+LLM_TOKENS = 32             # tokens the stub streams back
+
+TOPICS = [
+    "total revenue", "operating income", "research and development expenses", "main risk factors",
+    "cash flow from operations", "share repurchases", "segment results", "capital expenditures",
+    "competition", "employees and headcount",
+]
+
+
+def benchmark_questions():
+    companies = [names[0].title() for names in COMPANIES.values()]
+    return [f"What were {company}'s {topic} in {year}?"
+            for company, topic, year in itertools.product(companies, TOPICS, (2021, 2023))]
+
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    if not len(samples):
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "n": 0}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(samples.mean()), "n": len(samples)}
+
+
+def peak_rss_mb():
+    if resource is None:
+        # Windows: the peak working set from psutil if it's installed, nothing for child processes
+        try:
+            import psutil
+        except ImportError:
+            return {"self": None, "children": None}
+        return {"self": psutil.Process().memory_info().peak_wset / (1024 * 1024), "children": None}
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 / 1024 if sys.platform != "darwin" else 1 / (1024 * 1024)
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class StubLLM:
+    """Stands in for ollama.chat: sleeps for prompt processing, then streams fixed tokens"""
+
+    def __init__(self, ms_per_1k_tokens: float = LLM_MS_PER_1K_TOKENS, tokens: int = LLM_TOKENS):
+        self.ms_per_1k_tokens = ms_per_1k_tokens
+        self.tokens = tokens
+
+    def chat(self, messages):
+        prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+        time.sleep(prompt_tokens / 1000 * self.ms_per_1k_tokens / 1000)
+        for i in range(self.tokens):
+            yield f"token{i} "
+
+
+def _timed_calls(fn, args_list, concurrency: int):
+    """Runs fn(*args) for every args with concurrency threads, returns (latencies in ms, wall seconds)"""
+    def call(args):
+        start = time.perf_counter()
+        fn(*args)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        latencies = [call(args) for args in args_list]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(call, args_list))
+    return latencies, time.perf_counter() - start
+
+
+def bench_ingest(client, dataset: Path, patterns, workdir: Path):
+    store = QdrantStore(client, embed.collection_name)
+    store.create(rebuild=True)
+    paths = list(embed.dataset_files(dataset, patterns))
+    start = time.perf_counter()
+    # Local mode Qdrant isn't safe for concurrent writes, hence one upsert worker
+    manifest = embed.run_pipeline(store, paths, None, cache=False, upsert_workers=1)
+    elapsed = time.perf_counter() - start
+    chunks = len({pid for entry in manifest["files"].values() for pid in entry["chunk_ids"]})
+
+    index_path = workdir / "bm25.npz"
+    embed.build_sparse_index(manifest, index_path)
+    return {
+        "files": len(paths),
+        "chunks": chunks,
+        "seconds": elapsed,
+        "chunks_per_sec": chunks / max(elapsed, 1e-9),
+    }, index_path
+
+
+def bench_queries(client, questions, index_path: Path, limits, concurrencies, queries_per_run: int):
+    results = {}
+
+    # Query embedding, cache off so every call runs the model
+    latencies, _ = _timed_calls(lambda q: embed_queries([q], cache=False), [(q,) for q in questions], 1)
+    results["embed"] = percentiles(latencies)
+    vectors = embed_queries(questions, cache=False)
+
+    runs = []
+    workload = [vectors[i % len(vectors)] for i in range(queries_per_run)]
+    for limit, concurrency in itertools.product(limits, concurrencies):
+        def search(vector, limit=limit):
+            client.query_points(collection_name=embed.collection_name, query=vector.tolist(), limit=limit)
+        latencies, wall = _timed_calls(search, [(v,) for v in workload], concurrency)
+        runs.append({"limit": limit, "concurrency": concurrency, **percentiles(latencies),
+                     "qps": len(workload) / max(wall, 1e-9)})
+        print(f"\tsearch limit={limit} concurrency={concurrency}: p50 {runs[-1]['p50']:.2f} ms, "
+              f"p99 {runs[-1]['p99']:.2f} ms, {runs[-1]['qps']:.0f} QPS")
+    results["search"] = runs
+
+    index = load_index(index_path)
+    sparse = []
+    for limit in limits:
+        latencies, wall = _timed_calls(lambda q, limit=limit: index.search(q, limit),
+                                       [(questions[i % len(questions)],) for i in range(queries_per_run)], 1)
+        sparse.append({"limit": limit, **percentiles(latencies), "qps": queries_per_run / max(wall, 1e-9)})
+    results["sparse"] = sparse
+    return results
+
+
+def bench_ttft(client, questions, llm: StubLLM, n_points: int = 10):
+    ttft, context_tokens = [], []
+    for question in questions:
+        start = time.perf_counter()
+        vector = embed_queries([question], cache=False)[0]
+        points = client.query_points(collection_name=embed.collection_name, query=vector.tolist(),
+                                     limit=n_points, with_payload=True).points
+        context, stats = build_context(question, points)
+        next(iter(llm.chat(build_messages(question, context))))
+        ttft.append((time.perf_counter() - start) * 1000)
+        context_tokens.append(stats["tokens_out"])
+    return {**percentiles(ttft), "context_tokens_mean": float(np.mean(context_tokens)) if context_tokens else 0.0}
+
+
+def run_benchmark(scales, dataset: Path = Path("dataset"), limits=DEFAULT_LIMITS, concurrencies=DEFAULT_CONCURRENCY,
+                  queries_per_run: int = QUERIES_PER_RUN, ttft_questions: int = 20, qdrant_path=None,
+                  llm: StubLLM = None):
+    llm = llm or StubLLM()
+    questions = benchmark_questions()
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {"limits": list(limits), "concurrency": list(concurrencies), "queries_per_run": queries_per_run,
+                   "llm_ms_per_1k_tokens": llm.ms_per_1k_tokens, "index": embed.index_settings(),
+                   "qdrant": "path" if qdrant_path else "memory"},
+        "scales": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as tmp:
+        workdir = Path(tmp)
+        for scale in scales:
+            print(f"== {scale}: {', '.join(SCALES[scale])}")
+            # A fresh collection per scale
+            client = QdrantClient(path=str(Path(qdrant_path) / scale)) if qdrant_path else QdrantClient(":memory:")
+            try:
+                ingest, index_path = bench_ingest(client, dataset, SCALES[scale], workdir)
+                print(f"\tingest: {ingest['chunks']} chunks from {ingest['files']} files, {ingest['chunks_per_sec']:.1f} chunks/s")
+                queries = bench_queries(client, questions, index_path, limits, concurrencies, queries_per_run)
+                ttft = bench_ttft(client, questions[:ttft_questions], llm)
+                print(f"\tttft: p50 {ttft['p50']:.1f} ms, p99 {ttft['p99']:.1f} ms")
+            finally:
+                client.close()
+            report["scales"].append({"scale": scale, "ingest": ingest, **queries, "ttft": ttft, "peak_rss_mb": peak_rss_mb()})
+    return report
+
+
+def headline(report):
+    """Flat {name: value} of the numbers worth tracking between runs"""
+    numbers = {}
+    for scale in report["scales"]:
+        name = scale["scale"]
+        numbers[f"{name}.ingest.chunks_per_sec"] = scale["ingest"]["chunks_per_sec"]
+        numbers[f"{name}.embed.p50_ms"] = scale["embed"]["p50"]
+        for run in scale["search"]:
+            numbers[f"{name}.search.limit{run['limit']}.c{run['concurrency']}.p99_ms"] = run["p99"]
+            numbers[f"{name}.search.limit{run['limit']}.c{run['concurrency']}.qps"] = run["qps"]
+        numbers[f"{name}.ttft.p50_ms"] = scale["ttft"]["p50"]
+        numbers[f"{name}.peak_rss_mb"] = scale["peak_rss_mb"]["self"]
+    return numbers
+
+
+def compare(report, baseline):
+    current, previous = headline(report), headline(baseline)
+    print(f"{'metric':<45} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, value in current.items():
+        old = previous.get(name)
+        if old is None or value is None:
+            continue
+        change = (value - old) / old * 100 if old else 0.0
+        print(f"{name:<45} {old:>12.2f} {value:>12.2f} {change:>+8.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, retrieval and time to first token")
+    parser.add_argument("--dataset", type=Path, default=Path("dataset"))
+    parser.add_argument("--scales", default="tesla,four,all", help=f"Comma separated, from {', '.join(SCALES)}")
+    parser.add_argument("--limits", default=",".join(map(str, DEFAULT_LIMITS)), help="Search limits to time")
+    parser.add_argument("--concurrency", default=",".join(map(str, DEFAULT_CONCURRENCY)), help="Concurrent searches to time")
+    parser.add_argument("--queries", type=int, default=QUERIES_PER_RUN, help="Searches per limit/concurrency pair")
+    parser.add_argument("--llm-ms-per-1k-tokens", type=float, default=LLM_MS_PER_1K_TOKENS, help="Stub LLM prompt processing time")
+    parser.add_argument("--qdrant-path", help="Use on-disk local mode under this directory instead of memory")
+    parser.add_argument("--output", help="Write the JSON result here (default: stdout, with progress on stderr)")
+    parser.add_argument("--baseline", help="Earlier JSON result to compare against")
+    args = parser.parse_args()
+
+    scales = [s.strip() for s in args.scales.split(",") if s.strip()]
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        parser.error(f"unknown scales {unknown}, expected {', '.join(SCALES)}")
+    # A batch run writes the embedding cache, the timed embedding calls still bypass it (cache=False)
+    get_cache(embed.model_name, writable=True)
+
+    # Without --output stdout carries only the JSON result, progress (ours and embed's) goes to stderr
+    with contextlib.redirect_stdout(sys.stdout if args.output else sys.stderr):
+        report = run_benchmark(
+            scales, args.dataset,
+            [int(x) for x in args.limits.split(",")], [int(x) for x in args.concurrency.split(",")],
+            args.queries, qdrant_path=args.qdrant_path, llm=StubLLM(args.llm_ms_per_1k_tokens),
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f, \
+                contextlib.redirect_stdout(sys.stdout if args.output else sys.stderr):
+            compare(report, json.load(f))
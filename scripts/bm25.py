@@ -0,0 +1,175 @@
+"""
+Local BM25 index over the same chunks that are embedded in Qdrant
+
+embed.py rebuilds it after every run that changed the collection. It is stored as one
+compressed .npz holding a CSR-style inverted index:
+    vocab      term strings, sorted
+    indptr     postings of term t are docs[indptr[t]:indptr[t + 1]]
+    docs, tfs  chunk row and term frequency of every posting
+    doc_len    tokens per chunk
+    ids        Qdrant point ID of every chunk row
+    <field>_vocab, <field>_bits
+               for the filterable fields (tickers, years, documents): the field's values,
+               and a bitset per row of which values the chunk has
+
+Filters use the same dict as retrieval.py, e.g. {"ticker": ["TSLA"], "year": ["2023"]}
+
+Usage:
+    from bm25 import load_index
+    hits = load_index().search("energy generation and storage segment", limit=10)   # [(point_id, score)]
+"""
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_INDEX_PATH = Path(".bm25_index.npz")
+
+# Filter key -> per-chunk list field it matches against
+FILTER_FIELDS = {"ticker": "tickers", "year": "years", "document": "documents"}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or our that the their this to was were "
+    "we which will with what how does do did".split()
+)
+
+
+def tokenize(text: str):
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def _field_bits(values_per_row):
+    vocab = np.array(sorted({v for values in values_per_row for v in values}), dtype=str)
+    position = {v: i for i, v in enumerate(vocab)}
+    bits = np.zeros((len(values_per_row), max(1, (len(vocab) + 63) // 64)), dtype=np.uint64)
+    for row, values in enumerate(values_per_row):
+        for v in values:
+            i = position[v]
+            bits[row, i // 64] |= np.uint64(1 << (i % 64))
+    return vocab, bits
+
+
+class BM25Index:
+    def __init__(self, vocab, indptr, docs, tfs, doc_len, ids, fields=None, k1: float = 1.2, b: float = 0.75):
+        self.vocab = vocab
+        self.terms = {term: i for i, term in enumerate(vocab)}
+        self.indptr = indptr
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.ids = ids
+        self.fields = fields or {}      # field -> (values, bits)
+        self.k1 = k1
+        self.b = b
+        n = len(doc_len)
+        df = np.diff(indptr)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self.avg_len = float(doc_len.mean()) if n else 0.0
+
+    @classmethod
+    def build(cls, ids, texts, metadata=None):
+        """metadata is an optional list of {"tickers": [...], "years": [...], "documents": [...]} per chunk"""
+        postings = {}
+        doc_len = np.zeros(len(ids), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len[row] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((row, tf))
+
+        vocab = sorted(postings)
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(postings[t]) for t in vocab])
+        docs = np.empty(indptr[-1], dtype=np.int32)
+        tfs = np.empty(indptr[-1], dtype=np.float32)
+        for i, term in enumerate(vocab):
+            rows, counts = zip(*postings[term])
+            docs[indptr[i]:indptr[i + 1]] = rows
+            tfs[indptr[i]:indptr[i + 1]] = counts
+        fields = {}
+        if metadata is not None:
+            for field in FILTER_FIELDS.values():
+                fields[field] = _field_bits([m.get(field) or [] for m in metadata])
+        return cls(np.array(vocab), indptr, docs, tfs, doc_len, np.array(ids), fields)
+
+    def save(self, path: Path = DEFAULT_INDEX_PATH):
+        tmp = Path(path).with_suffix(".tmp.npz")
+        arrays = {}
+        for field, (values, bits) in self.fields.items():
+            arrays[f"{field}_vocab"] = values
+            arrays[f"{field}_bits"] = bits
+        np.savez_compressed(tmp, vocab=self.vocab, indptr=self.indptr, docs=self.docs, tfs=self.tfs,
+                            doc_len=self.doc_len, ids=self.ids, **arrays)
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path = DEFAULT_INDEX_PATH):
+        with np.load(path) as data:
+            fields = {
+                field: (data[f"{field}_vocab"], data[f"{field}_bits"])
+                for field in FILTER_FIELDS.values() if f"{field}_bits" in data
+            }
+            return cls(data["vocab"], data["indptr"], data["docs"], data["tfs"], data["doc_len"], data["ids"], fields)
+
+    def mask(self, filters):
+        """Bool array of the rows matching every key of filters (any of the listed values), None if no filters"""
+        mask = None
+        for key, wanted in (filters or {}).items():
+            if not wanted:
+                continue
+            field = FILTER_FIELDS[key]
+            if field not in self.fields:
+                raise ValueError(f"BM25 index has no '{field}' metadata, re-run embed.py")
+            values, bits = self.fields[field]
+            query = np.zeros(bits.shape[1], dtype=np.uint64)
+            for i in np.flatnonzero(np.isin(values, list(wanted))):
+                query[i // 64] |= np.uint64(1 << int(i % 64))
+            matches = (bits & query).any(axis=1)
+            mask = matches if mask is None else mask & matches
+        return mask
+
+    def scores(self, query: str):
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        for term, qtf in Counter(tokenize(query)).items():
+            t = self.terms.get(term)
+            if t is None:
+                continue
+            rows = self.docs[self.indptr[t]:self.indptr[t + 1]]
+            tf = self.tfs[self.indptr[t]:self.indptr[t + 1]]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[rows] / self.avg_len)
+            scores[rows] += qtf * self.idf[t] * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, limit: int = 10, filters=None):
+        """Top limit (point_id, score) pairs among the rows matching filters"""
+        scores = self.scores(query)
+        mask = self.mask(filters)
+        if mask is not None:
+            scores[~mask] = 0
+        limit = min(limit, int(np.count_nonzero(scores)))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(str(self.ids[row]), float(scores[row])) for row in top]
+
+    def __len__(self):
+        return len(self.doc_len)
+
+
+_loaded = {}
+
+
+def load_index(path: Path = DEFAULT_INDEX_PATH):
+    """Loads the index once per process, reloading if the file changed since"""
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"No BM25 index at {path}, run embed.py first")
+    mtime = path.stat().st_mtime
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, BM25Index.load(path))
+        _loaded[path] = cached
+    return cached[1]
@@ -0,0 +1,174 @@
+"""
+Local store of chunk text, so searches don't have to carry it in their payloads
+
+For every (document, part_index) the store keeps the byte range of the chunk in the original
+.txt file. Text is read from memory-mapped files on demand: only the chunks that end up in a
+prompt are ever decoded. embed.py chunks the newline-normalized text (\r\n -> \n), so offsets
+are mapped back to the raw bytes and the same normalization is applied when reading.
+
+Near-duplicate chunks that dedup folded into one point read as the text of the source the
+point is labelled with, which can differ slightly from the copy that was embedded.
+
+The store is rebuilt by embed.py after every run that changed the index. A file that changed
+on disk since then is treated as missing, callers fall back to the Qdrant payload.
+
+Usage:
+    from chunk_store import get_chunk_store
+    store = get_chunk_store()
+    text = store.text("NASDAQ_TSLA_2023.txt", 12)
+"""
+import mmap
+import os
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_STORE_PATH = Path(".chunk_store.npz")
+
+_CRLF_RE = re.compile("\r\n")
+
+
+def normalize_newlines(text: str) -> str:
+    # Same newline handling as reading the file in text mode, see embed.read_stage
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def byte_offsets(data: bytes, positions):
+    """Byte offsets in data of character positions in its newline-normalized text"""
+    raw = data.decode("utf-8")
+    positions = np.asarray(positions, dtype=np.int64)
+    crlf = np.fromiter((m.start() for m in _CRLF_RE.finditer(raw)), dtype=np.int64)
+    # The i-th \r\n starts at normalized position crlf[i] - i, every one before a position adds a byte
+    raw_positions = positions + np.searchsorted(crlf - np.arange(len(crlf)), positions, side="left")
+    if len(raw) == len(data):
+        return raw_positions
+    # Multi-byte characters: encode the text between consecutive positions once
+    marks = np.unique(raw_positions)
+    sizes = [len(raw[a:b].encode("utf-8")) for a, b in zip(np.concatenate(([0], marks[:-1])), marks)]
+    return np.cumsum(sizes, dtype=np.int64)[np.searchsorted(marks, raw_positions)]
+
+
+def _key(document: int, part_index: int):
+    return (np.int64(document) << 32) | np.int64(part_index)
+
+
+class ChunkStore:
+    def __init__(self, documents, paths, stats, keys, starts, ends):
+        self.documents = list(documents)              # file names, as in the "document" payload field
+        self.paths = list(paths)                      # where each file was read from
+        self.stats = [tuple(s) for s in stats]        # (size, mtime_ns) of each file when indexed
+        self.keys = keys
+        self.starts = starts
+        self.ends = ends
+        self._document_ids = {name: i for i, name in enumerate(self.documents)}
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, files):
+        """files: [(path, raw bytes, [(start, end) character offsets of each chunk in part_index order])]"""
+        documents, paths, stats = [], [], []
+        keys, starts, ends = [], [], []
+        for doc, (path, data, spans) in enumerate(sorted(files, key=lambda f: Path(f[0]).name)):
+            path = Path(path)
+            st = path.stat()
+            documents.append(path.name)
+            paths.append(path.as_posix())
+            stats.append((st.st_size, st.st_mtime_ns))
+            if not spans:
+                continue
+            offsets = byte_offsets(data, [p for span in spans for p in span]).reshape(-1, 2)
+            keys.append(_key(doc, np.arange(len(spans), dtype=np.int64)))
+            starts.append(offsets[:, 0])
+            ends.append(offsets[:, 1])
+        cat = lambda arrays: np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64)
+        return cls(documents, paths, stats, cat(keys), cat(starts), cat(ends))
+
+    def save(self, path: Path = DEFAULT_STORE_PATH):
+        tmp = Path(path).with_suffix(".tmp.npz")
+        np.savez(tmp, documents=np.array(self.documents), paths=np.array(self.paths),
+                 stats=np.array(self.stats, dtype=np.int64).reshape(-1, 2),
+                 keys=self.keys, starts=self.starts, ends=self.ends)
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path = DEFAULT_STORE_PATH):
+        with np.load(path) as data:
+            return cls(data["documents"].tolist(), data["paths"].tolist(), data["stats"].tolist(),
+                       data["keys"], data["starts"], data["ends"])
+
+    def _map(self, doc: int):
+        # Memory map of the file, None if it changed since the store was built
+        with self._lock:
+            if doc not in self._maps:
+                mapped = None
+                try:
+                    st = os.stat(self.paths[doc])
+                    if (st.st_size, st.st_mtime_ns) == self.stats[doc] and st.st_size:
+                        with open(self.paths[doc], "rb") as f:
+                            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except OSError:
+                    pass
+                self._maps[doc] = mapped
+            return self._maps[doc]
+
+    def text(self, document: str, part_index: int):
+        """Chunk text, None if the chunk or its file isn't available"""
+        doc = self._document_ids.get(document)
+        if doc is None:
+            return None
+        i = int(np.searchsorted(self.keys, _key(doc, part_index)))
+        if i == len(self.keys) or self.keys[i] != _key(doc, part_index):
+            return None
+        mapped = self._map(doc)
+        if mapped is None:
+            return None
+        return normalize_newlines(mapped[int(self.starts[i]):int(self.ends[i])].decode("utf-8"))
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                if mapped is not None:
+                    mapped.close()
+            self._maps = {}
+
+
+_loaded = {}
+
+
+def get_chunk_store(path: Path = DEFAULT_STORE_PATH):
+    """The store at path, loaded once per process and reloaded if the file changed, None if missing"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    mtime = path.stat().st_mtime
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != mtime:
+        if cached is not None:
+            cached[1].close()
+        cached = (mtime, ChunkStore.load(path))
+        _loaded[path] = cached
+    return cached[1]
+
+
+def fill_content(points, store=None):
+    """
+    Sets payload["content"] of points that don't have it from the store, in place.
+    Returns the points that are still missing it.
+    """
+    store = store if store is not None else get_chunk_store()
+    missing = []
+    for p in points:
+        if "content" in p.payload:
+            continue
+        text = store.text(p.payload["document"], p.payload["part_index"]) if store is not None else None
+        if text is None:
+            missing.append(p)
+        else:
+            p.payload["content"] = text
+    return missing
@@ -0,0 +1,191 @@
+"""
+Chunking strategies for the filing text files
+
+Strategies:
+    fixed       every `size` characters, same as the original chunk_text (plus optional overlap)
+    sentence    packs whole sentences up to `size` characters, never crosses a "--- Page N ---" marker
+    table       like sentence, and also keeps each [TABLE START]...[TABLE END] block in one chunk
+                when it fits (bigger tables are split between rows)
+
+Every chunk carries the page it starts on and the last "PART ..." / "ITEM N." heading seen before it.
+
+Chunkers work on offsets into the original string and only slice out the final chunk text,
+so a multi-hundred-KB filing is never copied into intermediate lists of pieces.
+
+Usage:
+    from chunking import chunk_document
+    for chunk in chunk_document(text, strategy="table", size=1024, overlap=128):
+        print(chunk.page, chunk.section, chunk.text)
+"""
+import bisect
+import re
+from itertools import chain
+from typing import NamedTuple, Optional
+
+_PAGE_RE = re.compile(r"^--- Page (\d+) ---[ \t]*$", re.M)
+_TABLE_RE = re.compile(r"\[TABLE START\].*?\[TABLE END\]", re.S)
+_SECTION_RE = re.compile(r"^[ \t]*((?:PART|Part)[ \t]+[IV]+\b.*|(?:ITEM|Item)[ \t]+\d+[A-Z]?\..*)$", re.M)
+# End of a sentence, or a blank line between paragraphs
+_SENTENCE_END_RE = re.compile(r"[.!?][\"'”’)\]]*\s+|\n[ \t]*\n\s*")
+_LINE_END_RE = re.compile(r"\n")
+_SPACE_RE = re.compile(r"\s+")
+
+STRATEGIES = ("fixed", "sentence", "table")
+
+
+class Chunk(NamedTuple):
+    text: str
+    start: int              # character offsets into the source text
+    end: int
+    page: Optional[int]
+    section: Optional[str]
+
+
+class _Outline:
+    """Page and section lookups by character offset"""
+
+    def __init__(self, text: str):
+        self.page_starts = []
+        self.pages = []
+        for m in _PAGE_RE.finditer(text):
+            self.page_starts.append(m.start())
+            self.pages.append(int(m.group(1)))
+        self.section_starts = []
+        self.sections = []
+        for m in _SECTION_RE.finditer(text):
+            self.section_starts.append(m.start())
+            self.sections.append(" ".join(m.group(1).split())[:120])
+
+    def page_at(self, pos: int):
+        i = bisect.bisect_right(self.page_starts, pos) - 1
+        return self.pages[i] if i >= 0 else None
+
+    def section_at(self, pos: int):
+        i = bisect.bisect_right(self.section_starts, pos) - 1
+        return self.sections[i] if i >= 0 else None
+
+
+def _make_chunk(text: str, start: int, end: int, outline: _Outline):
+    # Trim surrounding whitespace by moving the offsets, not by copying
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start == end:
+        return None
+    return Chunk(text[start:end], start, end, outline.page_at(start), outline.section_at(start))
+
+
+def fixed_chunks(text: str, size: int = 1024, overlap: int = 0):
+    outline = _Outline(text)
+    step = size - overlap
+    for start in range(0, len(text), step):
+        end = min(start + size, len(text))
+        yield Chunk(text[start:end], start, end, outline.page_at(start), outline.section_at(start))
+        if end == len(text):
+            break
+
+
+def _regions(text: str, keep_tables: bool):
+    """(start, end, is_table) spans between page markers, tables split out when keep_tables"""
+    pos = 0
+    for marker in _PAGE_RE.finditer(text):
+        yield from _split_tables(text, pos, marker.start(), keep_tables)
+        pos = marker.end()
+    yield from _split_tables(text, pos, len(text), keep_tables)
+
+
+def _split_tables(text: str, start: int, end: int, keep_tables: bool):
+    if keep_tables:
+        for table in _TABLE_RE.finditer(text, start, end):
+            if table.start() > start:
+                yield start, table.start(), False
+            yield table.start(), table.end(), True
+            start = table.end()
+    if end > start:
+        yield start, end, False
+
+
+def _units(text: str, start: int, end: int, boundary_re, size: int):
+    """Consecutive spans covering [start, end) that end on a boundary, none longer than size"""
+    pos = start
+    for m in boundary_re.finditer(text, start, end):
+        yield from _cap(text, pos, m.end(), size)
+        pos = m.end()
+    if end > pos:
+        yield from _cap(text, pos, end, size)
+
+
+def _cap(text: str, start: int, end: int, size: int):
+    # A span longer than size is cut at the last whitespace before the limit, or hard cut
+    while end - start > size:
+        cut = start + size
+        space = None
+        for m in _SPACE_RE.finditer(text, start + size // 2, cut):
+            space = m.end()
+        cut = space or cut
+        yield start, cut
+        start = cut
+    if end > start:
+        yield start, end
+
+
+def _pack(text: str, units, size: int, overlap: int, outline: _Outline):
+    """Greedily packs consecutive units into chunks of at most size characters"""
+    window = []     # units in the current chunk
+    for unit in units:
+        if window and unit[1] - window[0][0] > size:
+            chunk = _make_chunk(text, window[0][0], window[-1][1], outline)
+            if chunk:
+                yield chunk
+            # Carry the trailing units that fit in `overlap` chars into the next chunk,
+            # always dropping at least one so the chunker moves forward
+            keep = 0
+            while keep < len(window) - 1 and window[-1][1] - window[len(window) - 1 - keep][0] <= overlap:
+                keep += 1
+            window = window[len(window) - keep:] if keep else []
+            while window and unit[1] - window[0][0] > size:
+                window.pop(0)
+        window.append(unit)
+    if window:
+        chunk = _make_chunk(text, window[0][0], window[-1][1], outline)
+        if chunk:
+            yield chunk
+
+
+def structured_chunks(text: str, size: int = 1024, overlap: int = 0, keep_tables: bool = True):
+    outline = _Outline(text)
+    page_units = []     # unit iterators for the regions of the current page
+    page = None
+    for start, end, is_table in _regions(text, keep_tables):
+        region_page = outline.page_at(start)
+        # A page marker ends the current chunk
+        if page_units and region_page != page:
+            yield from _pack(text, chain.from_iterable(page_units), size, overlap, outline)
+            page_units = []
+        page = region_page
+
+        if is_table and end - start <= size:
+            page_units.append([(start, end)])
+        elif is_table:
+            # Too big for one chunk, split between rows
+            page_units.append(_units(text, start, end, _LINE_END_RE, size))
+        else:
+            page_units.append(_units(text, start, end, _SENTENCE_END_RE, size))
+    if page_units:
+        yield from _pack(text, chain.from_iterable(page_units), size, overlap, outline)
+
+
+def chunk_document(text: str, strategy: str = "table", size: int = 1024, overlap: int = 0):
+    # Checked here, before the generators start: overlap >= size would make a chunk per character
+    if size < 1:
+        raise ValueError(f"Chunk size must be positive, got {size}")
+    if not 0 <= overlap < size:
+        raise ValueError(f"Chunk overlap must be at least 0 and less than the chunk size {size}, got {overlap}")
+    if strategy == "fixed":
+        return fixed_chunks(text, size, overlap)
+    if strategy == "sentence":
+        return structured_chunks(text, size, overlap, keep_tables=False)
+    if strategy == "table":
+        return structured_chunks(text, size, overlap, keep_tables=True)
+    raise ValueError(f"Unknown chunking strategy '{strategy}', expected one of {', '.join(STRATEGIES)}")
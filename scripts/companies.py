@@ -0,0 +1,55 @@
+"""
+Companies in the dataset, and helpers to find tickers and years in file names and questions
+"""
+import re
+
+# Ticker -> names a question might use
+COMPANIES = {
+    "AAPL": ["apple"],
+    "AMZN": ["amazon"],
+    "AVGO": ["broadcom"],
+    "GOOGL": ["google", "alphabet"],
+    "META": ["meta", "facebook", "meta platforms"],
+    "MSFT": ["microsoft"],
+    "NVDA": ["nvidia"],
+    "ORCL": ["oracle"],
+    "TSLA": ["tesla"],
+    "TSM": ["tsmc", "taiwan semiconductor"],
+}
+
+# Other spellings found in file names and questions
+TICKER_ALIASES = {"FB": "META", "GOOG": "GOOGL", "APPL": "AAPL"}
+
+_FILE_TICKER_RE = re.compile(r"^(?:[A-Z]+_)?([A-Z]+)[_-]")
+_YEAR_RE = re.compile(r"\b(20[0-4]\d)\b")
+_NAME_RE = re.compile(
+    r"\b(" + "|".join(sorted((re.escape(n) for names in COMPANIES.values() for n in names), key=len, reverse=True)) + r")\b",
+    re.I,
+)
+# Tickers only count in upper case, "meta" is a name but "ON" or "IT" shouldn't be tickers
+_TICKER_RE = re.compile(r"\b(" + "|".join(list(COMPANIES) + list(TICKER_ALIASES)) + r")\b")
+_NAME_TO_TICKER = {name: ticker for ticker, names in COMPANIES.items() for name in names}
+
+
+def normalize_ticker(ticker: str):
+    ticker = ticker.upper()
+    return TICKER_ALIASES.get(ticker, ticker)
+
+
+def ticker_for_file(name: str):
+    """NASDAQ_TSLA_2023.txt -> TSLA, APPL-2021.csv -> AAPL, GOOGL-10k-2020.pdf -> GOOGL"""
+    match = _FILE_TICKER_RE.match(name)
+    if not match:
+        return None
+    ticker = normalize_ticker(match.group(1))
+    return ticker if ticker in COMPANIES else None
+
+
+def find_tickers(question: str):
+    tickers = {_NAME_TO_TICKER[m.group(1).lower()] for m in _NAME_RE.finditer(question)}
+    tickers.update(normalize_ticker(m.group(1)) for m in _TICKER_RE.finditer(question))
+    return sorted(tickers)
+
+
+def find_years(question: str):
+    return sorted(set(_YEAR_RE.findall(question)))
@@ -0,0 +1,199 @@
+"""
+Compares storage configurations of the knowledge_base vectors on memory, latency and recall
+
+Every configuration in CONFIGS (quantization, on-disk storage, HNSW parameters, see
+vector_store.collection_options) gets a copy of the existing collection: vectors and payloads are
+copied, nothing is re-embedded. The benchmark questions are then searched with every --ef
+value and compared with exact search, which is computed with NumPy from the same vectors.
+
+Reported per configuration and ef:
+    ram_mb      estimated resident memory: original vectors unless on disk, the quantized copy,
+                HNSW links (2 * m per vector on the base layer) and payloads unless on disk
+    p50/p95     query_points latency in ms, with payloads, one query at a time
+    recall@k    share of the exact top k found, averaged over the questions
+
+Needs a Qdrant server (QDRANT_URL): local mode ignores quantization and HNSW settings and
+always searches exactly. The copies are named knowledge_base_cmp_<config> and dropped
+afterwards unless --keep is given.
+
+Usage:
+    python scripts/compare_storage.py
+    python scripts/compare_storage.py --configs float32,scalar,binary --ef 32,64,128 --k 10 --output storage.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from qdrant_client import models
+
+import embed
+import vector_store
+from benchmark import benchmark_questions, percentiles
+from config import qdrant_client
+from embeddings import embed_queries, get_cache
+from retrieval import read_questions, search_params
+
+# name -> vector_store.collection_options arguments
+CONFIGS = {
+    "float32": {},
+    "float32-disk": {"on_disk": True},
+    "scalar": {"quantization": "scalar"},
+    "scalar-disk": {"quantization": "scalar", "on_disk": True},
+    "binary-disk": {"quantization": "binary", "on_disk": True},
+    "m32": {"hnsw_m": 32, "ef_construct": 200},
+}
+# Binary codes lose most of the information, rescoring needs more candidates to choose from
+OVERSAMPLING = {"scalar": None, "binary": 3.0}
+DEFAULT_EF = (32, 64, 128)
+DEFAULT_HNSW_M = 16
+COPY_BATCH = 256
+INDEX_TIMEOUT = 600      # seconds to wait for the HNSW index of a copy
+
+
+def load_points(client, name: str = embed.collection_name):
+    """(ids, float32 vectors, payloads) of every point in the collection"""
+    ids, vectors, payloads = [], [], []
+    offset = None
+    while True:
+        records, offset = client.scroll(collection_name=name, limit=COPY_BATCH, offset=offset,
+                                        with_payload=True, with_vectors=True)
+        for r in records:
+            ids.append(str(r.id))
+            vectors.append(r.vector)
+            payloads.append(r.payload)
+        if offset is None:
+            break
+    return ids, np.asarray(vectors, dtype=np.float32), payloads
+
+
+def exact_top_k(vectors, queries, k: int):
+    """Indices of the k most cosine-similar vectors for every query, best first"""
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+
+def estimate_ram_mb(n: int, dim: int, payload_bytes: int, options):
+    ram = 0 if options.get("on_disk") else n * dim * 4
+    quantization = options.get("quantization")
+    if quantization == "scalar":
+        ram += n * dim
+    elif quantization == "binary":
+        ram += n * dim // 8
+    ram += n * 2 * (options.get("hnsw_m") or DEFAULT_HNSW_M) * 4
+    if not options.get("on_disk"):
+        ram += payload_bytes
+    return ram / (1024 * 1024)
+
+
+def copy_collection(client, name: str, options, ids, vectors, payloads):
+    vector_store.QdrantStore(client, name).create(rebuild=True, storage=options)
+    # Build the HNSW index however small the collection is, otherwise Qdrant searches exactly
+    client.update_collection(collection_name=name, optimizers_config=models.OptimizersConfigDiff(indexing_threshold=1))
+    for start in range(0, len(ids), COPY_BATCH):
+        client.upsert(collection_name=name, wait=True, points=[
+            models.PointStruct(id=pid, vector=vector.tolist(), payload=payload)
+            for pid, vector, payload in zip(ids[start:start + COPY_BATCH], vectors[start:start + COPY_BATCH],
+                                            payloads[start:start + COPY_BATCH])
+        ])
+
+    deadline = time.monotonic() + INDEX_TIMEOUT
+    while time.monotonic() < deadline:
+        info = client.get_collection(name)
+        if info.status == models.CollectionStatus.GREEN and (info.indexed_vectors_count or 0) >= len(ids):
+            return
+        time.sleep(0.5)
+    print(f"\t{name}: index not finished after {INDEX_TIMEOUT}s, numbers may be off")
+
+
+def measure(client, name: str, queries, truth, ids, k: int, params):
+    latencies = []
+    recalls = []
+    for vector, expected in zip(queries, truth):
+        start = time.perf_counter()
+        points = client.query_points(collection_name=name, query=vector.tolist(), limit=k, search_params=params,
+                                     with_payload=True).points
+        latencies.append((time.perf_counter() - start) * 1000)
+        found = {str(p.id) for p in points}
+        recalls.append(len(found & {ids[i] for i in expected}) / len(expected))
+    stats = percentiles(latencies)
+    return {"p50": stats["p50"], "p95": stats["p95"], "recall": float(np.mean(recalls))}
+
+
+def compare_storage(client, configs, questions, efs=DEFAULT_EF, k: int = 10, keep: bool = False):
+    print(f"Loading {embed.collection_name}")
+    ids, vectors, payloads = load_points(client)
+    if not ids:
+        raise SystemExit(f"{embed.collection_name} is empty, run embed.py first")
+    payload_bytes = sum(len(json.dumps(p)) for p in payloads)
+    queries = np.asarray(embed_queries(questions, embed.model_name), dtype=np.float32)
+    truth = exact_top_k(vectors, queries, k)
+    print(f"{len(ids)} points, {len(questions)} questions, exact top {k} from NumPy")
+
+    runs = []
+    for config in configs:
+        options = CONFIGS[config]
+        name = f"{embed.collection_name}_cmp_{config}"
+        print(f"== {config}: {options or 'defaults'}")
+        copy_collection(client, name, options, ids, vectors, payloads)
+        ram_mb = estimate_ram_mb(len(ids), vectors.shape[1], payload_bytes, options)
+        quantization = options.get("quantization")
+        settings = [{"hnsw_ef": ef} for ef in efs]
+        if quantization:
+            settings = [{**s, "rescore": True, "oversampling": OVERSAMPLING[quantization]} for s in settings]
+            # What rescoring buys, at the largest ef
+            settings.append({"hnsw_ef": max(efs), "rescore": False})
+        try:
+            for setting in settings:
+                run = {"config": config, **setting, "ram_mb": ram_mb,
+                       **measure(client, name, queries, truth, ids, k, search_params(**setting))}
+                print(f"\tef {run['hnsw_ef']}{'' if run.get('rescore', True) else ' no rescore'}: "
+                      f"p50 {run['p50']:.2f} ms, recall@{k} {run['recall']:.3f}")
+                runs.append(run)
+        finally:
+            if not keep:
+                client.delete_collection(collection_name=name)
+    return {"points": len(ids), "questions": len(questions), "k": k, "runs": runs}
+
+
+def report_table(result):
+    k = result["k"]
+    lines = [f"| config | ef | rescore | ram MB | p50 ms | p95 ms | recall@{k} |", "|---|---|---|---|---|---|---|"]
+    for run in result["runs"]:
+        rescore = {True: "yes", False: "no"}.get(run.get("rescore"), "-")
+        lines.append(f"| {run['config']} | {run['hnsw_ef']} | {rescore} | {run['ram_mb']:.1f} | {run['p50']:.2f} "
+                     f"| {run['p95']:.2f} | {run['recall']:.3f} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare quantization, on-disk and HNSW settings against exact search")
+    parser.add_argument("--configs", default=",".join(CONFIGS), help=f"Comma separated, from {', '.join(CONFIGS)}")
+    parser.add_argument("--ef", default=",".join(map(str, DEFAULT_EF)), help="Query-time hnsw_ef values to try")
+    parser.add_argument("--k", type=int, default=10, help="Results per query, recall is measured at k")
+    parser.add_argument("--questions", help="Questions file as for retrieval.py (default: benchmark questions)")
+    parser.add_argument("--keep", action="store_true", help="Keep the copied collections")
+    parser.add_argument("--output", help="Also write the result as JSON")
+    args = parser.parse_args()
+
+    configs = [c.strip() for c in args.configs.split(",") if c.strip()]
+    unknown = [c for c in configs if c not in CONFIGS]
+    if unknown:
+        parser.error(f"unknown configs {unknown}, expected {', '.join(CONFIGS)}")
+    # A batch run: the query vectors go into the embedding cache for the next one
+    get_cache(embed.model_name, writable=True)
+
+    result = compare_storage(
+        qdrant_client(), configs,
+        read_questions(args.questions) if args.questions else benchmark_questions(),
+        [int(x) for x in args.ef.split(",")], args.k, args.keep,
+    )
+    print(report_table(result))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
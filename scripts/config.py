@@ -0,0 +1,153 @@
+"""
+Settings shared by the scripts, and the process-wide Qdrant client
+
+Loads .env once, names the collections and the embedding model, and builds Qdrant clients from
+the environment:
+    QDRANT_URL          e.g. http://localhost:6333, required for VECTOR_BACKEND=qdrant
+    QDRANT_API_KEY      sent unless the server is on localhost
+    QDRANT_PREFER_GRPC  1 to talk gRPC (port QDRANT_GRPC_PORT, 6334) instead of REST, faster for
+                        searches and large upserts. The Docker image needs -p 6334:6334 as well.
+    QDRANT_TIMEOUT      seconds per request (default 60)
+    QDRANT_POOL_SIZE    HTTP connections or gRPC channels per client (default: qdrant_client's)
+    QDRANT_RETRIES      retries of a request that failed with a connection error, a timeout or a
+                        429/502/503/504 (default 3)
+    QDRANT_BACKOFF      seconds before the first retry, doubled after each (default 0.5)
+
+qdrant_client() returns one client per process, so every store, stage and script in it shares
+its connections. Every request of vector_store.QdrantStore goes through with_retry(). Upserts,
+deletes and payload updates are keyed by point ID, so repeating them is safe.
+
+Usage:
+    from config import collection_name, model_name, qdrant_client, with_retry
+    client = qdrant_client()
+    count = with_retry(client.count, collection_name=collection_name).count
+"""
+import os
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Name of collection on Qdrant (and of the local index)
+collection_name = "knowledge_base"
+# Child chunks of the hierarchical index, see embed.points_for_file
+children_collection = f"{collection_name}_children"
+
+# Embedding model being used
+model_name = "BAAI/bge-small-en-v1.5"
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").strip().lower() in ("1", "true", "yes")
+
+
+def _env_int(name: str, default=None):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_PREFER_GRPC = _env_flag("QDRANT_PREFER_GRPC")
+QDRANT_GRPC_PORT = _env_int("QDRANT_GRPC_PORT", 6334)
+QDRANT_TIMEOUT = _env_int("QDRANT_TIMEOUT", 60)
+QDRANT_POOL_SIZE = _env_int("QDRANT_POOL_SIZE")
+QDRANT_RETRIES = _env_int("QDRANT_RETRIES", 3)
+QDRANT_BACKOFF = float(os.getenv("QDRANT_BACKOFF") or 0.5)
+
+# HTTP statuses worth another try: rate limited, or the server is restarting / overloaded
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+def is_local(url: str) -> bool:
+    return "localhost" in url or "127.0.0.1" in url
+
+
+def client_options(prefer_grpc: bool = None, timeout: int = None, pool_size: int = None):
+    """Keyword arguments of QdrantClient / AsyncQdrantClient, the environment fills what isn't given"""
+    if not QDRANT_URL:
+        raise ValueError("QDRANT_URL is not set, set it in .env or use VECTOR_BACKEND=local")
+    options = {
+        "url": QDRANT_URL,
+        "prefer_grpc": QDRANT_PREFER_GRPC if prefer_grpc is None else prefer_grpc,
+        "grpc_port": QDRANT_GRPC_PORT,
+        "timeout": timeout or QDRANT_TIMEOUT,
+        "pool_size": pool_size or QDRANT_POOL_SIZE,
+    }
+    # Skip API key if running locally
+    if not is_local(QDRANT_URL):
+        options["api_key"] = QDRANT_API_KEY
+    return options
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def qdrant_client():
+    """The process-wide QdrantClient, created on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            from qdrant_client import QdrantClient
+            _client = QdrantClient(**client_options())
+        return _client
+
+
+def async_qdrant_client(**overrides):
+    # Not shared: an async client belongs to the event loop it was first used on
+    from qdrant_client import AsyncQdrantClient
+    return AsyncQdrantClient(**client_options(**overrides))
+
+
+def is_transient(error: Exception) -> bool:
+    """True for failures that can pass by themselves: lost connections, timeouts, overload"""
+    from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+    if isinstance(error, ResponseHandlingException):
+        # Connection refused / reset, or the request timed out
+        return True
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code in RETRY_STATUS
+    # gRPC errors can only come from a client that imported grpc
+    grpc = sys.modules.get("grpc")
+    if grpc is not None and isinstance(error, grpc.RpcError) and hasattr(error, "code"):
+        return error.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                                grpc.StatusCode.RESOURCE_EXHAUSTED)
+    return False
+
+
+def _retry_delay(attempt: int, error: Exception, backoff: float) -> float:
+    delay = backoff * 2 ** attempt
+    print(f"\tQdrant request failed ({type(error).__name__}), retry {attempt + 1} in {delay:.1f}s")
+    return delay
+
+
+def with_retry(fn, *args, retries: int = None, backoff: float = None, **kwargs):
+    """fn(*args, **kwargs), retried with exponential backoff while it fails with a transient error"""
+    retries = QDRANT_RETRIES if retries is None else retries
+    backoff = QDRANT_BACKOFF if backoff is None else backoff
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            time.sleep(_retry_delay(attempt, e, backoff))
+
+
+async def with_retry_async(fn, *args, retries: int = None, backoff: float = None, **kwargs):
+    """with_retry for coroutine functions, e.g. the methods of AsyncQdrantClient"""
+    import asyncio
+    retries = QDRANT_RETRIES if retries is None else retries
+    backoff = QDRANT_BACKOFF if backoff is None else backoff
+    for attempt in range(retries + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            await asyncio.sleep(_retry_delay(attempt, e, backoff))
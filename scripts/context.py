@@ -0,0 +1,157 @@
+"""
+Builds the context block of the rag() prompt from retrieved points, within a token budget
+
+Steps, in order:
+    dedup     near-duplicate chunks (same MinHash test as embed.py's dedup) keep only the best scoring one
+    merge     chunks of the same document with consecutive part_index are joined into one passage,
+              so the prompt doesn't repeat the "Relevant Document" header and cut sentences in half
+    trim      optional: each passage keeps only the sentences most similar to the question
+    budget    passages are added best first until the token budget is used up, the last one
+              is cut at a sentence boundary if a useful part of it still fits
+
+Tokens are estimated from the text (about 4 characters per token for words, 1 per punctuation
+mark), which is close enough to gpt-oss's tokenizer for budgeting without depending on it.
+
+Usage:
+    from context import assemble_context
+    context, stats = assemble_context(question, points, budget=2048)
+"""
+import math
+import re
+
+import numpy as np
+
+from dedup import NearDuplicateIndex
+from embeddings import embed_query, embed_texts
+
+DEFAULT_TOKEN_BUDGET = 2048   # tokens of context, ~8k characters
+TRIM_KEEP = 0.5               # share of each passage's sentences kept when trimming
+MIN_TAIL_TOKENS = 64          # don't bother adding a cut passage shorter than this
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+# Sentence ends, or line breaks so table rows count as sentences
+_SENTENCE_RE = re.compile(r"[^\n.!?]*(?:[.!?]+(?=\s|$)|\n|$)")
+
+
+def count_tokens(text: str) -> int:
+    return sum(math.ceil(len(piece) / 4) for piece in _PIECE_RE.findall(text))
+
+
+def split_sentences(text: str):
+    """Splits text into sentences (and lines), joining the pieces gives back text"""
+    pieces = [m.group(0) for m in _SENTENCE_RE.finditer(text) if m.group(0)]
+    # Whitespace after a sentence end belongs to the sentence, keep it attached
+    sentences = []
+    for piece in pieces:
+        if sentences and not piece.strip():
+            sentences[-1] += piece
+        else:
+            sentences.append(piece)
+    return sentences
+
+
+def _join(first: str, second: str, max_overlap: int = 512, min_overlap: int = 20):
+    # Neighbouring chunks are consecutive slices of the file, minus any overlap they share
+    for size in range(min(len(first), len(second), max_overlap), min_overlap - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + second
+
+
+def _passages(points, dedup: bool = True, merge: bool = True):
+    """[(document, text, best score, rank of best point)] best first"""
+    kept = []
+    duplicates = NearDuplicateIndex() if dedup else None
+    for rank, p in enumerate(points):
+        if duplicates is not None and duplicates.find_or_add(rank, p.payload["content"]) != rank:
+            continue
+        kept.append((rank, p))
+
+    if not merge:
+        return [(p.payload["document"], p.payload["content"], p.score, rank) for rank, p in kept]
+
+    by_document = {}
+    for rank, p in kept:
+        by_document.setdefault(p.payload["document"], []).append((p.payload["part_index"], rank, p))
+
+    passages = []
+    for document, parts in by_document.items():
+        parts.sort(key=lambda part: part[0])
+        run = [parts[0]]
+        for part in parts[1:]:
+            if part[0] == run[-1][0] + 1:
+                run.append(part)
+                continue
+            passages.append(_merge_run(document, run))
+            run = [part]
+        passages.append(_merge_run(document, run))
+    return sorted(passages, key=lambda passage: passage[3])
+
+
+def _merge_run(document, run):
+    text = run[0][2].payload["content"]
+    for _, _, p in run[1:]:
+        text = _join(text, p.payload["content"])
+    best = min(run, key=lambda part: part[1])
+    return document, text, best[2].score, best[1]
+
+
+def trim_sentences(question: str, text: str, keep: float = TRIM_KEEP):
+    """Keeps the keep share of sentences most similar to the question, in their original order"""
+    sentences = split_sentences(text)
+    if len(sentences) <= 2:
+        return text
+    vectors = embed_texts([s.strip() or "." for s in sentences])
+    similarity = vectors @ np.asarray(embed_query(question), dtype=np.float32)
+    n_keep = max(1, math.ceil(len(sentences) * keep))
+    chosen = np.sort(np.argsort(-similarity)[:n_keep])
+    return "".join(sentences[i] for i in chosen)
+
+
+def _cut(text: str, budget: int):
+    # Longest run of whole sentences from the start that fits in budget tokens
+    used = 0
+    pieces = []
+    for sentence in split_sentences(text):
+        tokens = count_tokens(sentence)
+        if used + tokens > budget:
+            break
+        pieces.append(sentence)
+        used += tokens
+    return "".join(pieces)
+
+
+def assemble_context(question: str, points, budget: int = DEFAULT_TOKEN_BUDGET, dedup: bool = True,
+                     merge: bool = True, trim: bool = False, trim_keep: float = TRIM_KEEP):
+    """
+    Returns (context string, stats). stats has tokens_in (all chunks as retrieved), tokens_out,
+    chunks_in, passages (after dedup and merging) and passages_used.
+    budget=None disables the limit.
+    """
+    tokens_in = sum(count_tokens(f"Relevant Document {i}, {p.payload["document"]}: {p.payload["content"]}")
+                    for i, p in enumerate(points))
+    passages = _passages(points, dedup, merge)
+
+    blocks = []
+    used = 0
+    for document, text, _, _ in passages:
+        if trim:
+            text = trim_sentences(question, text, trim_keep)
+        header = f"Relevant Document {len(blocks)}, {document}: "
+        tokens = count_tokens(header) + count_tokens(text)
+        if budget is not None and used + tokens > budget:
+            room = budget - used - count_tokens(header)
+            if room < MIN_TAIL_TOKENS:
+                break
+            text = _cut(text, room)
+            if not text.strip():
+                break
+            tokens = count_tokens(header) + count_tokens(text)
+        blocks.append(header + text)
+        used += tokens
+        if budget is not None and used >= budget - MIN_TAIL_TOKENS:
+            break
+
+    stats = {"chunks_in": len(points), "passages": len(passages), "passages_used": len(blocks),
+             "tokens_in": tokens_in, "tokens_out": used}
+    return "\n".join(blocks), stats
@@ -0,0 +1,87 @@
+"""
+Near-duplicate detection for chunks before they are embedded
+
+Exact duplicates are caught by content-hashed point IDs in embed.py. This catches chunks
+that are almost the same text (re-flowed whitespace, a changed header or footnote) using
+MinHash signatures over word shingles and LSH banding to find candidates.
+
+Chunks are only merged if their numbers match exactly, so two years of a filing that share
+boilerplate but report different figures stay separate points.
+"""
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_WORD_RE = re.compile(r"\w+")
+_NUMBER_RE = re.compile(r"\d[\d,.]*")
+
+
+def shingles(text: str, size: int):
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class NearDuplicateIndex:
+    def __init__(self, num_perm: int = 128, bands: int = 16, threshold: float = 0.9,
+                 shingle_size: int = 5, min_shingles: int = 8, seed: int = 291):
+        assert num_perm % bands == 0, "num_perm must be divisible by bands"
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.min_shingles = min_shingles
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+
+        self._buckets = [defaultdict(list) for _ in range(bands)]
+        self._signatures = {}
+        self._numbers = {}
+
+    def signature(self, text: str):
+        """MinHash signature of text, None if the text is too short to compare reliably"""
+        grams = shingles(text, self.shingle_size)
+        if len(grams) < self.min_shingles:
+            return None
+        hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.int64, count=len(grams))
+        # (a * x + b) mod p for every permutation and shingle, then min over shingles
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+    def find_or_add(self, key, text: str):
+        """
+        Returns the key of an already indexed near-duplicate of text,
+        otherwise indexes text under key and returns key
+        """
+        sig = self.signature(text)
+        if sig is None:
+            return key
+        numbers = tuple(_NUMBER_RE.findall(text))
+
+        band_keys = [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        # In the order they were added, a set of str keys would be in a different order every run
+        candidates = dict.fromkeys(c for band, bk in zip(self._buckets, band_keys) for c in band.get(bk, ()))
+        for candidate in candidates:
+            if self._numbers[candidate] != numbers:
+                continue
+            if np.mean(self._signatures[candidate] == sig) >= self.threshold:
+                return candidate
+
+        self._signatures[key] = sig
+        self._numbers[key] = numbers
+        for band, bk in zip(self._buckets, band_keys):
+            band[bk].append(key)
+        return key
+
+
+def duplicate_files(files):
+    """Groups manifest entries that have the same digest, only groups with more than one file"""
+    by_digest = defaultdict(list)
+    for name, entry in files.items():
+        by_digest[entry["digest"]].append(name)
+    return [sorted(names) for names in by_digest.values() if len(names) > 1]
@@ -1,70 +1,95 @@
 """
 Sets up embeddings in Qdrant
+
+Ingestion runs as a pipeline of stages joined by bounded queues, so reading,
+CPU embedding and Qdrant round-trips overlap instead of running one after another:
+
+    read files -> chunk -> dedup -> embed (process pool) -> upsert (threads)
+
+Usage:
+    python scripts/embed.py
+    python scripts/embed.py --embed-workers 4 --upsert-workers 2 --queue-size 8
+    python scripts/embed.py --pattern "*TSLA*.txt" --pattern "*NVDA*.txt"
+    python scripts/embed.py --rebuild
+    python scripts/embed.py --no-dedup
+    python scripts/embed.py --chunker sentence --chunk-size 768 --overlap 128
+    python scripts/embed.py --quantization scalar --on-disk --hnsw-m 32 --ef-construct 200
+    python scripts/embed.py --lazy-content
+    python scripts/embed.py --backend local --quantization scalar --ivf 64
+    python scripts/embed.py --children --child-size 256
+
+Indexing is incremental by default. Point IDs are derived from the document name and
+chunk content, and a local manifest records each file's digest and chunk IDs, so a run
+only embeds new or changed chunks and deletes the ones that disappeared.
+Use --rebuild to drop the collection and re-embed everything.
+
+After a run that changed anything, the local BM25 index used by hybrid retrieval
+(see bm25.py) and the chunk store (byte offsets of every chunk in its file, see chunk_store.py)
+are rebuilt from the manifest. With --lazy-content the chunk text is left out of the Qdrant
+payloads altogether and only read from the chunk store.
+
+Vectors also go through the on-disk embedding cache (see embeddings.py), so re-embedding a
+chunk that was seen before (after a --rebuild, a chunking change, ...) skips the model.
+
+With dedup on (the default) point IDs only hash the chunk content, so identical chunks
+from different filings are embedded once. Near-duplicate chunks found in the same run
+(see dedup.py) are folded into the copy with the lowest (file path, part) pair, whatever
+order the pipeline reaches them in. Every point lists all of its sources in
+the "sources", "documents" and "years" payload fields.
+
+With --children every chunk is also split into small child chunks (CHILD_SIZE characters,
+sentence boundaries) that go into their own collection, knowledge_base_children. A child's
+payload links it to its chunk through "parent_id", so retrieval.py --parents can search the
+precise children and return their deduplicated parent chunks as context.
+
+Storage options (--quantization, --on-disk, --hnsw-m, --ef-construct) are applied when the
+collection is created, or to the existing collection when given explicitly. They don't change
+the points, so nothing is re-embedded. See compare_storage.py for choosing them.
 """
-from uuid import uuid4
-from dotenv import load_dotenv
+import argparse
+import hashlib
+import json
 import os
+import queue
 import re
-from qdrant_client import QdrantClient, models
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from ollama import chat
-from ollama import ChatResponse
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Read Qdrant credentials
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-
-# Initialize the Qdrant client
-# Skip API key if running locally
-if "localhost" in QDRANT_URL or "127.0.0.1" in QDRANT_URL:
-    print(QDRANT_URL)
-    client = QdrantClient(url=QDRANT_URL, timeout=60)
-else:
-    client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-
-# Name of collection on Qdrant
-collection_name = "knowledge_base"
-
-# Embedding model being used
-model_name = "BAAI/bge-small-en-v1.5"
-
-#WARNING DELETE
-client.delete_collection(collection_name=collection_name)
-
-# Check if collection exists
-collections = [col.name for col in client.get_collections().collections]
-if collection_name not in collections:
-    print(f"Creating new collection: {collection_name}")
-    client.create_collection(
-        collection_name=collection_name,
-        vectors_config=models.VectorParams(
-            size=384,
-            distance=models.Distance.COSINE
-        ),
-    )
-else:
-    print(f"Collection '{collection_name}' already exists — skipping creation.")
+from uuid import NAMESPACE_URL, uuid5
 
+import numpy as np
+from qdrant_client import models
 
+from bm25 import DEFAULT_INDEX_PATH, BM25Index
+from chunk_store import DEFAULT_STORE_PATH, ChunkStore, normalize_newlines
+from chunking import STRATEGIES, chunk_document
+from companies import ticker_for_file
+from config import children_collection, collection_name, model_name
+from dedup import NearDuplicateIndex, duplicate_files
+from embeddings import cached_embed, get_cache
+from runtime import MODEL_CACHE_DIR
+from tracing import count, span
+from vector_store import BACKENDS, QUANTIZATION, get_store
 
-# # Loop through all .txt files in the folder
-# documents = []
-# for file_path in folder.rglob("*2022.txt"):
-#     with file_path.open("r", encoding="utf-8") as f:
-#         content = f.read()
-#         documents.append((file_path.name, content))
+CHUNK_SIZE = 1024         # max chars per chunk
+CHUNK_OVERLAP = 0         # chars shared by neighbouring chunks
+CHUNK_STRATEGY = "table"  # fixed, sentence or table, see chunking.py
+BATCH_SIZE = 128          # points per upsert
+CHILD_SIZE = 256          # max chars per child chunk with --children
 
+# Files picked up from dataset/ when no --pattern is given
+DEFAULT_PATTERNS = ["*GOOGL*.txt", "*MSFT*.txt", "*TSLA*.txt", "*META*.txt"]
 
-CHUNK_SIZE = 1024         # chars per chunk
-BATCH_SIZE = 128          # points per upsert
+# Records what is already in the collection, see load_manifest
+MANIFEST_PATH = Path(".index_manifest.json")
 
+# Bump when the payload layout changes, so the next run rewrites every point (vectors come from the cache)
+PAYLOAD_VERSION = 2
 
-def chunk_text(text: str, size: int):
-    for start in range(0, len(text), size):
-        yield text[start:start+size]
+# Namespace for deterministic point IDs
+ID_NAMESPACE = uuid5(NAMESPACE_URL, "cse291a/knowledge_base")
 
 
 def batched(iterable, n: int):
@@ -78,45 +103,560 @@ def batched(iterable, n: int):
         yield batch
 
 
-def points_for_file(path: Path):
-    with path.open("r", encoding="utf-8") as f:
-        text = f.read()
+def point_id(document: str, chunk: str) -> str:
+    # Same document + same content always maps to the same point
+    # With document=None the ID only depends on the content, which is what dedup relies on
+    key = chunk if document is None else f"{document}\n{chunk}"
+    return str(uuid5(ID_NAMESPACE, key))
+
+
+def child_id(parent_id: str, child_index: int) -> str:
+    # Children follow their parent: same parent, same children
+    return str(uuid5(ID_NAMESPACE, f"{parent_id}#{child_index}"))
 
+
+def year_for(name: str):
     # Regex to get the year out of the filename
-    year_match = re.search(r"\d{4}", path.stem)
+    year_match = re.search(r"\d{4}", Path(name).stem)
+    return year_match.group(0) if year_match else None
+
 
-    file_ext = path.suffix
+def source_payload(sources):
+    """Payload fields describing where a chunk came from, sources is a list of (file path, part_index)"""
+    sources = sorted(sources)
+    first_path, first_idx = sources[0]
+    return {
+        "document": Path(first_path).name,
+        "part_index": first_idx,
+        "year": year_for(first_path),
+        "ticker": ticker_for_file(Path(first_path).name),
+        "sources": [{"document": Path(p).name, "part_index": i, "year": year_for(p)} for p, i in sources],
+        "documents": sorted({Path(p).name for p, _ in sources}),
+        "years": sorted({y for y in (year_for(p) for p, _ in sources) if y}),
+        "tickers": sorted({t for t in (ticker_for_file(Path(p).name) for p, _ in sources) if t}),
+    }
 
-    # Extra parsing for
 
+def points_for_file(path: Path, text: str, dedup: bool = False, strategy: str = CHUNK_STRATEGY,
+                    size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP, child_size: int = None):
+    """
+    Points of every chunk of the file. With child_size each chunk is followed by its child
+    points: pieces of at most child_size characters, with "level": "child" and the chunk's
+    ID in "parent_id". Children have no "content", their text is part of the parent's.
+    """
     num_chunks = 0
-    for part_idx, chunk in enumerate(chunk_text(text, CHUNK_SIZE)):
-        yield models.PointStruct(
-            id=str(uuid4()),  # unique per chunk
-            vector=models.Document(text=chunk, model=model_name),
+    num_children = 0
+    for part_idx, chunk in enumerate(chunk_document(text, strategy, size, overlap)):
+        sources = source_payload([(path.as_posix(), part_idx)])
+        parent = models.PointStruct(
+            id=point_id(None if dedup else path.name, chunk.text),
+            vector=models.Document(text=chunk.text, model=model_name),
             payload={
-                "document": path.name,
-                "content": chunk,
-                "part_index": part_idx,
-                "year": year_match.group(0) if year_match else None,
+                "content": chunk.text,
+                "page": chunk.page,
+                "section": chunk.section,
+                **sources,
             },
         )
+        yield parent
         num_chunks += 1
 
-    print(f"\tPROCESSED: {path.name} -> {num_chunks} chunks generated")
-
-# Iterate files lazily, build points lazily, upsert in batches
-def all_points():
-    # Define the folder path
-    folder = Path("dataset")
-    for file_path in folder.rglob("*GOOGL*.txt"):
-        yield from points_for_file(file_path)
-    for file_path in folder.rglob("*MSFT*.txt"):
-        yield from points_for_file(file_path)
-    for file_path in folder.rglob("*TSLA*.txt"):
-        yield from points_for_file(file_path)
-    for file_path in folder.rglob("*META*.txt"):
-        yield from points_for_file(file_path)
-
-for batch in batched(all_points(), BATCH_SIZE):
-    client.upsert(collection_name=collection_name, points=batch, wait=True)
+        if child_size:
+            for child_idx, child in enumerate(chunk_document(chunk.text, "sentence", child_size)):
+                yield models.PointStruct(
+                    id=child_id(parent.id, child_idx),
+                    vector=models.Document(text=child.text, model=model_name),
+                    payload={
+                        "level": "child",
+                        "parent_id": parent.id,
+                        "child_index": child_idx,
+                        "page": chunk.page,
+                        "section": chunk.section,
+                        **sources,
+                    },
+                )
+                num_children += 1
+
+    children = f" ({num_children} children)" if child_size else ""
+    print(f"\tPROCESSED: {path.name} -> {num_chunks} chunks generated{children}")
+
+
+def is_child(point) -> bool:
+    return point.payload.get("level") == "child"
+
+
+def dataset_files(folder: Path, patterns):
+    seen = set()
+    for pattern in patterns:
+        for file_path in sorted(folder.rglob(pattern)):
+            if file_path not in seen:
+                seen.add(file_path)
+                yield file_path
+
+
+# ---- Incremental indexing ----
+
+def index_settings(dedup: bool = True, chunking=None, content: bool = True, backend: str = "qdrant",
+                   child_size: int = None):
+    # Anything that changes the point IDs or vectors invalidates the whole manifest
+    chunking = {"strategy": CHUNK_STRATEGY, "size": CHUNK_SIZE, "overlap": CHUNK_OVERLAP, **(chunking or {})}
+    settings = {"collection": collection_name, "model": model_name, "chunking": chunking, "dedup": dedup,
+                "payload": PAYLOAD_VERSION}
+    # Points without their text have to be rewritten, only recorded when off so existing manifests stay valid
+    if not content:
+        settings["content"] = False
+    # Each backend has its own points, the manifest only describes one of them
+    if backend != "qdrant":
+        settings["backend"] = backend
+    # Turning children on or off, or resizing them, rebuilds both levels
+    if child_size:
+        settings["children"] = child_size
+    return settings
+
+
+def load_manifest(path: Path = MANIFEST_PATH, settings=None):
+    """
+    Manifest layout:
+        {"settings": {...}, "files": {"dataset/tesla/NASDAQ_TSLA_2022.txt": {"digest": ..., "chunk_ids": [...]}}}
+    chunk_ids are stored in part_index order. An index with children also has
+    "children": {chunk_id: number of child points}, see child_id.
+    """
+    settings = settings or index_settings()
+    if not path.exists():
+        return {"settings": settings, "files": {}}
+    with path.open("r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("settings") != settings:
+        print("Index settings changed since the last run — re-embedding everything")
+        return {"settings": settings, "files": {}}
+    return manifest
+
+
+def save_manifest(manifest, path: Path = MANIFEST_PATH):
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    tmp.replace(path)
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sources_by_id(files, names=None):
+    sources = {}
+    for name in (files if names is None else names):
+        if name in files:
+            for idx, pid in enumerate(files[name]["chunk_ids"]):
+                sources.setdefault(pid, []).append((name, idx))
+    return {pid: sorted(s) for pid, s in sources.items()}
+
+
+def update_sources(store, old_files, new_files, changed, children_store=None, children=None):
+    """
+    Rewrites the source payload of points whose sources changed in this run: chunks that
+    moved to another part_index, or that are now shared with (or no longer shared with)
+    another file. Their vectors are left alone.
+    Their child points in children_store ({chunk_id: count} in children) get the same fields.
+    """
+    touched = sources_by_id(old_files, changed) | sources_by_id(new_files, changed)
+    old_sources = sources_by_id(old_files)
+    new_sources = sources_by_id(new_files)
+
+    updates = []
+    for pid in touched:
+        if pid not in new_sources:
+            continue
+        if pid in old_sources and old_sources[pid] == new_sources[pid]:
+            continue
+        # Freshly upserted points already carry their single source
+        if pid not in old_sources and len(new_sources[pid]) == 1:
+            continue
+        updates.append((pid, source_payload(new_sources[pid])))
+
+    store.set_payloads(updates)
+    if children_store is not None:
+        # Children are filtered on the same source fields as their parent
+        children_store.set_payloads([(child_id(pid, i), payload) for pid, payload in updates
+                                     for i in range(children.get(pid, 0))])
+    return len(updates)
+
+
+def read_text(path: Path) -> str:
+    with path.open("r", encoding="utf-8") as f:
+        return f.read()
+
+
+def build_sparse_index(manifest, path: Path = DEFAULT_INDEX_PATH):
+    """
+    Rebuilds the BM25 index for every point in the manifest. Chunking is deterministic,
+    so re-chunking each file lines its chunks up with the manifest's chunk_ids.
+    """
+    start = time.perf_counter()
+    ids, texts = [], []
+    seen = set()
+    for name, entry in sorted(manifest["files"].items()):
+        chunks = chunk_document(read_text(Path(name)), **manifest["settings"]["chunking"])
+        for pid, chunk in zip(entry["chunk_ids"], chunks):
+            if pid not in seen:
+                seen.add(pid)
+                ids.append(pid)
+                texts.append(chunk.text)
+
+    # Same filterable fields as the Qdrant payload
+    sources = sources_by_id(manifest["files"])
+    metadata = []
+    for pid in ids:
+        payload = source_payload(sources[pid])
+        metadata.append({"tickers": payload["tickers"], "years": payload["years"], "documents": payload["documents"]})
+
+    index = BM25Index.build(ids, texts, metadata)
+    index.save(path)
+    print(f"BM25 index: {len(index)} chunks, {len(index.vocab)} terms in {time.perf_counter() - start:.1f}s -> {path}")
+
+
+def build_chunk_store(manifest, path: Path = DEFAULT_STORE_PATH):
+    """Rebuilds the chunk store (see chunk_store.py) for every file in the manifest"""
+    start = time.perf_counter()
+    files = []
+    for name in sorted(manifest["files"]):
+        data = Path(name).read_bytes()
+        chunks = chunk_document(normalize_newlines(data.decode("utf-8")), **manifest["settings"]["chunking"])
+        files.append((name, data, [(chunk.start, chunk.end) for chunk in chunks]))
+    store = ChunkStore.build(files)
+    store.save(path)
+    print(f"Chunk store: {len(store)} chunks from {len(files)} files in {time.perf_counter() - start:.1f}s -> {path}")
+
+
+# ---- Embedding workers (run inside the process pool) ----
+
+_embedder = None
+
+
+def _init_embedder(name: str, threads: int):
+    global _embedder
+    from fastembed import TextEmbedding
+    _embedder = TextEmbedding(model_name=name, threads=threads, cache_dir=str(MODEL_CACHE_DIR))
+
+
+def _embed_texts(texts):
+    return np.stack(list(_embedder.embed(texts, batch_size=len(texts)))).astype(np.float32)
+
+
+# ---- Pipeline stages ----
+# Each stage is a function taking one item from its inbox and yielding items for its outbox
+
+def read_stage(path: Path, state):
+    with span("read", file=path.name) as s:
+        data = path.read_bytes()
+        s.set(bytes=len(data))
+    digest = file_digest(data)
+    old = state["old"].get(path.as_posix())
+    if old and old["digest"] == digest:
+        # Unchanged since the last run, passed on only so dedup_stage knows not to wait for it
+        with state["lock"]:
+            state["new"][path.as_posix()] = old
+        yield path, digest, None
+        return
+    # Same newline handling as reading the file in text mode
+    yield path, digest, data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def chunk_stage(item, state):
+    path, digest, text = item
+    if text is None:
+        yield item
+        return
+    dedup = state["near_dups"] is not None
+    with span("chunk", file=path.name) as s:
+        points = list(points_for_file(path, text, dedup, **state["chunking"], child_size=state["child_size"]))
+        s.set(chunks=len(points))
+    yield path, digest, points
+
+
+def dedup_stage(item, batch_size: int, state):
+    # Runs on a single worker: "known", "pending" and the near-duplicate index are not locked.
+    # Files arrive in whatever order the readers and chunkers finish them, they are deduplicated
+    # in path order so the same near-duplicate copy is kept on every run.
+    state["pending"][item[0]] = item
+    while state["order"] and state["order"][-1] in state["pending"]:
+        path, digest, points = state["pending"].pop(state["order"].pop())
+        if points is not None:
+            yield from _dedup_file(path, digest, points, batch_size, state)
+
+
+def _dedup_file(path: Path, digest: str, points, batch_size: int, state):
+    near_dups = state["near_dups"]
+
+    chunk_ids = []
+    fresh = []
+    children = {}
+    new_parent = False
+    for point in points:
+        if is_child(point):
+            # Children follow their parent and are only needed if it is new
+            if new_parent:
+                fresh.append(point)
+                children[point.payload["parent_id"]] = children.get(point.payload["parent_id"], 0) + 1
+            continue
+        pid = point.id
+        if near_dups is not None and pid not in state["known"]:
+            pid = near_dups.find_or_add(pid, point.payload["content"])
+        chunk_ids.append(pid)
+        # Already in the collection, or already on its way there
+        new_parent = pid not in state["known"]
+        if new_parent:
+            state["known"].add(pid)
+            fresh.append(point)
+
+    with state["lock"]:
+        state["new"][path.as_posix()] = {"digest": digest, "chunk_ids": chunk_ids}
+        state["children"].update(children)
+        state["skipped"] += len(chunk_ids) - sum(1 for point in fresh if not is_child(point))
+
+    yield from batched(fresh, batch_size)
+
+
+def embed_stage(batch, pool, cache: bool):
+    # Cache lookups happen here in the main process, only misses go to the pool
+    def compute(missing):
+        return pool.submit(_embed_texts, missing).result()
+    with span("embed_batch", chunks=len(batch)):
+        vectors = cached_embed([p.vector.text for p in batch], compute, model_name, cache=cache)
+    for point, vector in zip(batch, vectors):
+        point.vector = vector.tolist()
+    yield batch
+
+
+def upsert_stage(batch, store, stats, content: bool = True, children_store=None):
+    children = [point for point in batch if is_child(point)]
+    parents = [point for point in batch if not is_child(point)]
+    if not content:
+        # The text is served from the chunk store instead
+        for point in parents:
+            point.payload.pop("content", None)
+    with span("upsert", points=len(batch)):
+        if parents:
+            store.upsert(parents)
+        if children:
+            children_store.upsert(children)
+    count("chunks_upserted", len(parents))
+    with stats["lock"]:
+        stats["chunks"] += len(parents)
+        stats["children"] += len(children)
+    return ()
+
+
+_DONE = object()
+
+
+def start_stage(name, fn, inbox, outbox, workers: int, errors):
+    def work():
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # Put it back so the sibling workers also see it
+                inbox.put(_DONE)
+                return
+            try:
+                for out in fn(item):
+                    outbox.put(out)
+            except Exception as e:
+                # Keep draining so upstream stages never block on a full queue
+                errors.append((name, e))
+                print(f"\tERROR ({name}): {e}")
+
+    threads = [threading.Thread(target=work, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def run_pipeline(store, paths, manifest=None, dedup: bool = True, cache: bool = True, chunking=None,
+                 readers: int = 2, chunkers: int = 2, embed_workers: int = None, upsert_workers: int = 2,
+                 queue_size: int = 8, batch_size: int = BATCH_SIZE, content: bool = True, children_store=None,
+                 child_size: int = CHILD_SIZE):
+    """
+    Embeds and upserts every new or changed chunk under paths.
+    chunking holds strategy/size/overlap overrides for chunking.chunk_document.
+    content=False leaves the chunk text out of the payloads, see chunk_store.py.
+    With children_store, child chunks of child_size characters are indexed there, see points_for_file.
+    Returns the updated manifest, pass manifest=None to index everything from scratch.
+    """
+    child_size = child_size if children_store is not None else None
+    settings = index_settings(dedup, chunking, content, store.backend, child_size)
+    manifest = manifest or {"settings": settings, "files": {}}
+    state = {
+        "chunking": settings["chunking"],
+        "child_size": child_size,
+        "old": manifest["files"],
+        "new": {},
+        "known": {pid for entry in manifest["files"].values() for pid in entry["chunk_ids"]},
+        "near_dups": NearDuplicateIndex() if dedup else None,
+        "children": {},
+        "skipped": 0,
+        "lock": threading.Lock(),
+    }
+    # Near-duplicates are folded into the copy in the first path, see dedup_stage
+    paths = sorted(paths, key=Path.as_posix)
+    state["order"] = paths[::-1]
+    state["pending"] = {}
+
+    embed_workers = embed_workers or max(1, (os.cpu_count() or 2) // 2)
+    onnx_threads = max(1, (os.cpu_count() or 1) // embed_workers)
+
+    stats = {"chunks": 0, "children": 0, "lock": threading.Lock()}
+    errors = []
+    start = time.perf_counter()
+    if cache:
+        # Writes the embedding cache, unless another batch run already does
+        get_cache(model_name, writable=True)
+
+    with ProcessPoolExecutor(max_workers=embed_workers, initializer=_init_embedder,
+                             initargs=(model_name, onnx_threads)) as pool:
+        # paths -> texts -> points per file -> new point batches -> embedded batches -> (upserted)
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(5)]
+        sink = queue.Queue()
+        stages = [
+            ("read", partial(read_stage, state=state), readers),
+            ("chunk", partial(chunk_stage, state=state), chunkers),
+            ("dedup", partial(dedup_stage, batch_size=batch_size, state=state), 1),
+            ("embed", partial(embed_stage, pool=pool, cache=cache), embed_workers),
+            ("upsert", partial(upsert_stage, store=store, stats=stats, content=content, children_store=children_store),
+             upsert_workers),
+        ]
+        outboxes = queues[1:] + [sink]
+        threads = [
+            start_stage(name, fn, queues[i], outboxes[i], workers, errors)
+            for i, (name, fn, workers) in enumerate(stages)
+        ]
+
+        for path in paths:
+            queues[0].put(path)
+        queues[0].put(_DONE)
+
+        # Stages finish in order: once every worker of a stage exits, signal the next one
+        for stage_threads, outbox in zip(threads, outboxes):
+            for t in stage_threads:
+                t.join()
+            outbox.put(_DONE)
+
+    if cache:
+        embedding_cache = get_cache(model_name)
+        embedding_cache.flush()
+        print(f"Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses, {len(embedding_cache)} entries")
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} batch(es) failed during ingestion, first error in {errors[0][0]}: {errors[0][1]}")
+
+    # Files that were deleted from disk drop out of the manifest
+    files = dict(manifest["files"])
+    files.update(state["new"])
+    removed = [name for name in files if not Path(name).exists()]
+    for name in removed:
+        del files[name]
+
+    children = {**manifest.get("children", {}), **state["children"]}
+    changed = [name for name, entry in state["new"].items() if manifest["files"].get(name) is not entry]
+    relabeled = update_sources(store, manifest["files"], files, changed + removed, children_store, children)
+
+    live_ids = {pid for entry in files.values() for pid in entry["chunk_ids"]}
+    stale = {pid for entry in manifest["files"].values() for pid in entry["chunk_ids"]} - live_ids
+    store.delete(list(stale))
+    store.flush()
+    if children_store is not None:
+        children_store.delete([child_id(pid, i) for pid in stale for i in range(children.pop(pid, 0))])
+        children_store.flush()
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(paths)} files ({len(changed)} new or changed, {len(removed)} removed)")
+    for group in duplicate_files(files):
+        print(f"\tIDENTICAL FILES: {', '.join(Path(name).name for name in group)}")
+    print(f"Upserted {stats['chunks']} chunks, skipped {state['skipped']} duplicate or unchanged chunks, "
+          f"relabeled {relabeled}, deleted {len(stale)} stale chunks in {elapsed:.1f}s "
+          f"({stats['chunks'] / max(elapsed, 1e-9):.1f} chunks/s)")
+    if children_store is not None:
+        print(f"Upserted {stats['children']} child chunks, {sum(children.values())} in the index")
+        return {"settings": manifest["settings"], "files": files, "children": children}
+    return {"settings": manifest["settings"], "files": files}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed dataset text files into the vector store")
+    parser.add_argument("--dataset", default="dataset", help="Folder to search for text files")
+    parser.add_argument("--pattern", action="append", help="Glob of files to embed, can be repeated (default: GOOGL, MSFT, TSLA, META)")
+    parser.add_argument("--readers", type=int, default=2, help="File reader threads")
+    parser.add_argument("--chunkers", type=int, default=2, help="Chunker threads")
+    parser.add_argument("--embed-workers", type=int, default=None, help="Embedding processes (default: half the CPUs)")
+    parser.add_argument("--upsert-workers", type=int, default=2, help="Concurrent upsert threads")
+    parser.add_argument("--queue-size", type=int, default=8, help="Max items waiting between two stages")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Points per embedding batch / upsert")
+    parser.add_argument("--rebuild", action="store_true", help="Delete the collection and re-embed everything")
+    parser.add_argument("--manifest", type=Path, default=MANIFEST_PATH, help="Where the incremental index manifest is kept")
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false", help="Embed duplicate chunks from different files separately")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Don't read or write the embedding cache")
+    parser.add_argument("--no-sparse", dest="sparse", action="store_false", help="Don't rebuild the local BM25 index")
+    parser.add_argument("--chunker", choices=STRATEGIES, default=CHUNK_STRATEGY, help="Chunking strategy")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Max characters per chunk")
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP, help="Characters shared by neighbouring chunks")
+    parser.add_argument("--quantization", choices=sorted(QUANTIZATION), help="Quantize vectors, searches rescore with the originals")
+    parser.add_argument("--on-disk", action="store_true", default=None, help="Keep original vectors and payloads on disk")
+    parser.add_argument("--hnsw-m", type=int, help="HNSW links per node (Qdrant default 16)")
+    parser.add_argument("--ef-construct", type=int, help="HNSW build-time candidate list (Qdrant default 100)")
+    parser.add_argument("--lazy-content", dest="content", action="store_false", help="Keep chunk text out of the Qdrant payloads")
+    parser.add_argument("--backend", choices=BACKENDS, help="Vector store (default: VECTOR_BACKEND, else qdrant)")
+    parser.add_argument("--ivf", type=int, help="Local backend: number of IVF lists, 0 for brute force")
+    parser.add_argument("--children", action="store_true", help=f"Also index child chunks in '{children_collection}'")
+    parser.add_argument("--child-size", type=int, default=CHILD_SIZE, help="With --children: max characters per child chunk")
+    args = parser.parse_args()
+    if args.chunk_size < 1 or args.child_size < 1:
+        parser.error("--chunk-size and --child-size must be positive")
+    if not 0 <= args.overlap < args.chunk_size:
+        parser.error(f"--overlap must be at least 0 and less than --chunk-size ({args.chunk_size})")
+    chunking = {"strategy": args.chunker, "size": args.chunk_size, "overlap": args.overlap}
+    storage = {key: value for key, value in (("quantization", args.quantization), ("on_disk", args.on_disk),
+               ("hnsw_m", args.hnsw_m), ("ef_construct", args.ef_construct), ("ivf", args.ivf)) if value is not None}
+
+    store = get_store(args.backend, collection_name)
+    if store.backend != "local" and "ivf" in storage:
+        parser.error("--ivf only applies to --backend local")
+    children_store = get_store(args.backend, children_collection) if args.children else None
+    child_size = args.child_size if args.children else None
+    manifest = None if args.rebuild else load_manifest(
+        args.manifest, index_settings(args.dedup, chunking, args.content, store.backend, child_size))
+    if manifest and manifest["files"] and not store.exists():
+        print(f"Collection '{collection_name}' is missing — ignoring the manifest")
+        manifest = None
+    if manifest and manifest["files"] and children_store is not None and not children_store.exists():
+        print(f"Collection '{children_collection}' is missing — ignoring the manifest")
+        manifest = None
+    # Without a manifest (none yet, or the settings changed) nothing says which points are stale,
+    # start from empty collections so chunks of the old settings don't linger in searches
+    rebuild = args.rebuild or not (manifest and manifest["files"])
+    store.create(rebuild=rebuild, storage=storage)
+    if children_store is not None:
+        children_store.create(rebuild=rebuild, storage=storage)
+
+    paths = dataset_files(Path(args.dataset), args.pattern or DEFAULT_PATTERNS)
+    previous = manifest
+    manifest = run_pipeline(
+        store, paths, manifest,
+        dedup=args.dedup,
+        cache=args.cache,
+        chunking=chunking,
+        readers=args.readers,
+        chunkers=args.chunkers,
+        embed_workers=args.embed_workers,
+        upsert_workers=args.upsert_workers,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        content=args.content,
+        children_store=children_store,
+        child_size=args.child_size,
+    )
+    save_manifest(manifest, args.manifest)
+
+    if args.sparse and (manifest != previous or not DEFAULT_INDEX_PATH.exists()):
+        build_sparse_index(manifest)
+    if manifest != previous or not DEFAULT_STORE_PATH.exists():
+        build_chunk_store(manifest)
@@ -0,0 +1,263 @@
+"""
+Embedding layer shared by the scripts, with a persistent on-disk cache
+
+Vectors are cached per model under .cache/embeddings/<model>/:
+    vectors.f32   float32 memmap, one row per slot
+    index.bin     memmap of (key, last_used) per slot, key is a hash of model + text
+    lock          held by the process writing to the cache
+
+The files grow GROW_ENTRIES slots at a time up to max_entries, after that the least recently
+used entries are overwritten. The in-memory index is rebuilt from index.bin on load, and a
+slot's key is checked on every read, so a half-written entry is a cache miss rather than a
+wrong vector.
+
+Only one process writes at a time. Batch runs (embed.py, and the command lines of retrieval.py,
+rag.py, evaluate_documents.py, benchmark.py and compare_storage.py) open the cache with
+writable=True, which holds an exclusive lock on the lock file while they run, so repeated
+questions reuse their query vectors. A second writer falls back to reading. The long-lived
+service.py only reads, so it never keeps a batch run from writing. Readers see the entries
+that existed when they opened the cache. Within a process the cache is safe to share between
+threads.
+
+Usage:
+    from embeddings import embed_texts, embed_query
+    vectors = embed_texts(["chunk one", "chunk two"])
+    query = embed_query("How did Tesla's energy segment grow?")
+"""
+import atexit
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from config import model_name
+from runtime import MODEL_CACHE_DIR
+
+DEFAULT_CACHE_DIR = Path(".cache/embeddings")
+DEFAULT_MAX_ENTRIES = 200_000     # ~300 MB of vectors for a 384-dim model
+GROW_ENTRIES = 8192               # slots added when the cache is full, ~12 MB for a 384-dim model
+
+_INDEX_DTYPE = np.dtype([("key", "V16"), ("stamp", "<i8")])
+
+
+def _try_lock(path: Path):
+    """Open file holding an exclusive lock on path, None if another process has it"""
+    f = open(path, "a+b")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class EmbeddingCache:
+    def __init__(self, model: str, dim: int, cache_dir: Path = DEFAULT_CACHE_DIR,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, writable: bool = False):
+        self.model = model
+        self.dim = dim
+        self.max_entries = max_entries
+        self.dir = Path(cache_dir) / re.sub(r"[^\w.-]+", "_", model)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._lock_file = _try_lock(self.dir / "lock") if writable else None
+        if writable and self._lock_file is None:
+            print(f"Embedding cache {self.dir} is being written by another process, reading only")
+        self.writable = self._lock_file is not None
+        self._vectors_path = self.dir / "vectors.f32"
+        self._index_path = self.dir / "index.bin"
+        self._open()
+
+    def _open(self):
+        capacity = 0
+        if self._index_path.exists() and self._vectors_path.exists():
+            capacity = self._index_path.stat().st_size // _INDEX_DTYPE.itemsize
+            if self._vectors_path.stat().st_size != capacity * self.dim * 4:
+                # Written by a model with another dimension, start over
+                capacity = -1
+        if self.writable and (capacity < 0 or capacity > self.max_entries):
+            capacity = self._rebuild(max(capacity, 0))
+        self._capacity = max(capacity, 0)
+        self._map()
+
+        # key -> slot, least recently used first
+        stamps = np.asarray(self._index["stamp"]) if self._capacity else np.zeros(0, dtype=np.int64)
+        used = np.flatnonzero(stamps)
+        order = used[np.argsort(stamps[used])]
+        self._slots = OrderedDict((self._index["key"][slot].tobytes(), int(slot)) for slot in order)
+        self._free = sorted(set(range(self._capacity)) - set(self._slots.values()), reverse=True)
+        self._clock = int(stamps.max(initial=0))
+
+    def _map(self):
+        if not self._capacity:
+            self._vectors = self._index = None
+            return
+        mode = "r+" if self.writable else "r"
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode=mode, shape=(self._capacity, self.dim))
+        self._index = np.memmap(self._index_path, dtype=_INDEX_DTYPE, mode=mode, shape=(self._capacity,))
+
+    def _rebuild(self, old_capacity: int):
+        # Shrinks to max_entries keeping the most recently used entries, returns the new capacity.
+        # New files replace the old ones, so readers keep the copy they mapped.
+        keep_vectors = np.zeros((0, self.dim), dtype=np.float32)
+        keep_index = np.zeros(0, dtype=_INDEX_DTYPE)
+        if old_capacity:
+            old_vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(old_capacity, self.dim))
+            old_index = np.memmap(self._index_path, dtype=_INDEX_DTYPE, mode="r", shape=(old_capacity,))
+            used = np.flatnonzero(old_index["stamp"])
+            keep = used[np.argsort(old_index["stamp"][used])][-self.max_entries:]
+            keep_vectors = np.array(old_vectors[keep])
+            keep_index = np.array(old_index[keep])
+            del old_vectors, old_index
+        for path, data in ((self._vectors_path, keep_vectors), (self._index_path, keep_index)):
+            tmp = path.with_suffix(".tmp")
+            data.tofile(tmp)
+            tmp.replace(path)
+        return len(keep_index)
+
+    def _grow(self):
+        # Extends both files with zeroed (free) slots and maps them again
+        capacity = min(self.max_entries, self._capacity + GROW_ENTRIES)
+        if self._capacity:
+            self._vectors.flush()
+            self._index.flush()
+        self._vectors = self._index = None
+        for path, row_bytes in ((self._vectors_path, self.dim * 4), (self._index_path, _INDEX_DTYPE.itemsize)):
+            with open(path, "a+b") as f:
+                f.truncate(capacity * row_bytes)
+        self._free = list(range(capacity - 1, self._capacity - 1, -1)) + self._free
+        self._capacity = capacity
+        self._map()
+
+    def key(self, text: str, kind: str = "passage") -> bytes:
+        return hashlib.blake2b(f"{self.model}\0{kind}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+    def get_many(self, keys):
+        """Returns a list with a vector (copy) for every cached key and None for misses"""
+        found = []
+        with self._lock:
+            for key in keys:
+                slot = self._slots.get(key)
+                if slot is None or self._index["key"][slot].tobytes() != key:
+                    found.append(None)
+                    self.misses += 1
+                    continue
+                if self.writable:
+                    self._slots.move_to_end(key)
+                    self._clock += 1
+                    self._index["stamp"][slot] = self._clock
+                found.append(np.array(self._vectors[slot]))
+                self.hits += 1
+        return found
+
+    def put_many(self, keys, vectors):
+        """Stores the vectors, a no-op for a read-only cache"""
+        if not self.writable:
+            return
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                slot = self._slots.pop(key, None)
+                if slot is None:
+                    if not self._free and self._capacity < self.max_entries:
+                        self._grow()
+                    if self._free:
+                        slot = self._free.pop()
+                    else:
+                        # Evict the least recently used entry
+                        _, slot = self._slots.popitem(last=False)
+                self._clock += 1
+                # Vector first, so a crash in between leaves a key that doesn't match
+                self._vectors[slot] = vector
+                self._index[slot] = (key, self._clock)
+                self._slots[key] = slot
+
+    def flush(self):
+        with self._lock:
+            if self.writable and self._capacity:
+                self._vectors.flush()
+                self._index.flush()
+
+    def __len__(self):
+        return len(self._slots)
+
+
+_models = {}
+_caches = {}
+_models_lock = threading.Lock()
+
+
+def get_model(name: str = model_name, threads: int = None):
+    with _models_lock:
+        if name not in _models:
+            from fastembed import TextEmbedding
+            _models[name] = TextEmbedding(model_name=name, threads=threads, cache_dir=str(MODEL_CACHE_DIR))
+        return _models[name]
+
+
+def get_cache(name: str = model_name, cache_dir: Path = DEFAULT_CACHE_DIR, max_entries: int = DEFAULT_MAX_ENTRIES,
+              writable: bool = False):
+    """The process-wide cache of the model, read-only unless this or an earlier call asked for writable"""
+    with _models_lock:
+        cache = _caches.get(name)
+        if cache is None or (writable and not cache.writable):
+            from fastembed import TextEmbedding
+            cache = EmbeddingCache(name, TextEmbedding.get_embedding_size(name), cache_dir, max_entries, writable)
+            _caches[name] = cache
+        return cache
+
+
+def cached_embed(texts, compute, name: str = model_name, kind: str = "passage", cache: bool = True):
+    """
+    Looks texts up in the cache and calls compute(missing_texts) -> array for the rest.
+    Returns a float32 array of shape (len(texts), dim).
+    """
+    texts = list(texts)
+    if not cache:
+        return np.asarray(compute(texts), dtype=np.float32)
+
+    store = get_cache(name)
+    keys = [store.key(text, kind) for text in texts]
+    found = store.get_many(keys)
+    missing = [i for i, vector in enumerate(found) if vector is None]
+    if missing:
+        computed = np.asarray(compute([texts[i] for i in missing]), dtype=np.float32)
+        store.put_many([keys[i] for i in missing], computed)
+        for i, vector in zip(missing, computed):
+            found[i] = vector
+    if not found:
+        return np.empty((0, store.dim), dtype=np.float32)
+    return np.stack(found)
+
+
+def embed_texts(texts, name: str = model_name, cache: bool = True, batch_size: int = 256):
+    def compute(missing):
+        return list(get_model(name).embed(missing, batch_size=batch_size))
+    return cached_embed(texts, compute, name, "passage", cache)
+
+
+def embed_queries(questions, name: str = model_name, cache: bool = True):
+    def compute(missing):
+        return list(get_model(name).query_embed(missing))
+    return cached_embed(questions, compute, name, "query", cache)
+
+
+def embed_query(question: str, name: str = model_name, cache: bool = True):
+    # Qdrant's query_points accepts a plain list of floats
+    return embed_queries([question], name, cache)[0].tolist()
+
+
+@atexit.register
+def _flush_caches():
+    for store in list(_caches.values()):
+        store.flush()
@@ -1,20 +1,42 @@
-import os
-from dotenv import load_dotenv
-from qdrant_client import QdrantClient
-
-# Load environment variables
-load_dotenv()
-
-# Initialize Qdrant client
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-
-if "localhost" in QDRANT_URL or "127.0.0.1" in QDRANT_URL:
-    client = QdrantClient(url=QDRANT_URL, timeout=60)
-else:
-    client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-
-collection_name = "knowledge_base"
+"""
+Evaluates retrieval, either by hand or in batch against stored gold labels
+
+Interactive (default): judge each retrieved chunk y/n, optionally saving the judgments as gold
+labels with --save-labels.
+
+Batch: --gold takes a JSONL query set, one query per line:
+    {"id": "tsla-energy", "question": "...",
+     "relevant": [{"document": "NASDAQ_TSLA_2023.txt", "part_index": 42, "grade": 2}, ["NASDAQ_TSLA_2023.txt", 43]]}
+grade is optional (default 1) and only matters for nDCG. Labels are resolved to point IDs through
+the index manifest, so a chunk shared by several filings matches whichever one it was stored under.
+Every question is retrieved in one batch (or read from a retrieval.py --questions output with
+--results), P@k, R@k, MAP, MRR and nDCG@k are computed for all queries at once, and the run is saved
+under .eval_runs/ so runs over different index configurations can be compared with --compare.
+
+Usage:
+    python scripts/evaluate_documents.py
+    python scripts/evaluate_documents.py --gold gold.jsonl --mode hybrid --name hybrid
+    python scripts/evaluate_documents.py --gold gold.jsonl --results results.jsonl --name from-file
+    python scripts/evaluate_documents.py --compare .eval_runs/*.json --report report.md
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from chunk_store import fill_content
+from config import collection_name, model_name
+from runtime import lazy_import
+
+# Qdrant or the local index, see vector_store.py. Imported on first use, --compare doesn't need it
+vector_store = lazy_import("vector_store")
+
+MANIFEST_PATH = Path(".index_manifest.json")   # written by embed.py
+RUNS_DIR = Path(".eval_runs")
+DEFAULT_KS = (1, 3, 5, 10)
 
 # Can dump in string directly from RAG script
 def parse_document_references(dump_string):
@@ -41,21 +63,43 @@ def parse_document_references(dump_string):
     return references
 
 
-def fetch_chunk(doc_name, chunk_idx):
-    results = client.scroll(
-        collection_name=collection_name,
-        scroll_filter={
-            "must": [
-                {"key": "document", "match": {"value": doc_name}},
-                {"key": "part_index", "match": {"value": chunk_idx}}
-            ]
-        },
-        limit=1
-    )
-
-    if results:
-        return results[0][0]
-    return None
+def load_manifest_ids(path: Path = MANIFEST_PATH):
+    """File name -> point IDs in part_index order, from the manifest embed.py writes"""
+    if not path.exists():
+        return {}
+    with path.open("r", encoding="utf-8") as f:
+        files = json.load(f)["files"]
+    return {Path(name).name: entry["chunk_ids"] for name, entry in files.items()}
+
+
+def resolve_references(references, manifest_ids=None):
+    """(doc_name, part_index) -> point ID, None where the manifest doesn't have it"""
+    manifest_ids = load_manifest_ids() if manifest_ids is None else manifest_ids
+    resolved = {}
+    for doc_name, chunk_idx in references:
+        ids = manifest_ids.get(doc_name)
+        resolved[(doc_name, chunk_idx)] = ids[chunk_idx] if ids and 0 <= chunk_idx < len(ids) else None
+    return resolved
+
+
+def fetch_chunks(references, manifest_ids=None):
+    """fetch_chunk for many references in one request, returns {(doc_name, part_index): record or None}"""
+    references = list(dict.fromkeys(references))
+    resolved = resolve_references(references, manifest_ids)
+    ids = list(dict.fromkeys(pid for pid in resolved.values() if pid))
+    store = vector_store.get_store(name=collection_name)
+    records = {}
+    if ids:
+        records = {str(r.id): r for r in store.retrieve(ids, with_payload=True)}
+    chunks = {ref: records.get(pid) if pid else None for ref, pid in resolved.items()}
+
+    # Without a manifest entry, match on the payload instead, still in one request
+    missing = [ref for ref, chunk in chunks.items() if chunk is None]
+    for record in store.find(missing):
+        chunks[(record.payload["document"], record.payload["part_index"])] = record
+    # Collections built with --lazy-content keep the text in the chunk store only
+    fill_content([chunk for chunk in chunks.values() if chunk is not None])
+    return chunks
 
 
 def calculate_metrics(relevance_judgments):
@@ -126,17 +170,17 @@ def calculate_metrics(relevance_judgments):
     }
 
 
-def evaluate_retrieval(query, document_references):
+def evaluate_retrieval(query, document_references, save_labels=None):
     print(f"Query: {query}")
 
     relevance_judgments = []
+    judged = []
 
     parsed_doc_refs = parse_document_references(document_references)
+    chunks = fetch_chunks(parsed_doc_refs)
 
     for i, (doc_name, chunk_idx) in enumerate(parsed_doc_refs):
-        # doc_name, chunk_idx = parse_document_references(doc_ref)
-
-        chunk = fetch_chunk(doc_name, chunk_idx)
+        chunk = chunks.get((doc_name, chunk_idx))
         if chunk is None:
             print(f"\n[{i}/{len(document_references)}] WARNING: Could not find chunk")
             print(f"  Document: {doc_name}, Chunk: {chunk_idx}")
@@ -153,9 +197,13 @@ def evaluate_retrieval(query, document_references):
             response = input(f"\nRelevant to the query? (y/n): ").strip().lower()
             if response in ['y', 'n']:
                 relevance_judgments.append(response == 'y')
+                judged.append((doc_name, chunk_idx, response == 'y'))
                 break
             print("only enter 'y' or 'n'")
 
+    if save_labels:
+        save_gold_labels(save_labels, query, [(doc_name, chunk_idx) for doc_name, chunk_idx, relevant in judged if relevant])
+
     print(f"\n\n{'='*80}")
     print("EVALUATION RESULTS")
     print(f"{'='*80}\n")
@@ -180,7 +228,193 @@ def evaluate_retrieval(query, document_references):
     return results
 
 
-if __name__ == "__main__":
+# ---- Batch mode ----
+
+def load_gold(path):
+    """Query set as a list of {"id", "question", "relevant": {(doc_name, part_index): grade}}"""
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            relevant = {}
+            for label in record["relevant"]:
+                if isinstance(label, dict):
+                    relevant[(label["document"], int(label["part_index"]))] = label.get("grade", 1)
+                else:
+                    relevant[(label[0], int(label[1]))] = label[2] if len(label) > 2 else 1
+            queries.append({"id": record.get("id", str(n)), "question": record["question"], "relevant": relevant})
+    return queries
+
+
+def save_gold_labels(path, question, references):
+    # Appends one query to a gold-label file, in the format load_gold reads
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"question": question, "relevant": [[doc_name, chunk_idx] for doc_name, chunk_idx in references]}) + "\n")
+    print(f"Saved {len(references)} relevant chunks for this query to {path}")
+
+
+def read_results(path):
+    """Question -> retrieved point IDs, from the JSONL written by retrieval.py --questions"""
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {r["question"]: [hit["id"] for hit in r["results"]] for r in records}
+
+
+def gain_matrix(retrieved, gold_ids, depth: int):
+    """gains[q, rank] = grade of the rank-th retrieved point of query q, 0 if not relevant"""
+    gains = np.zeros((len(retrieved), depth), dtype=np.float64)
+    for q, (ids, grades) in enumerate(zip(retrieved, gold_ids)):
+        for rank, pid in enumerate(ids[:depth]):
+            gains[q, rank] = grades.get(pid, 0)
+    return gains
+
+
+def batch_metrics(gains, gold_ids, ks=DEFAULT_KS):
+    """Per-query metrics for every query at once, {name: array of shape (queries,)}"""
+    n_queries, depth = gains.shape
+    relevant = gains > 0
+    n_relevant = np.array([sum(1 for grade in grades.values() if grade > 0) for grades in gold_ids], dtype=np.float64)
+    ranks = np.arange(1, depth + 1)
+
+    hits = np.cumsum(relevant, axis=1)
+    precision = hits / ranks
+    recall = hits / np.maximum(n_relevant, 1)[:, None]
+
+    discounts = 1 / np.log2(ranks + 1)
+    dcg = np.cumsum((2 ** gains - 1) * discounts, axis=1)
+    ideal = np.zeros_like(gains)
+    for q, grades in enumerate(gold_ids):
+        best = sorted((g for g in grades.values() if g > 0), reverse=True)[:depth]
+        ideal[q, :len(best)] = best
+    idcg = np.cumsum((2 ** ideal - 1) * discounts, axis=1)
+    ndcg = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+
+    metrics = {
+        "MAP": (precision * relevant).sum(axis=1) / np.maximum(n_relevant, 1),
+        "MRR": np.where(relevant.any(axis=1), 1 / (relevant.argmax(axis=1) + 1), 0.0),
+    }
+    for k in ks:
+        if k > depth:
+            continue
+        metrics[f"P@{k}"] = precision[:, k - 1]
+        metrics[f"R@{k}"] = recall[:, k - 1]
+        metrics[f"nDCG@{k}"] = ndcg[:, k - 1]
+    return metrics
+
+
+def evaluate_batch(gold_path, n_points: int = 10, mode: str = "dense", rerank: bool = False, auto_filter: bool = True,
+                   results_path=None, name=None, ks=DEFAULT_KS, runs_dir: Path = RUNS_DIR, parents: bool = False):
+    queries = load_gold(gold_path)
+    manifest_ids = load_manifest_ids()
+    if not manifest_ids:
+        raise SystemExit(f"No index manifest at {MANIFEST_PATH}, run embed.py first")
+
+    # Gold labels -> point IDs, and one request to check they still exist in the collection
+    references = [ref for query in queries for ref in query["relevant"]]
+    chunks = fetch_chunks(references, manifest_ids)
+    stale = [ref for ref, chunk in chunks.items() if chunk is None]
+    if stale:
+        print(f"WARNING: {len(stale)} gold labels don't match any chunk (re-chunked index?): {stale[:5]}")
+    gold_ids = [
+        {str(chunks[ref].id): grade for ref, grade in query["relevant"].items() if chunks.get(ref) is not None}
+        for query in queries
+    ]
+
+    questions = [query["question"] for query in queries]
+    timings = {}
+    start = time.perf_counter()
+    if results_path:
+        stored = read_results(results_path)
+        retrieved = [stored.get(question, []) for question in questions]
+    else:
+        from retrieval import retrieve_batch
+        points = retrieve_batch(questions, n_points, mode, auto_filter=auto_filter, timings=timings, rerank=rerank,
+                                parents=parents)
+        retrieved = [[str(p.id) for p in ranked] for ranked in points]
+    elapsed = time.perf_counter() - start
+
+    # Queries without any usable label can't be scored
+    scored = [q for q, grades in enumerate(gold_ids) if grades]
+    if len(scored) < len(queries):
+        print(f"WARNING: skipping {len(queries) - len(scored)} queries without relevant labels")
+    depth = max([n_points, *ks, *(len(retrieved[q]) for q in scored)])
+    gains = gain_matrix([retrieved[q] for q in scored], [gold_ids[q] for q in scored], depth)
+    per_query = batch_metrics(gains, [gold_ids[q] for q in scored], ks)
+    summary = {metric: float(values.mean()) if len(values) else 0.0 for metric, values in per_query.items()}
+
+    created = datetime.now(timezone.utc)
+    name = name or f"{mode}{'-parents' if parents else ''}{'-rerank' if rerank else ''}-{created:%Y%m%d-%H%M%S}"
+    with MANIFEST_PATH.open("r", encoding="utf-8") as f:
+        index_settings = json.load(f)["settings"]
+    run = {
+        "name": name,
+        "created": created.isoformat(),
+        "config": {"mode": mode, "n_points": n_points, "rerank": rerank, "parents": parents, "auto_filter": auto_filter,
+                   "results": str(results_path) if results_path else None, "index": index_settings},
+        "queries_scored": len(scored),
+        "seconds": elapsed,
+        "timings": timings,
+        "metrics": summary,
+        "per_query": [
+            {"id": queries[q]["id"], "question": queries[q]["question"], "retrieved": retrieved[q],
+             **{metric: float(values[i]) for metric, values in per_query.items()}}
+            for i, q in enumerate(scored)
+        ],
+    }
+    runs_dir.mkdir(parents=True, exist_ok=True)
+    run_path = runs_dir / f"{name}.json"
+    with run_path.open("w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+
+    print(f"Evaluated {len(scored)} queries in {elapsed:.2f}s -> {run_path}")
+    for metric, value in summary.items():
+        print(f"{metric:<10} {value:.4f}")
+    return run
+
+
+def compare_runs(run_paths, report_path=None):
+    """Markdown table of every run's mean metrics, with the change against the first run"""
+    runs = []
+    for path in run_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            runs.append(json.load(f))
+    if not runs:
+        print("No runs to compare")
+        return ""
+    metrics = list(dict.fromkeys(metric for run in runs for metric in run["metrics"]))
+    baseline = runs[0]["metrics"]
+
+    lines = [
+        "| run | mode | rerank | chunking | queries | " + " | ".join(metrics) + " |",
+        "|---|---|---|---|---|" + "---|" * len(metrics),
+    ]
+    for run in runs:
+        config = run["config"]
+        chunking = config["index"].get("chunking", {})
+        cells = []
+        for metric in metrics:
+            value = run["metrics"].get(metric)
+            if value is None:
+                cells.append("")
+            elif run is runs[0] or metric not in baseline:
+                cells.append(f"{value:.4f}")
+            else:
+                cells.append(f"{value:.4f} ({value - baseline[metric]:+.4f})")
+        lines.append(f"| {run['name']} | {config['mode']} | {config['rerank']} | "
+                     f"{chunking.get('strategy', '')}/{chunking.get('size', '')} | {run['queries_scored']} | "
+                     + " | ".join(cells) + " |")
+    report = "\n".join(lines) + "\n"
+    print(report)
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write(report)
+        print(f"Report written to {report_path}")
+    return report
+
+
+def interactive_example(save_labels=None):
     # what was the question asked, doesn't have to be filled out
     query = ""
 
@@ -199,4 +433,32 @@ Relevant Document 9, NASDAQ_MSFT_2023.txt, chunk index 5
 
         """
 
-    results = evaluate_retrieval(query, document_refs)
+    return evaluate_retrieval(query, document_refs, save_labels)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate retrieval by hand, or in batch against gold labels")
+    parser.add_argument("--gold", help="JSONL query set with gold labels, runs a batch evaluation")
+    parser.add_argument("--results", help="With --gold: score this retrieval.py --questions output instead of retrieving")
+    parser.add_argument("--mode", default="dense", help="With --gold: retrieval mode (dense, sparse, hybrid)")
+    parser.add_argument("--n-points", type=int, default=10, help="With --gold: chunks retrieved per question")
+    parser.add_argument("--rerank", action="store_true", help="With --gold: rerank with the cross-encoder")
+    parser.add_argument("--parents", action="store_true", help="With --gold: search child chunks, score their parents")
+    parser.add_argument("--no-auto-filter", dest="auto_filter", action="store_false", help="With --gold: don't infer filters from questions")
+    parser.add_argument("--name", help="With --gold: name of the saved run")
+    parser.add_argument("--compare", nargs="+", metavar="RUN", help="Saved run files to compare, the first is the baseline")
+    parser.add_argument("--report", help="With --compare: write the comparison table to this file")
+    parser.add_argument("--save-labels", help="Interactive: append the judgments to this gold-label file")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_runs(args.compare, args.report)
+    else:
+        # A batch run: the query vectors go into the embedding cache for the next one
+        from embeddings import get_cache
+        get_cache(model_name, writable=True)
+        if args.gold:
+            evaluate_batch(args.gold, args.n_points, args.mode, args.rerank, args.auto_filter, args.results, args.name,
+                           parents=args.parents)
+        else:
+            interactive_example(args.save_labels)
@@ -1,31 +1,104 @@
 '''
-plumbertxtextract.py takes the csv output from pdfplumber, extracts the 'char' column and combines characters into a txt file.
+plumbertxtextract.py takes the csv output from pdfplumber, extracts the 'char' rows and combines characters into a txt file.
 
-replace 'input.csv' with location of pdfplumber csv
-replace 'output.txt' with location of txt conversion
+The CSV is streamed row by row and the text is written out in chunks, so memory stays flat no
+matter how many char rows the export has. Word and line breaks are rebuilt from the
+page_number / top / x0 / x1 columns when they are present.
+
+Usage:
+    python plumber_csv_to_txt.py input.csv
+    python plumber_csv_to_txt.py dataset/*/*.csv --out-dir converted --workers 4
+    python plumber_csv_to_txt.py input.csv --no-layout      # just concatenate chars, like before
 '''
 
+import argparse
 import csv
-import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# Cells holding path data can be huge, but stay below what the C long on every platform can hold
+csv.field_size_limit(2**31 - 1)
+
+WRITE_CHUNK = 1 << 16       # chars buffered before each write
+LINE_TOLERANCE = 0.5        # vertical jump (in font sizes) that starts a new line
+SPACE_TOLERANCE = 0.15      # horizontal gap (in font sizes) that counts as a space
+
+
+def _column(header, name):
+    return header.index(name) if name in header else None
+
+
+def convert(input_csv, output_txt, layout=True):
+    chars = 0
+    with open(input_csv, newline='', encoding='utf-8') as csvfile, open(output_txt, "w", encoding="utf-8") as out:
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        if header is None:
+            return input_csv, 0
+        type_col = header.index("object_type")
+        text_col = header.index("text")
+        page_col, top_col, x0_col, x1_col, size_col = (
+            _column(header, name) for name in ("page_number", "top", "x0", "x1", "size")
+        )
+        layout = layout and None not in (page_col, top_col, x0_col, x1_col)
+
+        buffer = []
+        buffered = 0
+        prev_page = prev_top = prev_x1 = None
+        for row in reader:
+            # Only char rows are looked at past the first column
+            if len(row) <= text_col or row[type_col] != "char" or not row[text_col]:
+                continue
+            text = row[text_col]
+
+            if layout:
+                page = row[page_col]
+                top = float(row[top_col])
+                x0 = float(row[x0_col])
+                size = float(row[size_col]) if size_col is not None and row[size_col] else 10.0
+                if prev_page is not None:
+                    if page != prev_page:
+                        text = "\n\n" + text
+                    elif abs(top - prev_top) > LINE_TOLERANCE * size:
+                        text = "\n" + text
+                    elif x0 - prev_x1 > SPACE_TOLERANCE * size and not text.isspace():
+                        text = " " + text
+                prev_page, prev_top, prev_x1 = page, top, float(row[x1_col])
 
-input_csv = "input.csv"
-output_txt = "output.txt"
+            buffer.append(text)
+            buffered += len(text)
+            chars += 1
+            if buffered >= WRITE_CHUNK:
+                out.write("".join(buffer))
+                buffer.clear()
+                buffered = 0
+        out.write("".join(buffer))
+    return input_csv, chars
 
-# Increase field size limit to handle huge CSV cells
-csv.field_size_limit(sys.maxsize)
 
-chars = []
+def output_for(input_csv, out_dir=None):
+    out = Path(input_csv).with_suffix(".txt")
+    return str(Path(out_dir) / out.name) if out_dir else str(out)
 
-with open(input_csv, newline='', encoding='utf-8') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        if row.get("object_type") == "char" and row.get("text"):
-            chars.append(row["text"])
 
-# Join all the characters
-text_content = "".join(chars)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert pdfplumber CSV exports to text")
+    parser.add_argument("input_csv", nargs="+", help="pdfplumber CSV file(s)")
+    parser.add_argument("--out-dir", help="Where to write .txt files (default: next to each CSV)")
+    parser.add_argument("--workers", type=int, default=None, help="Files converted in parallel (default: all CPUs)")
+    parser.add_argument("--no-layout", dest="layout", action="store_false", help="Don't rebuild word and line breaks")
+    args = parser.parse_args()
 
-with open(output_txt, "w", encoding="utf-8") as f:
-    f.write(text_content)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
 
-print(f"Extracted {len(chars)} characters to {output_txt}")
+    outputs = [output_for(path, args.out_dir) for path in args.input_csv]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(convert, src, dst, args.layout) for src, dst in zip(args.input_csv, outputs)]
+        for future, output_txt in zip(futures, outputs):
+            try:
+                input_csv, chars = future.result()
+                print(f"Extracted {chars} characters from {input_csv} to {output_txt}")
+            except Exception as e:
+                print(f"ERROR converting to {output_txt}: {e}")
@@ -4,11 +4,25 @@ pdf_line_extractor.py - Extract text from PDF using pdfplumber line extraction
 Usage:
     python pdf_line_extractor.py input.pdf output.txt
     python pdf_line_extractor.py input.pdf output.txt --pages 1-5,10,15-20
+    python pdf_line_extractor.py --batch dataset --workers 8
+    python pdf_line_extractor.py --batch "dataset/tesla/*.pdf" --out-dir converted --force
+
+Batch mode converts every PDF under a directory (or matching a glob). Pages are split into
+spans that run across a process pool, each span is streamed to disk page by page and the
+spans are stitched together in order. PDFs whose .txt output is newer than the PDF are skipped.
 '''
 
 import pdfplumber
 import sys
 import argparse
+import glob
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+PAGES_PER_TASK = 16       # pages handled by one worker task
 
 # Parse out the ranges and make it a set of pages to read through
 def parse_page_ranges(range_string):
@@ -21,34 +35,40 @@ def parse_page_ranges(range_string):
             pages.add(int(part))
     return pages
 
-def extract_lines_from_pdf(pdf_path, output_path, page_ranges=None):
-    all_text = []
-
-    with pdfplumber.open(pdf_path) as pdf:
-        for page_num, page in enumerate(pdf.pages, start=1):
-            if page_ranges and page_num not in page_ranges:
-                continue
-
-            all_text.append(f"\n--- Page {page_num} ---\n")
-
-            text = page.extract_text(x_tolerance=1, layout=False)
+def page_pieces(page, page_num):
+    yield f"\n--- Page {page_num} ---\n"
+
+    text = page.extract_text(x_tolerance=1, layout=False)
+
+    if text:
+        yield text
+
+    tables = page.extract_tables()
+    if tables:
+        yield "\n[TABLE START]\n"
+        for table_idx, table in enumerate(tables, start=1):
+            yield format_table_as_plain_text(table)
+        yield "\n[TABLE END]\n"
+
+def write_pages(pdf, out, page_nums, first=True):
+    # Pieces are separated by newlines, written as soon as each page is done
+    for page_num in page_nums:
+        page = pdf.pages[page_num - 1]
+        for piece in page_pieces(page, page_num):
+            if not first:
+                out.write("\n")
+            out.write(piece)
+            first = False
+        # Drop pdfplumber's cached layout objects for this page
+        page.close()
+    return len(page_nums)
 
-            if text:
-                all_text.append(text)
-
-            tables = page.extract_tables()
-            if tables:
-                all_text.append("\n[TABLE START]\n")
-                for table_idx, table in enumerate(tables, start=1):
-                    all_text.append(format_table_as_plain_text(table))
-                all_text.append("\n[TABLE END]\n")
-
-    text_content = "\n".join(all_text)
-
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(text_content)
+def extract_lines_from_pdf(pdf_path, output_path, page_ranges=None):
+    with pdfplumber.open(pdf_path) as pdf, open(output_path, "w", encoding="utf-8") as out:
+        page_nums = [n for n in range(1, len(pdf.pages) + 1) if not page_ranges or n in page_ranges]
+        write_pages(pdf, out, page_nums)
 
-    print(f"Extracted text from {len(pdf.pages)} pages")
+        print(f"Extracted text from {len(pdf.pages)} pages")
     print(f"Output written to: {output_path}")
 
 def format_table_as_plain_text(table):
@@ -63,13 +83,113 @@ def format_table_as_plain_text(table):
 
     return "\n".join(lines)
 
+# ---- Batch mode ----
+
+def find_pdfs(target):
+    path = Path(target)
+    if path.is_dir():
+        return sorted(path.rglob("*.pdf"))
+    if path.is_file():
+        return [path]
+    return sorted(Path(p) for p in glob.glob(target, recursive=True) if p.lower().endswith(".pdf"))
+
+def output_for(pdf_path, out_dir=None):
+    out = pdf_path.with_suffix(".txt")
+    return Path(out_dir) / out.name if out_dir else out
+
+def is_up_to_date(pdf_path, output_path):
+    return output_path.exists() and output_path.stat().st_mtime >= pdf_path.stat().st_mtime
+
+def extract_span(pdf_path, part_path, page_nums, first):
+    # Runs in a worker process
+    with pdfplumber.open(pdf_path) as pdf, open(part_path, "w", encoding="utf-8") as out:
+        return write_pages(pdf, out, page_nums, first)
+
+def stitch(output_path, part_paths):
+    tmp = output_path.with_name(output_path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as out:
+        for part in part_paths:
+            with open(part, "r", encoding="utf-8") as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part)
+    os.replace(tmp, output_path)
+
+def extract_batch(target, out_dir=None, workers=None, page_ranges=None, force=False, pages_per_task=PAGES_PER_TASK):
+    pdfs = find_pdfs(target)
+    if out_dir:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    jobs = []
+    for pdf_path in pdfs:
+        output_path = output_for(pdf_path, out_dir)
+        if not force and is_up_to_date(pdf_path, output_path):
+            print(f"\tSKIPPED (up to date): {pdf_path}")
+            continue
+        with pdfplumber.open(pdf_path) as pdf:
+            num_pages = len(pdf.pages)
+        page_nums = [n for n in range(1, num_pages + 1) if not page_ranges or n in page_ranges]
+        spans = [page_nums[i:i + pages_per_task] for i in range(0, len(page_nums), pages_per_task)] or [[]]
+        parts = [output_path.with_name(f"{output_path.name}.part{i:04d}") for i in range(len(spans))]
+        jobs.append((pdf_path, output_path, spans, parts))
+
+    start = time.perf_counter()
+    total_pages = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for job_idx, (pdf_path, output_path, spans, parts) in enumerate(jobs):
+            for span_idx, (span, part) in enumerate(zip(spans, parts)):
+                future = pool.submit(extract_span, str(pdf_path), str(part), span, span_idx == 0)
+                futures[future] = job_idx
+
+        remaining = {job_idx: len(job[2]) for job_idx, job in enumerate(jobs)}
+        pages_done = {job_idx: 0 for job_idx in remaining}
+        for future in as_completed(futures):
+            job_idx = futures[future]
+            pdf_path, output_path, spans, parts = jobs[job_idx]
+            try:
+                pages_done[job_idx] += future.result()
+            except Exception as e:
+                print(f"\tERROR: {pdf_path}: {e}")
+                remaining[job_idx] = None
+                continue
+            if remaining[job_idx] is None:
+                continue
+            remaining[job_idx] -= 1
+            if remaining[job_idx] == 0:
+                # Every span of this PDF is done, stitch them in page order
+                stitch(output_path, parts)
+                total_pages += pages_done[job_idx]
+                elapsed = time.perf_counter() - start
+                print(f"\tCONVERTED: {pdf_path} -> {output_path} ({pages_done[job_idx]} pages, "
+                      f"{total_pages / max(elapsed, 1e-9):.1f} pages/s overall)")
+
+    for job_idx, left in remaining.items():
+        if left is None:
+            for part in jobs[job_idx][3]:
+                if os.path.exists(part):
+                    os.remove(part)
+
+    elapsed = time.perf_counter() - start
+    print(f"Converted {sum(1 for left in remaining.values() if left == 0)}/{len(jobs)} PDFs, "
+          f"{total_pages} pages in {elapsed:.1f}s ({total_pages / max(elapsed, 1e-9):.1f} pages/s)")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract text from PDF')
-    parser.add_argument('input_pdf', help='Input PDF file')
-    parser.add_argument('output_txt', help='Output text file')
+    parser.add_argument('input_pdf', nargs='?', help='Input PDF file')
+    parser.add_argument('output_txt', nargs='?', help='Output text file')
     parser.add_argument('--pages', help='Page ranges to extract (e.g., 1-5,10,15-20)', default=None)
+    parser.add_argument('--batch', metavar='DIR_OR_GLOB', help='Convert every PDF in a directory or matching a glob')
+    parser.add_argument('--out-dir', help='Batch mode: where to write .txt files (default: next to each PDF)')
+    parser.add_argument('--workers', type=int, default=None, help='Batch mode: worker processes (default: all CPUs)')
+    parser.add_argument('--pages-per-task', type=int, default=PAGES_PER_TASK, help='Batch mode: pages per worker task')
+    parser.add_argument('--force', action='store_true', help='Batch mode: convert even if the output is up to date')
 
     args = parser.parse_args()
     page_ranges = parse_page_ranges(args.pages) if args.pages else None
 
-    extract_lines_from_pdf(args.input_pdf, args.output_txt, page_ranges)
+    if args.batch:
+        extract_batch(args.batch, args.out_dir, args.workers, page_ranges, args.force, args.pages_per_task)
+    elif args.input_pdf and args.output_txt:
+        extract_lines_from_pdf(args.input_pdf, args.output_txt, page_ranges)
+    else:
+        parser.error("give input_pdf and output_txt, or --batch")
@@ -0,0 +1,320 @@
+"""
+Daily stock prices from the dataset's price CSVs, as a columnar store with fast range queries
+
+Every company folder has files like dataset/tesla/TSLA-2022.csv:
+    Date,Close/Last,Volume,Open,High,Low
+    12/30/2022,$123.18 ,157777300,$119.95 ,$124.48 ,$119.75
+
+These are parsed once per ticker into a structured NumPy array sorted by date and saved to
+.cache/prices/<TICKER>.npy, which later runs memory-map instead of parsing the text again. The
+cache is rebuilt when a CSV is added, removed or modified. Date ranges are found with binary
+search (np.searchsorted), so lookups, returns and aggregates take microseconds.
+
+rag() uses price_context() to answer stock performance questions from these numbers rather
+than from price tables embedded as text.
+
+Usage:
+    from prices import get_price_store
+    tsla = get_price_store()["TSLA"]
+    tsla.close_on("2023-06-30")
+    tsla.summary("2022-01-01", "2022-12-31")
+
+    python scripts/prices.py TSLA --start 2022-01-01 --end 2022-12-31
+    python scripts/prices.py --question "How did Tesla stock perform in 2022?"
+"""
+import argparse
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from companies import find_tickers, find_years, normalize_ticker, ticker_for_file
+
+DATASET_PATH = Path("dataset")
+CACHE_PATH = Path(".cache/prices")
+TRADING_DAYS = 252
+
+PRICE_DTYPE = np.dtype([
+    ("date", "datetime64[D]"),
+    ("open", "f8"),
+    ("high", "f8"),
+    ("low", "f8"),
+    ("close", "f8"),
+    ("volume", "i8"),
+])
+
+# Price files are <TICKER>-<YEAR>.csv, filings and other CSVs (e.g. NASDAQ_FB_2023.csv) aren't
+_PRICE_FILE_RE = re.compile(r"^[A-Z]+-\d{4}\.csv$")
+# Questions about the stock rather than the business. "price" alone is about products as often as
+# shares, it needs one of _PERFORMANCE_RE with it:
+#   "How did Tesla stock perform in 2022?"                               stock
+#   "What was Apple's closing price at the end of 2023?"                 closing
+#   "How did the price of MSFT change over 2022, what was the return?"   price + return
+#   "What was the average selling price of an iPhone for Apple in 2022?" not a price question
+#   "How much stock-based compensation did Meta record in 2023?"         not a price question
+_PRICE_QUESTION_RE = re.compile(
+    r"\b(stocks?(?![-\w])|shares? prices?|stock prices?|ticker|closing|closed at|trading volume|traded"
+    r"|market value of (?:its|the) shares)\b",
+    re.I,
+)
+_PRICE_RE = re.compile(r"\bprices?\b", re.I)
+_PERFORMANCE_RE = re.compile(r"\b(perform(?:ed|ance)?|returns?|close[ds]?|volatil\w*|gain(?:ed|s)?|rallied|plunged)\b",
+                             re.I)
+
+
+def _parse_date(value: str):
+    return datetime.strptime(value.strip(), "%m/%d/%Y").date()
+
+
+def _parse_price(value: str) -> float:
+    return float(value.strip().lstrip("$").replace(",", ""))
+
+
+def read_price_csv(path: Path):
+    """Rows of one CSV as a PRICE_DTYPE array, in file order"""
+    rows = []
+    with path.open("r", encoding="utf-8") as f:
+        header = f.readline().strip().split(",")
+        if not header or header == [""]:
+            return np.empty(0, dtype=PRICE_DTYPE)
+        column = {name: i for i, name in enumerate(header)}
+        for line in f:
+            fields = line.rstrip("\n").split(",")
+            if len(fields) != len(header) or not fields[0].strip():
+                continue
+            rows.append((
+                _parse_date(fields[column["Date"]]),
+                _parse_price(fields[column["Open"]]),
+                _parse_price(fields[column["High"]]),
+                _parse_price(fields[column["Low"]]),
+                _parse_price(fields[column["Close/Last"]]),
+                int(fields[column["Volume"]]),
+            ))
+    return np.array(rows, dtype=PRICE_DTYPE)
+
+
+def price_files(folder: Path = DATASET_PATH):
+    """{ticker: [csv paths]} for every price file in the dataset"""
+    files = {}
+    for path in sorted(folder.rglob("*.csv")):
+        if _PRICE_FILE_RE.match(path.name) and path.stat().st_size > 0:
+            ticker = ticker_for_file(path.name)
+            if ticker:
+                files.setdefault(ticker, []).append(path)
+    return files
+
+
+def _as_day(value):
+    if value is None:
+        return None
+    return np.datetime64(value, "D")
+
+
+class PriceSeries:
+    """Daily prices of one ticker, columns are NumPy arrays sorted by date"""
+
+    def __init__(self, ticker: str, data):
+        self.ticker = ticker
+        self.data = data
+        self.dates = data["date"]
+        self.close = data["close"]
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def first_date(self):
+        return self.dates[0] if len(self) else None
+
+    @property
+    def last_date(self):
+        return self.dates[-1] if len(self) else None
+
+    def _bounds(self, start=None, end=None):
+        # Index range [lo, hi) of the trading days between start and end, both inclusive
+        lo = 0 if start is None else int(np.searchsorted(self.dates, _as_day(start), side="left"))
+        hi = len(self) if end is None else int(np.searchsorted(self.dates, _as_day(end), side="right"))
+        return lo, max(lo, hi)
+
+    def range(self, start=None, end=None):
+        """Rows between start and end (dates or "YYYY-MM-DD" strings, inclusive), a view"""
+        lo, hi = self._bounds(start, end)
+        return self.data[lo:hi]
+
+    def close_on(self, date):
+        """Close of the last trading day on or before date, None before the first one"""
+        i = int(np.searchsorted(self.dates, _as_day(date), side="right")) - 1
+        return float(self.close[i]) if i >= 0 else None
+
+    def total_return(self, start=None, end=None):
+        """Close to close return over the range, 0.1 is +10%"""
+        lo, hi = self._bounds(start, end)
+        if hi - lo < 2:
+            return None
+        return float(self.close[hi - 1] / self.close[lo] - 1)
+
+    def daily_returns(self, start=None, end=None):
+        lo, hi = self._bounds(start, end)
+        close = self.close[lo:hi]
+        return close[1:] / close[:-1] - 1
+
+    def summary(self, start=None, end=None):
+        """Aggregates over the range, None if it has no trading days"""
+        lo, hi = self._bounds(start, end)
+        if hi <= lo:
+            return None
+        rows = self.data[lo:hi]
+        high = int(np.argmax(rows["high"]))
+        low = int(np.argmin(rows["low"]))
+        returns = np.diff(np.log(rows["close"]))
+        return {
+            "ticker": self.ticker,
+            "start": str(rows["date"][0]),
+            "end": str(rows["date"][-1]),
+            "days": len(rows),
+            "first_close": float(rows["close"][0]),
+            "last_close": float(rows["close"][-1]),
+            "return": float(rows["close"][-1] / rows["close"][0] - 1),
+            "high": float(rows["high"][high]),
+            "high_date": str(rows["date"][high]),
+            "low": float(rows["low"][low]),
+            "low_date": str(rows["date"][low]),
+            "mean_close": float(rows["close"].mean()),
+            "mean_volume": float(rows["volume"].mean()),
+            "total_volume": int(rows["volume"].sum()),
+            "volatility": float(returns.std() * np.sqrt(TRADING_DAYS)) if len(returns) > 1 else None,
+        }
+
+
+class PriceStore:
+    """{ticker: PriceSeries}, built from the CSVs and cached as memory-mapped .npy files"""
+
+    def __init__(self, folder: Path = DATASET_PATH, cache_path: Path = CACHE_PATH):
+        self.folder = Path(folder)
+        self.cache_path = Path(cache_path)
+        self.series = {}
+        self.load()
+
+    def __getitem__(self, ticker: str) -> PriceSeries:
+        return self.series[ticker]
+
+    def __contains__(self, ticker: str):
+        return ticker in self.series
+
+    def tickers(self):
+        return sorted(self.series)
+
+    def load(self):
+        files = price_files(self.folder)
+        sources_path = self.cache_path / "sources.json"
+        sources = {}
+        if sources_path.exists():
+            with sources_path.open("r", encoding="utf-8") as f:
+                sources = json.load(f)
+
+        current = {ticker: [[p.as_posix(), p.stat().st_mtime_ns, p.stat().st_size] for p in paths]
+                   for ticker, paths in files.items()}
+        rebuilt = []
+        self.series = {}
+        for ticker, paths in files.items():
+            npy = self.cache_path / f"{ticker}.npy"
+            if sources.get(ticker) != current[ticker] or not npy.exists():
+                self._build(ticker, paths, npy)
+                rebuilt.append(ticker)
+            self.series[ticker] = PriceSeries(ticker, np.load(npy, mmap_mode="r"))
+
+        if rebuilt or set(sources) != set(current):
+            with sources_path.open("w", encoding="utf-8") as f:
+                json.dump(current, f)
+            print(f"Price store: rebuilt {', '.join(rebuilt) or 'nothing'} ({len(self.series)} tickers)")
+
+    def _build(self, ticker: str, paths, npy: Path):
+        data = np.concatenate([read_price_csv(p) for p in paths])
+        data = np.sort(data, order="date")
+        # Overlapping files repeat days, keep one row per date
+        keep = np.ones(len(data), dtype=bool)
+        keep[1:] = data["date"][1:] != data["date"][:-1]
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        np.save(npy, data[keep])
+
+
+_store = None
+
+
+def get_price_store():
+    """Process-wide PriceStore, built on first use"""
+    global _store
+    if _store is None:
+        _store = PriceStore()
+    return _store
+
+
+def is_price_question(question: str) -> bool:
+    if _PRICE_QUESTION_RE.search(question):
+        return True
+    return bool(_PRICE_RE.search(question) and _PERFORMANCE_RE.search(question))
+
+
+def format_summary(s) -> str:
+    text = (f"{s["ticker"]} daily prices {s["start"]} to {s["end"]} ({s["days"]} trading days): "
+            f"close ${s["first_close"]:.2f} -> ${s["last_close"]:.2f} ({s["return"]:+.1%}), "
+            f"high ${s["high"]:.2f} on {s["high_date"]}, low ${s["low"]:.2f} on {s["low_date"]}, "
+            f"average close ${s["mean_close"]:.2f}, average daily volume {s["mean_volume"]:,.0f}")
+    if s["volatility"] is not None:
+        text += f", annualized volatility {s["volatility"]:.1%}"
+    return text
+
+
+def price_context(question: str, filters=None, store=None):
+    """
+    Text block of price facts for a stock performance question, None for other questions.
+    Tickers and years come from filters (see retrieval.resolve_filters) or the question itself,
+    without years the whole price history of the ticker is summarized.
+    """
+    if not is_price_question(question):
+        return None
+    filters = filters or {}
+    tickers = filters.get("ticker") or find_tickers(question)
+    if not tickers:
+        return None
+    years = filters.get("year") or find_years(question)
+    store = store or get_price_store()
+
+    lines = []
+    for ticker in tickers:
+        if ticker not in store:
+            continue
+        series = store[ticker]
+        periods = [(f"{y}-01-01", f"{y}-12-31") for y in sorted(years)] or [(None, None)]
+        for start, end in periods:
+            summary = series.summary(start, end)
+            if summary is not None:
+                lines.append(format_summary(summary))
+    return "\n".join(lines) or None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the daily price store")
+    parser.add_argument("ticker", nargs="?", help="e.g. TSLA")
+    parser.add_argument("--start", help="YYYY-MM-DD, inclusive")
+    parser.add_argument("--end", help="YYYY-MM-DD, inclusive")
+    parser.add_argument("--question", help="Print the price context rag() would add for this question")
+    args = parser.parse_args()
+
+    store = get_price_store()
+    if args.question:
+        print(price_context(args.question, store=store) or "Not a price question, or no prices for it")
+    elif args.ticker:
+        # Same spelling rules as questions, e.g. FB -> META
+        ticker = normalize_ticker(args.ticker)
+        if ticker not in store:
+            print(f"No prices for {ticker}, have {', '.join(store.tickers())}")
+        else:
+            summary = store[ticker].summary(args.start, args.end)
+            print(format_summary(summary) if summary else "No trading days in that range")
+    else:
+        for ticker in store.tickers():
+            series = store[ticker]
+            print(f"{ticker}: {len(series)} days, {series.first_date} to {series.last_date}")
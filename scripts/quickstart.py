@@ -13,32 +13,15 @@ Install Ollama and run the gpt-oss:20b (lower parameter model)
     ollama run gpt-oss:20b
 """
 
-from dotenv import load_dotenv
-import os
-from qdrant_client import QdrantClient, models
-from ollama import chat
-from ollama import ChatResponse
+from qdrant_client import models
 
-# Load environment variables from .env file
-load_dotenv()
+from config import QDRANT_URL, collection_name, model_name, qdrant_client
+from embeddings import embed_query, embed_texts
+from runtime import ollama_client
 
-# Read Qdrant credentials
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-
-# Initialize the Qdrant client
-# Skip API key if running locally
-if "localhost" in QDRANT_URL or "127.0.0.1" in QDRANT_URL:
-    print(QDRANT_URL) 
-    client = QdrantClient(url=QDRANT_URL)
-else:
-    client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-
-# Name of collection on Qdrant
-collection_name = "knowledge_base"
-
-# Embedding model being used
-model_name = "BAAI/bge-small-en-v1.5"
+# Initialize the Qdrant client (settings in .env, see config.py)
+print(QDRANT_URL)
+client = qdrant_client()
 
 # Check if collection exists
 collections = [col.name for col in client.get_collections().collections]
@@ -69,17 +52,17 @@ client.upsert(
     points=[
         models.PointStruct(
             id=idx,
-            vector=models.Document(text=document, model=model_name),
+            vector=vector.tolist(),
             payload={"document": document},
         )
-        for idx, document in enumerate(documents)
+        for idx, (document, vector) in enumerate(zip(documents, embed_texts(documents, model_name)))
     ],
 )
 
 def rag(question: str, n_points: int = 3) -> str:
     results = client.query_points(
         collection_name=collection_name,
-        query=models.Document(text=question, model=model_name),
+        query=embed_query(question, model_name),
         limit=n_points,
     )
 
@@ -93,7 +76,8 @@ def rag(question: str, n_points: int = 3) -> str:
     {context.strip()}
     """
 
-    response: ChatResponse = chat(model='gpt-oss:20b', stream= True,
+    # ollama is imported here, on the first question
+    response = ollama_client().chat(model='gpt-oss:20b', stream= True,
         messages=[
             {
                 'role': 'system',
@@ -1,44 +1,56 @@
 """
 Generates response based on queries
+
+Retrieved points and answers are cached (see rag_cache.py), so asking the same question, or a
+close paraphrase, again returns without re-embedding, searching or generating. --no-cache
+turns that off.
+
+The retrieved chunks are deduplicated, merged and fitted into a token budget before they go
+into the prompt (see context.py), which keeps prompt processing in the LLM short.
+
+Questions about stock performance also get a block of figures computed from the daily price
+CSVs (see prices.py), so the answer doesn't depend on price tables appearing in the filings.
+--no-prices turns that off.
+
+stream_rag() is the same pipeline as a generator of sources, tokens and a final "done" event with
+time to first token and tokens/s. It can stop generation at a deadline (--timeout) or after
+max_tokens (--max-tokens); rag() prints what it yields.
+
+--parents retrieves through the small child chunks of embed.py --children and puts their
+parent chunks in the prompt, see retrieval.py.
 """
-from dotenv import load_dotenv
-import os
-from qdrant_client import QdrantClient, models
-from ollama import chat
-from ollama import ChatResponse
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Read Qdrant credentials
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-
-# Name of collection on Qdrant
-collection_name = "knowledge_base"
-
-# Embedding model being used
-model_name = "BAAI/bge-small-en-v1.5"
-
-# Initialize the Qdrant client
-# Skip API key if running locally
-if "localhost" in QDRANT_URL or "127.0.0.1" in QDRANT_URL:
-    print(QDRANT_URL)
-    client = QdrantClient(url=QDRANT_URL)
-else:
-    client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-
-def rag(question: str, n_points: int = 10):
-    results = client.query_points(
-        collection_name=collection_name,
-        query=models.Document(text=question, model=model_name),
-        limit=n_points,
-    )
-
-    context = "\n".join(f"Relevant Document {i}, {r.payload["document"]}: {r.payload["content"]}" for i, r in enumerate(results.points))
-    docs = "\n".join(f"Relevant Document {i}, {r.payload["document"]}, chunk index {r.payload["part_index"]}" for i, r in enumerate(results.points))
-    print(docs)
+import argparse
+import time
+
+from config import model_name
+from context import DEFAULT_TOKEN_BUDGET, assemble_context
+from embeddings import embed_query, get_cache
+from prices import price_context
+from rag_cache import get_rag_cache, scope_for
+from retrieval import MODES, load_content, resolve_filters, retrieve
+from runtime import lazy_import, ollama_client
+from tracing import SECONDS_BUCKETS, count, observe, span, traced
+
+# LLM that writes the answer
+llm_name = 'gpt-oss:20b'
+
+# Imported with the Ollama client, when the first answer is generated
+httpx = lazy_import("httpx")
+
+def build_context(question: str, points, budget: int = DEFAULT_TOKEN_BUDGET, trim: bool = False):
+    """(context, stats), see context.assemble_context"""
+    return assemble_context(question, points, budget, trim=trim)
+
+
+def add_prices(question: str, context: str, filters=None):
+    """(context, price facts), facts from prices.py go first for stock performance questions"""
+    facts = price_context(question, filters)
+    if not facts:
+        return context, None
+    return f"Stock prices, computed from daily price data:\n{facts}\n{context}", facts
 
+
+def build_messages(question: str, context: str):
     metaprompt = f"""
     Answer the following question using the provided context.
     If you can't find the answer, do not pretend you know it, but only answer "I don't know".
@@ -46,29 +58,197 @@ def rag(question: str, n_points: int = 10):
     Context:
     {context.strip()}
     """
+    return [
+        {
+            'role': 'system',
+            'content': metaprompt
+        },
+        {
+            'role': 'user',
+            'content': question.strip()
+        },
+    ]
+
+
+def stream_rag(question: str, n_points: int = 10, mode: str = "dense", filters=None, auto_filter: bool = True,
+               cache: bool = True, budget: int = DEFAULT_TOKEN_BUDGET, trim: bool = False, rerank: bool = False,
+               prices: bool = True, parents: bool = False, timeout: float = None, max_tokens: int = None):
+    """
+    Answers question as a generator of (event, data) pairs, in this order:
+        ("sources", [{"document", "part_index", "score"}])      the retrieved chunks
+        ("context", {"prices": facts or None, **context stats})  what went into the prompt
+        ("token", text)                                          many, as the LLM writes them
+        ("done", {"answer", "cached", "stopped", "timings"})
+    A cached answer only comes with "done". stopped is None, "timeout" when the answer wasn't
+    finished timeout seconds after the call, or "max_tokens". Stopping early, or closing the
+    generator, closes the Ollama stream, which ends generation on the server too. Answers that
+    were cut short aren't cached.
+    """
+    start = time.perf_counter()
+    deadline = None if timeout is None else start + timeout
+    timings = {}
+    store = get_rag_cache() if cache else None
+    resolved = resolve_filters(question, filters, auto_filter)
+
+    entry = None
+    cached_question = question
+    if store is not None:
+        scope = scope_for(mode=mode, n_points=n_points, model=model_name, rerank=rerank,
+                          filters=resolved, parents=parents)
+        with span("cache_points") as s:
+            entry, vector = store.get_points(question, scope, lambda: embed_query(question, model_name))
+            s.set(hit=entry is not None)
+    if entry is not None:
+        points = entry["points"]
+        # A paraphrase shares the cached answer of the question it matched
+        cached_question = entry["question"]
+    else:
+        points = retrieve(question, n_points, mode, filters=filters, auto_filter=auto_filter, rerank=rerank, lazy=True,
+                          parents=parents)
+        if store is not None:
+            store.put_points(question, scope, vector, points)
+    timings["retrieve_ms"] = (time.perf_counter() - start) * 1000
+    yield "sources", [
+        {"document": p.payload["document"], "part_index": p.payload["part_index"], "score": p.score} for p in points
+    ]
 
-    response: ChatResponse = chat(model='gpt-oss:20b', stream= True,
-        messages=[
-            {
-                'role': 'system',
-                'content': metaprompt
-            },
-            {
-                'role': 'user',
-                'content': question.strip()
-            },
-        ])
+    # Text of the chunks comes from the local chunk store, not the search response
+    load_content(points)
+    with span("context", budget=budget, trim=trim) as s:
+        context, stats = build_context(question, points, budget, trim)
+        s.set(**stats)
+    facts = None
+    if prices:
+        with span("prices") as s:
+            context, facts = add_prices(question, context, resolved)
+            s.set(found=facts is not None)
+    observe("prompt_tokens", stats["tokens_out"])
+    yield "context", {"prices": facts, **stats}
 
-    print(f"User: {question.strip()}")
+    if store is not None:
+        with span("cache_answer") as s:
+            answer = store.get_answer(cached_question, context, llm_name)
+            s.set(hit=answer is not None)
+        if answer is not None:
+            timings["total_ms"] = (time.perf_counter() - start) * 1000
+            yield "done", {"answer": answer, "cached": True, "stopped": None, "timings": timings}
+            return
 
+    pieces = []
+    stopped = None
+    response = None
+    options = {"num_predict": max_tokens} if max_tokens else None
+    with span("llm", model=llm_name) as s:
+        llm_start = time.perf_counter()
+        try:
+            # Reads that wait past the deadline raise instead of blocking
+            client = ollama_client(max(deadline - time.perf_counter(), 0.001) if deadline is not None else None)
+            response = client.chat(model=llm_name, stream=True, messages=build_messages(question, context), options=options)
+            for chunk in response:
+                # Checked before skipping empty chunks, a thinking model streams nothing but those for a while
+                if deadline is not None and time.perf_counter() >= deadline:
+                    stopped = "timeout"
+                    break
+                if not chunk.message.content:
+                    # The closing chunk, or the model thinking
+                    continue
+                if not pieces:
+                    first_token = time.perf_counter()
+                    timings["ttft_ms"] = (first_token - start) * 1000
+                    s.set(ttft_ms=(first_token - llm_start) * 1000)
+                pieces.append(chunk.message.content)
+                yield "token", chunk.message.content
+                if max_tokens and len(pieces) >= max_tokens:
+                    stopped = "max_tokens"
+                    break
+        except httpx.TimeoutException:
+            stopped = "timeout"
+        except GeneratorExit:
+            # The caller stopped reading
+            stopped = "closed"
+            raise
+        finally:
+            if response is not None:
+                # Drops the HTTP stream, Ollama stops generating
+                response.close()
+            s.set(tokens=len(pieces), stopped=stopped)
+
+        if pieces:
+            # Stream chunks are roughly one token each
+            timings["tokens"] = len(pieces)
+            timings["tokens_per_sec"] = len(pieces) / max(time.perf_counter() - first_token, 1e-9)
+            if s.enabled:
+                s.set(tokens_per_sec=timings["tokens_per_sec"])
+                observe("ttft_seconds", s.attrs["ttft_ms"] / 1000, buckets=SECONDS_BUCKETS)
+                observe("tokens_per_sec", timings["tokens_per_sec"])
+    if stopped:
+        count("answers_stopped", reason=stopped)
+
+    answer = "".join(pieces)
+    timings["total_ms"] = (time.perf_counter() - start) * 1000
+    if store is not None and answer.strip() and stopped is None:
+        store.put_answer(cached_question, context, llm_name, answer)
+    yield "done", {"answer": answer, "cached": False, "stopped": stopped, "timings": timings}
+
+
+@traced("rag")
+def rag(question: str, n_points: int = 10, mode: str = "dense", filters=None, auto_filter: bool = True,
+        cache: bool = True, budget: int = DEFAULT_TOKEN_BUDGET, trim: bool = False, rerank: bool = False,
+        prices: bool = True, parents: bool = False, timeout: float = None, max_tokens: int = None):
+    """Prints the sources and streams the answer of stream_rag() to stdout, returns the answer"""
+    events = stream_rag(question, n_points, mode, filters, auto_filter, cache, budget, trim, rerank, prices, parents,
+                        timeout, max_tokens)
+    answer = None
     try:
-        # Receive the chunks from the streaming reponse, print as they arrive
-        for chunk in response:
-            print(chunk.message.content, end='', flush=True)
+        for event, data in events:
+            if event == "sources":
+                print("\n".join(f"Relevant Document {i}, {p["document"]}, chunk index {p["part_index"]}"
+                                for i, p in enumerate(data)))
+            elif event == "context":
+                if data["prices"]:
+                    print(data["prices"])
+                print(f"Context: {data["chunks_in"]} chunks -> {data["passages_used"]}/{data["passages"]} passages, "
+                      f"~{data["tokens_in"]} -> ~{data["tokens_out"]} tokens")
+                print(f"User: {question.strip()}")
+            elif event == "token":
+                print(data, end='', flush=True)
+            else:
+                answer = data["answer"]
+                timings = data["timings"]
+                if data["cached"]:
+                    print(answer)
+                    print(f"(cached answer, {timings["total_ms"]:.0f} ms)")
+                elif "ttft_ms" in timings:
+                    stopped = f", stopped: {data["stopped"]}" if data["stopped"] else ""
+                    print(f"\n(first token after {timings["ttft_ms"]:.0f} ms, {timings["tokens_per_sec"]:.1f} tokens/s, "
+                          f"total {timings["total_ms"]:.0f} ms{stopped})")
     except KeyboardInterrupt:
+        events.close()
         print("(QUIT)")
         return None
+    return answer
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a question with retrieved context")
+    parser.add_argument("question", nargs="?", default="How does Tesla evaluate its energy segment growth and what strategies are they working on to increase its profitability?")
+    parser.add_argument("--n-points", type=int, default=10)
+    parser.add_argument("--mode", choices=MODES, default="dense", help="Retrieval mode, see retrieval.py")
+    parser.add_argument("--ticker", action="append", help="Only search these companies, can be repeated")
+    parser.add_argument("--year", action="append", help="Only search these filing years, can be repeated")
+    parser.add_argument("--no-auto-filter", dest="auto_filter", action="store_false", help="Don't infer filters from the question")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Always retrieve and generate from scratch")
+    parser.add_argument("--budget", type=int, default=DEFAULT_TOKEN_BUDGET, help="Context tokens, 0 for no limit")
+    parser.add_argument("--trim", action="store_true", help="Keep only the sentences of each chunk closest to the question")
+    parser.add_argument("--rerank", action="store_true", help="Rerank over-fetched candidates with a cross-encoder")
+    parser.add_argument("--no-prices", dest="prices", action="store_false", help="Don't add price data for stock questions")
+    parser.add_argument("--parents", action="store_true", help="Match child chunks, answer from their parents")
+    parser.add_argument("--timeout", type=float, help="Stop the answer this many seconds after asking")
+    parser.add_argument("--max-tokens", type=int, help="Stop the answer after this many tokens")
+    args = parser.parse_args()
+    # A batch run: the query vectors go into the embedding cache for the next one
+    get_cache(model_name, writable=True)
 
-# Example use
-rag("How does Tesla evaluate its energy segment growth and what strategies are they working on to increase its profitability?")
+    # Example use
+    rag(args.question, args.n_points, args.mode, {"ticker": args.ticker, "year": args.year}, args.auto_filter, args.cache,
+        args.budget or None, args.trim, args.rerank, args.prices, args.parents, args.timeout, args.max_tokens)
@@ -0,0 +1,227 @@
+"""
+Two-level cache for rag()
+
+    queries   normalized question + retrieval settings -> query embedding and retrieved points
+    answers   question + hash of the retrieved context + LLM -> final answer
+
+A question that isn't cached word for word can still hit an earlier one whose embedding has
+a cosine similarity of at least SIMILARITY_THRESHOLD, so paraphrases skip both retrieval and
+generation. Only questions with the same retrieval settings (mode, n_points, filters) are
+compared, which keeps "Tesla revenue 2022" and "Tesla revenue 2023" apart.
+
+Cached points never carry the chunk text: put_points stores them without payload["content"] and
+get_points hands out copies, so load_content() can fill them in without growing the cache.
+
+Entries expire after ttl seconds and the least recently used ones are dropped past max_entries.
+Everything is thrown away when the index manifest written by embed.py changes, i.e. after
+any re-index that added, changed or removed chunks.
+
+The cache lives in memory and is pickled to .cache/rag/cache.pkl at exit.
+
+Usage:
+    from rag_cache import get_rag_cache
+    cache = get_rag_cache()
+    entry, vector = cache.get_points(question, scope, lambda: embed_query(question))
+"""
+import atexit
+import hashlib
+import json
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = Path(".cache/rag/cache.pkl")
+MANIFEST_PATH = Path(".index_manifest.json")   # written by embed.py
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 24 * 3600           # seconds
+SIMILARITY_THRESHOLD = 0.95       # cosine similarity for a paraphrase to count as a hit
+
+
+def normalize_question(question: str):
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _lean(points):
+    # Copies with their own payload dicts, minus the chunk text
+    return [p.model_copy(update={"payload": {k: v for k, v in p.payload.items() if k != "content"}}) for p in points]
+
+
+class RagCache:
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl: float = DEFAULT_TTL, threshold: float = SIMILARITY_THRESHOLD, manifest: Path = MANIFEST_PATH):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.manifest = Path(manifest)
+        self.hits = {"exact": 0, "semantic": 0, "answer": 0}
+        self.misses = {"points": 0, "answer": 0}
+        self._lock = threading.Lock()
+        self._manifest_stat = None
+        self._manifest_digest = None
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        self.version = None
+        self._queries = OrderedDict()     # key -> {"question", "scope", "vector", "points", "created"}
+        self._answers = OrderedDict()     # key -> {"answer", "created"}
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open("rb") as f:
+                state = pickle.load(f)
+            self.version, self._queries, self._answers = state["version"], state["queries"], state["answers"]
+        except Exception as e:
+            print(f"Ignoring unreadable rag cache {self.path}: {e}")
+
+    def _index_version(self):
+        # Hash the manifest contents, but only re-read it when the file changed
+        try:
+            stat = self.manifest.stat()
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self._manifest_stat:
+            self._manifest_digest = hashlib.sha256(self.manifest.read_bytes()).hexdigest()
+            self._manifest_stat = stamp
+        return self._manifest_digest
+
+    def _check_version(self):
+        version = self._index_version()
+        if version != self.version:
+            self._queries.clear()
+            self._answers.clear()
+            self.version = version
+            self._dirty = True
+
+    def _fresh(self, entries, key, now):
+        entry = entries.get(key)
+        if entry is not None and now - entry["created"] > self.ttl:
+            del entries[key]
+            self._dirty = True
+            return None
+        return entry
+
+    def _touch(self, entries, key):
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def get_points(self, question: str, scope: str, embed):
+        """
+        Looks up the retrieved points for question, scope is any string describing the retrieval settings.
+        embed() -> query vector is only called if there is no exact match.
+        Returns (entry or None, query vector or None), entry["question"] is the question it was cached under
+        and entry["points"] are copies without "content".
+        """
+        normalized = normalize_question(question)
+        key = _digest(scope, normalized)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            entry = self._fresh(self._queries, key, now)
+            if entry is not None:
+                self._touch(self._queries, key)
+                self.hits["exact"] += 1
+                return {**entry, "points": _lean(entry["points"])}, None
+
+        vector = np.asarray(embed(), dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            candidates = [
+                (k, e) for k, e in self._queries.items()
+                if e["scope"] == scope and now - e["created"] <= self.ttl
+            ]
+            if candidates:
+                similarity = np.stack([e["vector"] for _, e in candidates]) @ vector
+                best = int(np.argmax(similarity))
+                if similarity[best] >= self.threshold:
+                    k, entry = candidates[best]
+                    self._touch(self._queries, k)
+                    self.hits["semantic"] += 1
+                    return {**entry, "points": _lean(entry["points"])}, vector
+            self.misses["points"] += 1
+        return None, vector
+
+    def put_points(self, question: str, scope: str, vector, points):
+        normalized = normalize_question(question)
+        key = _digest(scope, normalized)
+        with self._lock:
+            self._check_version()
+            self._queries[key] = {"question": normalized, "scope": scope, "vector": vector,
+                                  "points": _lean(points), "created": time.time()}
+            self._touch(self._queries, key)
+            self._dirty = True
+
+    def get_answer(self, question: str, context: str, llm: str):
+        key = _digest(llm, normalize_question(question), hashlib.sha256(context.encode("utf-8")).hexdigest())
+        with self._lock:
+            self._check_version()
+            entry = self._fresh(self._answers, key, time.time())
+            if entry is None:
+                self.misses["answer"] += 1
+                return None
+            self._touch(self._answers, key)
+            self.hits["answer"] += 1
+            return entry["answer"]
+
+    def put_answer(self, question: str, context: str, llm: str, answer: str):
+        key = _digest(llm, normalize_question(question), hashlib.sha256(context.encode("utf-8")).hexdigest())
+        with self._lock:
+            self._check_version()
+            self._answers[key] = {"answer": answer, "created": time.time()}
+            self._touch(self._answers, key)
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+            self._answers.clear()
+            self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with tmp.open("wb") as f:
+                pickle.dump({"version": self.version, "queries": self._queries, "answers": self._answers}, f)
+            tmp.replace(self.path)
+            self._dirty = False
+
+    def __len__(self):
+        return len(self._queries)
+
+
+def scope_for(**settings) -> str:
+    """Stable string for the retrieval settings a cached entry depends on"""
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_rag_cache(path: Path = DEFAULT_CACHE_PATH):
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RagCache(path)
+        return _cache
+
+
+@atexit.register
+def _flush_cache():
+    if _cache is not None:
+        _cache.flush()
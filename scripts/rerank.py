@@ -0,0 +1,78 @@
+"""
+Cross-encoder reranking of retrieved points
+
+retrieve(..., rerank=True) over-fetches RERANK_CANDIDATES points and rescores them here with a
+small CPU cross-encoder (fastembed's TextCrossEncoder), which reads question and chunk together
+and ranks much better than the bi-encoder alone, so fewer chunks need to go into the prompt.
+
+Candidates are scored in batches on a thread pool. If scoring takes longer than the latency
+budget the retrieval order is kept, so a slow machine degrades to plain retrieval rather than
+a slow answer.
+
+Usage:
+    from rerank import rerank
+    top = rerank(question, points, top_k=5)
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from runtime import MODEL_CACHE_DIR
+from tracing import span
+
+# Cross-encoder being used, ~80 MB and fast on CPU
+rerank_model_name = "Xenova/ms-marco-MiniLM-L-6-v2"
+
+RERANK_CANDIDATES = 50    # points fetched for the reranker to choose from
+RERANK_BATCH = 16         # candidates scored per task
+RERANK_WORKERS = 2        # scoring tasks running at once
+RERANK_BUDGET_MS = 1000   # past this, fall back to retrieval order
+
+_models = {}
+_models_lock = threading.Lock()
+_pool = ThreadPoolExecutor(max_workers=RERANK_WORKERS, thread_name_prefix="rerank")
+
+
+def get_reranker(name: str = rerank_model_name, threads: int = None):
+    with _models_lock:
+        if name not in _models:
+            from fastembed.rerank.cross_encoder import TextCrossEncoder
+            _models[name] = TextCrossEncoder(model_name=name, threads=threads, cache_dir=str(MODEL_CACHE_DIR))
+        return _models[name]
+
+
+def _score(question: str, texts, name: str):
+    return list(get_reranker(name).rerank(question, texts, batch_size=len(texts)))
+
+
+def rerank(question: str, points, top_k: int, name: str = rerank_model_name, batch_size: int = RERANK_BATCH,
+           budget_ms: float = RERANK_BUDGET_MS, timings=None):
+    """
+    Returns the top_k points by cross-encoder score, with score set to it.
+    If scoring doesn't finish within budget_ms, returns the first top_k points unchanged.
+    """
+    points = list(points)
+    if len(points) <= 1:
+        return points[:top_k]
+    # Loading the model isn't part of the budget
+    get_reranker(name)
+
+    start = time.perf_counter()
+    with span("rerank", candidates=len(points), top_k=top_k) as s:
+        batches = [points[i:i + batch_size] for i in range(0, len(points), batch_size)]
+        futures = [_pool.submit(_score, question, [p.payload["content"] for p in batch], name) for batch in batches]
+        done, not_done = wait(futures, timeout=None if budget_ms is None else budget_ms / 1000)
+        s.set(fallback=bool(not_done))
+    elapsed = (time.perf_counter() - start) * 1000
+    if timings is not None:
+        timings["rerank_ms"] = elapsed
+
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        print(f"Reranking took over {budget_ms:.0f} ms, keeping retrieval order")
+        return points[:top_k]
+
+    scores = [score for future in futures for score in future.result()]
+    ranked = sorted(zip(points, scores), key=lambda item: item[1], reverse=True)[:top_k]
+    return [p.model_copy(update={"score": float(score)}) for p, score in ranked]
@@ -1,40 +1,428 @@
 """
 Retrevial script of relevant docs
+
+Modes:
+    dense     bge-small vectors in Qdrant (default)
+    sparse    local BM25 index built by embed.py, good at exact tickers, years and line-item names
+    hybrid    both legs run concurrently and are merged with reciprocal rank fusion
+
+Filters restrict the search to some companies / years / filings, e.g.
+    {"ticker": ["TSLA"], "year": ["2023"], "document": ["NASDAQ_TSLA_2023.txt"]}
+Company names, tickers and years mentioned in the question are turned into filters
+automatically (explicit filters win), and if that filter leaves no hits the search is
+repeated without it.
+
+With rerank=True (--rerank) RERANK_CANDIDATES points are fetched and the best n_points by a
+cross-encoder are returned, see rerank.py.
+
+With parents=True (--parents) the dense leg searches the small child chunks indexed by
+embed.py --children instead and returns their parent chunks, each once and scored by its best
+child, fetched in one request. Matching is as precise as the children, the context is as
+complete as the parents.
+
+With lazy=True (--lazy) searches return only IDs, scores and the small payload fields, the
+chunk text stays out of the responses. load_content() fills it in afterwards from the local
+chunk store (see chunk_store.py), asking Qdrant only for chunks the store doesn't have.
+
+The vectors live in Qdrant or, with VECTOR_BACKEND=local, in an in-process NumPy index, see
+vector_store.py.
+
+Dense searches use the query-time HNSW and quantization settings in SEARCH_PARAMS, read from
+the environment (HNSW_EF, QUANTIZATION_RESCORE=0/1, QUANTIZATION_OVERSAMPLING) or set with
+--hnsw-ef / --no-rescore / --oversampling / --exact. See compare_storage.py for choosing them.
+
+Usage:
+    python scripts/retrieval.py
+    python scripts/retrieval.py "energy generation and storage segment revenue 2023" --mode hybrid
+    python scripts/retrieval.py "What are the main risk factors?" --ticker MSFT --year 2022
+    python scripts/retrieval.py --questions questions.txt --mode hybrid --output results.jsonl
+
+--questions takes a text file with one question per line, or a .jsonl file of {"question": ...}
+records. All questions are embedded in one call and searched with batched Qdrant queries;
+every output line is {"question": ..., "results": [{"id", "score", "document", "part_index"}, ...]}
 """
-from dotenv import load_dotenv
+import argparse
+import contextvars
+import json
 import os
-from qdrant_client import QdrantClient, models
-from ollama import chat
-from ollama import ChatResponse
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Read Qdrant credentials
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-
-# Name of collection on Qdrant
-collection_name = "knowledge_base"
-
-# Embedding model being used
-model_name = "BAAI/bge-small-en-v1.5"
-
-# Initialize the Qdrant client
-# Skip API key if running locally
-if "localhost" in QDRANT_URL or "127.0.0.1" in QDRANT_URL:
-    print(QDRANT_URL)
-    client = QdrantClient(url=QDRANT_URL)
-else:
-    client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-
-question = "How does Tesla evaluate its energy segment growth and what strategies are they working on to increase its profitability?"
-n_points = 10
-
-results = client.query_points(
-        collection_name=collection_name,
-        query=models.Document(text=question, model=model_name),
-        limit=n_points,
-    )
-docs = "\n".join(f"Relevant Document {i}, {r.payload["document"]}, chunk index {r.payload["part_index"]}" for i, r in enumerate(results.points))
-print(docs)
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from qdrant_client import models
+
+from bm25 import load_index
+from chunk_store import fill_content
+from companies import find_tickers, find_years, normalize_ticker
+from config import children_collection, collection_name, model_name
+from embeddings import embed_queries, embed_query, get_cache
+from rerank import RERANK_CANDIDATES, rerank as rerank_points
+from tracing import payload_bytes, span
+from vector_store import get_store
+
+# Qdrant collection or local index, picked by VECTOR_BACKEND (see vector_store.py)
+store = get_store(name=collection_name)
+# Child chunks of the hierarchical index (embed.py --children), searched with parents=True
+children_store = get_store(name=children_collection)
+
+MODES = ("dense", "sparse", "hybrid")
+RRF_K = 60                # rank offset in reciprocal rank fusion
+HYBRID_CANDIDATES = 3     # each leg fetches n_points * this many candidates
+QUERY_BATCH = 64          # searches sent per query_batch_points request
+CHILD_CANDIDATES = 4      # child hits fetched per parent wanted, several children often share a parent
+
+# Payload of lazy searches: everything but the chunk text
+LIGHT_PAYLOAD = models.PayloadSelectorExclude(exclude=["content"])
+# Child hits only need the link to their parent
+CHILD_PAYLOAD = ["parent_id"]
+
+
+def search_params(hnsw_ef: int = None, exact: bool = False, rescore: bool = None, oversampling: float = None):
+    """
+    models.SearchParams for dense queries, None for Qdrant's defaults.
+    hnsw_ef is the candidate list size (higher: better recall, slower), exact=True skips the index.
+    On a quantized collection rescore re-ranks with the original vectors and oversampling fetches
+    that many times more candidates for it.
+    """
+    quantization = None
+    if rescore is not None or oversampling is not None:
+        quantization = models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling)
+    if hnsw_ef is None and not exact and quantization is None:
+        return None
+    return models.SearchParams(hnsw_ef=hnsw_ef, exact=exact, quantization=quantization)
+
+
+def _env_number(name: str, kind):
+    value = os.getenv(name)
+    return kind(value) if value else None
+
+
+SEARCH_PARAMS = search_params(
+    hnsw_ef=_env_number("HNSW_EF", int),
+    rescore=None if os.getenv("QUANTIZATION_RESCORE") is None else os.getenv("QUANTIZATION_RESCORE") != "0",
+    oversampling=_env_number("QUANTIZATION_OVERSAMPLING", float),
+)
+
+
+def set_search_params(**options):
+    """Replaces SEARCH_PARAMS, options as for search_params()"""
+    global SEARCH_PARAMS
+    SEARCH_PARAMS = search_params(**options)
+
+
+_legs = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+
+
+def _timed(timings, name, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    if timings is not None:
+        timings[name] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def question_filters(question: str):
+    """Filters implied by the question, e.g. "Tesla in 2023" -> {"ticker": ["TSLA"], "year": ["2023"]}"""
+    filters = {"ticker": find_tickers(question), "year": find_years(question)}
+    return {key: values for key, values in filters.items() if values}
+
+
+def resolve_filters(question: str, filters=None, auto_filter: bool = True):
+    resolved = question_filters(question) if auto_filter else {}
+    for key, values in (filters or {}).items():
+        if values:
+            resolved[key] = [normalize_ticker(v) for v in values] if key == "ticker" else [str(v) for v in values]
+    return resolved
+
+
+def dense_search(question: str, n_points: int, filters=None, with_payload=True):
+    with span("embed_query"):
+        vector = embed_query(question, model_name)
+    with span("qdrant_query", limit=n_points, filtered=bool(filters)) as s:
+        points = store.search(vector, n_points, filters, with_payload, SEARCH_PARAMS)
+        if s.enabled:
+            s.set(points=len(points), payload_bytes=payload_bytes(points))
+    return points
+
+
+def sparse_search(question: str, n_points: int, filters=None):
+    """[(point_id, bm25 score)]"""
+    with span("bm25_search", limit=n_points, filtered=bool(filters)) as s:
+        hits = load_index().search(question, n_points, filters)
+        s.set(hits=len(hits))
+    return hits
+
+
+def fetch_points(ids, with_payload=True):
+    # One request for every point, returned in the order of ids
+    with span("qdrant_retrieve", ids=len(ids)) as s:
+        records = {str(r.id): r for r in store.retrieve(ids, with_payload)}
+        if s.enabled:
+            s.set(payload_bytes=payload_bytes(records.values()))
+    return [records[pid] for pid in ids if pid in records]
+
+
+def parent_points(children_lists, n_points: int, with_payload=True):
+    """
+    For every list of child hits (best first), up to n_points ScoredPoints of their parents,
+    each parent once with the score of its best child. All parents are fetched in one request.
+    """
+    ranked = []
+    for children in children_lists:
+        scores = {}
+        for child in children:
+            scores.setdefault(child.payload["parent_id"], child.score)
+        ranked.append(list(scores.items())[:n_points])
+    ids = list(dict.fromkeys(pid for hits in ranked for pid, _ in hits))
+    records = {str(r.id): r for r in fetch_points(ids, with_payload)} if ids else {}
+    return [_as_scored([records[pid] for pid, _ in hits if pid in records], dict(hits)) for hits in ranked]
+
+
+def child_search(question: str, n_points: int, filters=None, with_payload=True):
+    """dense_search over the child chunks, returns up to n_points of their parents"""
+    with span("embed_query"):
+        vector = embed_query(question, model_name)
+    with span("child_query", limit=n_points * CHILD_CANDIDATES, filtered=bool(filters)) as s:
+        children = children_store.search(vector, n_points * CHILD_CANDIDATES, filters, CHILD_PAYLOAD, SEARCH_PARAMS)
+        s.set(children=len(children))
+    return parent_points([children], n_points, with_payload)[0]
+
+
+def reciprocal_rank_fusion(rankings, k: int = RRF_K):
+    """rankings is a list of ranked point ID lists, returns [(point_id, fused score)] best first"""
+    fused = {}
+    for ranking in rankings:
+        for rank, pid in enumerate(ranking):
+            fused[pid] = fused.get(pid, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def load_content(points):
+    """Fills in payload["content"] of lazily retrieved points, in place, and returns points"""
+    with span("load_content", points=len(points)) as s:
+        missing = fill_content(points)
+        if missing:
+            # Not in the chunk store (not built yet, or the file changed since), ask Qdrant
+            records = {str(r.id): r for r in store.retrieve([p.id for p in missing], with_payload=["content"])}
+            for p in missing:
+                record = records.get(str(p.id))
+                p.payload["content"] = record.payload.get("content", "") if record is not None else ""
+        s.set(from_qdrant=len(missing))
+    return points
+
+
+def _as_scored(records, scores):
+    return [
+        models.ScoredPoint(id=r.id, version=0, score=scores[str(r.id)], payload=r.payload)
+        for r in records
+    ]
+
+
+def retrieve(question: str, n_points: int = 10, mode: str = "dense", timings=None, filters=None,
+             auto_filter: bool = True, rerank: bool = False, lazy: bool = False, parents: bool = False):
+    """
+    Returns up to n_points ScoredPoints with payloads, best first.
+    filters is an explicit filter dict (see the top of this file), auto_filter adds the ones found in the question.
+    rerank over-fetches and reorders the candidates with a cross-encoder.
+    lazy leaves "content" out of the payloads, see load_content().
+    parents searches the child chunks and returns their parents, see child_search().
+    If timings is a dict it is filled with per-leg latencies in milliseconds.
+    """
+    with span("retrieve", mode=mode, n_points=n_points, rerank=rerank, lazy=lazy, parents=parents) as s:
+        fetch = max(n_points, RERANK_CANDIDATES) if rerank else n_points
+        with_payload = LIGHT_PAYLOAD if lazy else True
+        resolved = resolve_filters(question, filters, auto_filter)
+        points = _search(question, fetch, mode, timings, resolved, with_payload, parents)
+        explicit = resolve_filters(question, filters, auto_filter=False)
+        if not points and resolved != explicit:
+            # The guessed filter was too strict, fall back to the explicit filters only
+            s.set(filter_fallback=True)
+            points = _search(question, fetch, mode, timings, explicit, with_payload, parents)
+        if rerank:
+            # The cross-encoder reads the text
+            if lazy:
+                load_content(points)
+            points = rerank_points(question, points, n_points, timings=timings)
+        s.set(points=len(points), filters=resolved)
+    return points
+
+
+def _search(question: str, n_points: int, mode: str, timings, filters, with_payload=True, parents: bool = False):
+    dense_leg = child_search if parents else dense_search
+    if mode == "dense":
+        return _timed(timings, "dense_ms", dense_leg, question, n_points, filters, with_payload)
+
+    if mode == "sparse":
+        hits = _timed(timings, "sparse_ms", sparse_search, question, n_points, filters)
+        scores = dict(hits)
+        records = _timed(timings, "fetch_ms", fetch_points, [pid for pid, _ in hits], with_payload)
+        return _as_scored(records, scores)
+
+    if mode == "hybrid":
+        candidates = n_points * HYBRID_CANDIDATES
+        # Run the legs in copies of this context so their trace spans nest under the caller's
+        dense = _legs.submit(contextvars.copy_context().run, _timed, timings, "dense_ms", dense_leg, question, candidates, filters,
+                             with_payload)
+        sparse = _legs.submit(contextvars.copy_context().run, _timed, timings, "sparse_ms", sparse_search, question, candidates, filters)
+        dense_points = dense.result()
+        sparse_hits = sparse.result()
+
+        start = time.perf_counter()
+        with span("fusion"):
+            fused = reciprocal_rank_fusion([[str(p.id) for p in dense_points], [pid for pid, _ in sparse_hits]])[:n_points]
+        if timings is not None:
+            timings["fusion_ms"] = (time.perf_counter() - start) * 1000
+
+        # Dense hits already carry their payload, only sparse-only hits need fetching
+        payloads = {str(p.id): p for p in dense_points}
+        missing = [pid for pid, _ in fused if pid not in payloads]
+        if missing:
+            payloads.update((str(r.id), r) for r in _timed(timings, "fetch_ms", fetch_points, missing, with_payload))
+        scores = dict(fused)
+        return _as_scored([payloads[pid] for pid, _ in fused if pid in payloads], scores)
+
+    raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(MODES)}")
+
+
+def dense_search_batch(vectors, n_points: int, filters_list, batch_size: int = QUERY_BATCH, with_payload=True):
+    return store.search_batch(vectors, n_points, filters_list, with_payload, SEARCH_PARAMS, batch_size)
+
+
+def retrieve_batch(questions, n_points: int = 10, mode: str = "dense", filters=None, auto_filter: bool = True,
+                   batch_size: int = QUERY_BATCH, timings=None, rerank: bool = False, lazy: bool = False,
+                   parents: bool = False):
+    """
+    retrieve() for many questions at once, returns a list of ScoredPoint lists in the order of questions.
+    Questions are embedded in one call, dense searches go out batch_size at a time and every
+    payload the sparse leg needs is fetched in one request, as are the parents of every child hit.
+    """
+    with_payload = LIGHT_PAYLOAD if lazy else True
+    if mode not in MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(MODES)}")
+    questions = list(questions)
+    resolved = [resolve_filters(q, filters, auto_filter) for q in questions]
+    fetch = max(n_points, RERANK_CANDIDATES) if rerank else n_points
+    candidates = fetch * HYBRID_CANDIDATES if mode == "hybrid" else fetch
+
+    dense = sparse = None
+    if mode in ("dense", "hybrid"):
+        vectors = _timed(timings, "embed_ms", embed_queries, questions, model_name)
+        if parents:
+            children = _timed(timings, "dense_ms", children_store.search_batch, vectors, candidates * CHILD_CANDIDATES,
+                              resolved, CHILD_PAYLOAD, SEARCH_PARAMS, batch_size)
+            dense = _timed(timings, "parents_ms", parent_points, children, candidates, with_payload)
+        else:
+            dense = _timed(timings, "dense_ms", dense_search_batch, vectors, candidates, resolved, batch_size, with_payload)
+    if mode in ("sparse", "hybrid"):
+        sparse = _timed(timings, "sparse_ms", lambda: [sparse_search(q, candidates, f) for q, f in zip(questions, resolved)])
+
+    if mode == "dense":
+        results = dense
+    else:
+        start = time.perf_counter()
+        if mode == "sparse":
+            ranked = sparse
+        else:
+            ranked = [
+                reciprocal_rank_fusion([[str(p.id) for p in points], [pid for pid, _ in hits]])[:fetch]
+                for points, hits in zip(dense, sparse)
+            ]
+        if timings is not None:
+            timings["fusion_ms"] = (time.perf_counter() - start) * 1000
+
+        payloads = {str(p.id): p for points in (dense or []) for p in points}
+        missing = list(dict.fromkeys(pid for hits in ranked for pid, _ in hits if pid not in payloads))
+        if missing:
+            payloads.update((str(r.id), r) for r in _timed(timings, "fetch_ms", fetch_points, missing, with_payload))
+        results = [_as_scored([payloads[pid] for pid, _ in hits if pid in payloads], dict(hits)) for hits in ranked]
+
+    # Same fallback as retrieve(): questions whose guessed filter found nothing are searched again without it
+    explicit = resolve_filters("", filters, auto_filter=False)
+    retry = [i for i, points in enumerate(results) if not points and resolved[i] != explicit]
+    if retry:
+        again = retrieve_batch([questions[i] for i in retry], fetch, mode, filters, False, batch_size, lazy=lazy,
+                               parents=parents)
+        for i, points in zip(retry, again):
+            results[i] = points
+    if rerank:
+        start = time.perf_counter()
+        if lazy:
+            load_content([p for points in results for p in points])
+        results = [rerank_points(q, points, n_points) for q, points in zip(questions, results)]
+        if timings is not None:
+            timings["rerank_ms"] = (time.perf_counter() - start) * 1000
+    return results
+
+
+def read_questions(path):
+    """One question per line, or {"question": ...} records in a .jsonl file"""
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if str(path).endswith(".jsonl"):
+        return [json.loads(line)["question"] for line in lines]
+    return lines
+
+
+def write_results(questions, results, out, with_content: bool = False):
+    for question, points in zip(questions, results):
+        hits = []
+        for p in points:
+            hit = {"id": str(p.id), "score": p.score, "document": p.payload["document"], "part_index": p.payload["part_index"]}
+            if with_content:
+                hit["content"] = p.payload["content"]
+            hits.append(hit)
+        out.write(json.dumps({"question": question, "results": hits}) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrieve relevant chunks for a question")
+    parser.add_argument("question", nargs="?", default="How does Tesla evaluate its energy segment growth and what strategies are they working on to increase its profitability?")
+    parser.add_argument("--n-points", type=int, default=10)
+    parser.add_argument("--mode", choices=MODES, default="dense")
+    parser.add_argument("--ticker", action="append", help="Only search these companies, can be repeated")
+    parser.add_argument("--year", action="append", help="Only search these filing years, can be repeated")
+    parser.add_argument("--document", action="append", help="Only search these files, can be repeated")
+    parser.add_argument("--no-auto-filter", dest="auto_filter", action="store_false", help="Don't infer filters from the question")
+    parser.add_argument("--rerank", action="store_true", help="Rerank over-fetched candidates with a cross-encoder")
+    parser.add_argument("--parents", action="store_true", help="Search child chunks and return their parents (embed.py --children)")
+    parser.add_argument("--questions", help="File of questions to retrieve for in one batch, writes JSONL")
+    parser.add_argument("--output", help="With --questions: JSONL file to write (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=QUERY_BATCH, help="With --questions: searches per Qdrant request")
+    parser.add_argument("--with-content", action="store_true", help="With --questions: include chunk text in the output")
+    parser.add_argument("--hnsw-ef", type=int, help="HNSW search candidate list size")
+    parser.add_argument("--exact", action="store_true", help="Exact search, bypasses the HNSW index")
+    parser.add_argument("--no-rescore", dest="rescore", action="store_false", default=None, help="Don't rescore quantized results")
+    parser.add_argument("--oversampling", type=float, help="Quantized candidates fetched per result for rescoring")
+    args = parser.parse_args()
+    if args.hnsw_ef or args.exact or args.rescore is not None or args.oversampling:
+        set_search_params(hnsw_ef=args.hnsw_ef, exact=args.exact, rescore=args.rescore, oversampling=args.oversampling)
+
+    # A batch run: the query vectors go into the embedding cache for the next one
+    get_cache(model_name, writable=True)
+
+    filters = {"ticker": args.ticker, "year": args.year, "document": args.document}
+    if args.questions:
+        questions = read_questions(args.questions)
+        timings = {}
+        start = time.perf_counter()
+        # Only IDs and metadata are printed, the text comes from the chunk store if asked for
+        results = retrieve_batch(questions, args.n_points, args.mode, filters, args.auto_filter, args.batch_size, timings,
+                                 args.rerank, lazy=True, parents=args.parents)
+        if args.with_content:
+            load_content([p for points in results for p in points])
+        elapsed = time.perf_counter() - start
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as out:
+                write_results(questions, results, out, args.with_content)
+        else:
+            write_results(questions, results, sys.stdout, args.with_content)
+        print(f"{len(questions)} questions in {elapsed:.2f}s ({len(questions) / max(elapsed, 1e-9):.1f} questions/s): "
+              + ", ".join(f"{name} {ms:.1f}" for name, ms in timings.items()), file=sys.stderr)
+    else:
+        print(f"Filters: {resolve_filters(args.question, filters, args.auto_filter)}")
+        timings = {}
+        points = retrieve(args.question, args.n_points, args.mode, timings, filters, args.auto_filter, args.rerank, lazy=True,
+                          parents=args.parents)
+        docs = "\n".join(f"Relevant Document {i}, {r.payload["document"]}, chunk index {r.payload["part_index"]}" for i, r in enumerate(points))
+        print(docs)
+        print(", ".join(f"{name} {ms:.1f}" for name, ms in timings.items()))
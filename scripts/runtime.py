@@ -0,0 +1,217 @@
+"""
+Process start-up: lazy imports, shared Ollama clients, model preloading and a cold-start budget
+
+Heavy dependencies are imported where they are first used rather than at the top of every
+script. lazy_import() returns a module whose import runs on the first attribute access, and
+the Ollama clients are only built (and ollama/httpx imported) when an answer is generated.
+ONNX models are downloaded to MODEL_CACHE_DIR (.cache/models, or FASTEMBED_CACHE_PATH) rather
+than fastembed's default temp folder, so the download happens once and not after every reboot.
+
+preload() does the slow first-use work up front: it loads and runs the embedding model, runs
+one search against the vector store (opens the Qdrant connection, or pages the local index into
+memory), loads the BM25 index and the chunk store, and optionally loads the reranker and asks
+Ollama to load the LLM. service.py calls it on start; the command below is meant for after a
+deploy or reboot, so the first question doesn't pay for downloads and cold disk caches.
+
+cold_start() runs every step of COLD_START_STEPS in a fresh interpreter and compares the wall
+time, interpreter start-up included, with COLD_START_BUDGET_MS. A step that imports any of
+LAZY_MODULES fails too.
+
+Usage:
+    from runtime import lazy_import, ollama_client
+    httpx = lazy_import("httpx")
+
+    python scripts/runtime.py --preload
+    python scripts/runtime.py --preload --reranker --llm
+    python scripts/runtime.py --cold-start --repeat 3 --output cold_start.json
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+MODEL_CACHE_DIR = Path(os.getenv("FASTEMBED_CACHE_PATH", ".cache/models"))
+LLM_KEEP_ALIVE = "30m"    # how long Ollama keeps a preloaded LLM in memory
+
+# Wall time of each step in a fresh process, interpreter start-up included. Most of an import of
+# retrieval or rag is qdrant_client (~1.5s, it imports fastembed, grpc and httpx), which the query
+# path can't defer: its models are the point types of both vector store backends. Budgets are about
+# 10% over what a laptop measures, so an eager import that doesn't belong there takes a step over.
+COLD_START_BUDGET_MS = {
+    "python": 150,
+    "import prices": 250,
+    "import evaluate_documents": 250,
+    "import retrieval": 2200,
+    "import rag": 2200,
+    "embedding model": 4000,
+    "first retrieval": 5000,
+}
+# Only imported where they are used, a step that loads one of them fails whatever its time
+LAZY_MODULES = ("ollama", "pdfplumber", "fastembed.rerank.cross_encoder")
+COLD_START_STEPS = {
+    "python": "pass",
+    "import prices": "import prices",
+    "import evaluate_documents": "import evaluate_documents",
+    "import retrieval": "import retrieval",
+    "import rag": "import rag",
+    "embedding model": "from embeddings import embed_queries; embed_queries(['warm up'], cache=False)",
+    "first retrieval": "from retrieval import retrieve; retrieve('What are the main risk factors?', 10, lazy=True)",
+}
+
+
+def lazy_import(name: str):
+    """The module name, imported on first attribute access. Parent packages are imported right away."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def ollama_client(timeout: float = None):
+    """Process-wide ollama.Client, or a new one whose reads give up after timeout seconds"""
+    from ollama import Client
+    if timeout is not None:
+        return Client(timeout=timeout)
+    with _clients_lock:
+        if "ollama" not in _clients:
+            _clients["ollama"] = Client()
+        return _clients["ollama"]
+
+
+def async_ollama_client():
+    # Not shared: an AsyncClient belongs to the event loop it was first used on
+    from ollama import AsyncClient
+    return AsyncClient()
+
+
+def _step(timings, name, fn):
+    start = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        # A missing index shouldn't stop the other steps
+        print(f"\t{name}: skipped ({type(e).__name__}: {e})")
+        return
+    timings[name] = (time.perf_counter() - start) * 1000
+
+
+def preload(embedding: bool = True, store: bool = True, indexes: bool = True, reranker: bool = False,
+            llm: bool = False):
+    """Does the first-use work of a query ahead of time, returns {step: milliseconds}"""
+    timings = {}
+    if embedding:
+        from config import model_name
+        from embeddings import embed_queries
+        _step(timings, "embedding_model", lambda: embed_queries(["warm up"], model_name, False))
+    if store:
+        import numpy as np
+        from retrieval import store as vector_store
+        from vector_store import VECTOR_SIZE
+        _step(timings, "vector_store", lambda: vector_store.search(np.ones(VECTOR_SIZE, dtype=np.float32), 1))
+    if indexes:
+        from bm25 import load_index
+        from chunk_store import get_chunk_store
+        _step(timings, "bm25_index", load_index)
+        _step(timings, "chunk_store", get_chunk_store)
+    if reranker:
+        from rerank import get_reranker
+        _step(timings, "reranker", get_reranker)
+    if llm:
+        from rag import llm_name
+        # An empty prompt only loads the model
+        _step(timings, "llm", lambda: ollama_client().generate(model=llm_name, prompt="", keep_alive=LLM_KEEP_ALIVE))
+    return timings
+
+
+def cold_start(steps=None, repeat: int = 3):
+    """
+    {step: {"ms": median wall time, "budget": ms, "ok": bool, "eager": [LAZY_MODULES it imported]}}
+    over repeat fresh interpreters per step
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(SCRIPTS_DIR), os.getenv("PYTHONPATH")]))}
+    results = {}
+    for step in steps or COLD_START_STEPS:
+        # The last line of output lists the lazy modules the step imported
+        code = f"{COLD_START_STEPS[step]}\nimport sys\nprint(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+        times = []
+        error = None
+        eager = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            done = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+            if done.returncode != 0:
+                error = (done.stderr.strip().splitlines() or ["failed"])[-1]
+                break
+            times.append((time.perf_counter() - start) * 1000)
+            eager = list(filter(None, done.stdout.splitlines()[-1].split(",")))
+        budget = COLD_START_BUDGET_MS.get(step)
+        if error:
+            results[step] = {"ms": None, "budget": budget, "ok": None, "error": error}
+        else:
+            ms = statistics.median(times)
+            ok = (budget is None or ms <= budget) and not eager
+            results[step] = {"ms": ms, "budget": budget, "ok": ok, "eager": eager}
+    return results
+
+
+def report_table(results):
+    lines = ["| step | ms | budget ms | |", "|---|---|---|---|"]
+    for step, r in results.items():
+        if r["ms"] is None:
+            lines.append(f"| {step} | - | {r['budget']} | error: {r['error']} |")
+        else:
+            status = "ok" if r["ok"] else f"imports {', '.join(r['eager'])}" if r["eager"] else "OVER"
+            lines.append(f"| {step} | {r['ms']:.0f} | {r['budget']} | {status} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preload models and indexes, or measure cold start")
+    parser.add_argument("--preload", action="store_true", help="Load the embedding model, vector store and local indexes")
+    parser.add_argument("--reranker", action="store_true", help="With --preload: also load the cross-encoder")
+    parser.add_argument("--llm", action="store_true", help="With --preload: also have Ollama load the LLM")
+    parser.add_argument("--cold-start", action="store_true", help="Time each step in a fresh process against the budget")
+    parser.add_argument("--steps", help=f"With --cold-start: comma separated, from {', '.join(COLD_START_STEPS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="With --cold-start: runs per step, the median is reported")
+    parser.add_argument("--output", help="With --cold-start: also write the result as JSON")
+    args = parser.parse_args()
+    if not args.preload and not args.cold_start:
+        parser.error("nothing to do, pass --preload and/or --cold-start")
+
+    if args.preload:
+        start = time.perf_counter()
+        timings = preload(reranker=args.reranker, llm=args.llm)
+        print(", ".join(f"{name} {ms:.0f} ms" for name, ms in timings.items()))
+        print(f"Preloaded in {time.perf_counter() - start:.1f}s")
+    if args.cold_start:
+        steps = [s.strip() for s in args.steps.split(",")] if args.steps else None
+        unknown = [s for s in steps or [] if s not in COLD_START_STEPS]
+        if unknown:
+            parser.error(f"unknown steps {unknown}, expected {', '.join(COLD_START_STEPS)}")
+        results = cold_start(steps, args.repeat)
+        print(report_table(results))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+        if any(r["ok"] is False for r in results.values()):
+            sys.exit(1)
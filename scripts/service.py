@@ -0,0 +1,431 @@
+"""
+Long-running RAG service, so questions don't pay client setup and model load every time
+
+One process keeps an AsyncQdrantClient, the async Ollama client and a warm embedding model
+(loaded with the local indexes on start, see runtime.preload).
+With VECTOR_BACKEND=local searches run in-process on the local index instead (see vector_store.py).
+timeout (seconds, including the wait for a generation slot) and max_tokens cut an answer short:
+"stopped" in the done reply says "timeout" or "max_tokens", and the Ollama stream is closed so
+the model stops generating. Timed-out questions free their place for the ones behind them.
+Questions are handled concurrently: embeddings of questions that arrive together are computed
+in one batch, at most --max-concurrent generations run at once, and past --max-pending waiting
+questions new ones are turned away with a "busy" error instead of queueing forever.
+
+Protocol: newline-delimited JSON over TCP. Several requests can be in flight on one connection,
+every reply carries the id of its request.
+    request   {"id": 1, "question": "...", "n_points": 10, "mode": "hybrid",
+               "filters": {"ticker": ["TSLA"]}, "auto_filter": true, "cache": true, "budget": 2048, "trim": false,
+               "rerank": false, "prices": true, "parents": false, "timeout": 30, "max_tokens": 512}
+    replies   {"id": 1, "event": "sources", "sources": [{"document": ..., "part_index": ..., "score": ...}]}
+              {"id": 1, "event": "token", "text": "..."}                    (many)
+              {"id": 1, "event": "done", "answer": "...", "cached": false, "stopped": null, "timings": {...}, "context": {...}}
+              {"id": 1, "event": "error", "error": "..."}
+
+Usage:
+    python scripts/service.py --port 8765 --max-concurrent 4
+    python scripts/service.py --ask "How did Tesla's energy segment grow in 2023?"
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bm25 import load_index
+from chunk_store import fill_content
+from config import async_qdrant_client, children_collection, collection_name, model_name, with_retry_async
+from context import DEFAULT_TOKEN_BUDGET
+from embeddings import embed_queries
+from rag import add_prices, build_context, build_messages, llm_name
+from rag_cache import get_rag_cache, scope_for
+from rerank import RERANK_CANDIDATES, rerank as rerank_points
+from retrieval import (CHILD_CANDIDATES, CHILD_PAYLOAD, HYBRID_CANDIDATES, LIGHT_PAYLOAD, MODES, SEARCH_PARAMS, _as_scored,
+                       reciprocal_rank_fusion, resolve_filters)
+from runtime import async_ollama_client, preload
+from vector_store import get_store, to_qdrant_filter
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_CONCURRENT = 4        # generations running at once
+MAX_PENDING = 64          # questions waiting for a generation slot before new ones are rejected
+EMBED_BATCH = 32          # questions embedded together
+EMBED_WAIT_MS = 5         # how long the first question of a batch waits for others
+
+# Request fields passed on to RagService.answer
+REQUEST_OPTIONS = ("n_points", "mode", "filters", "auto_filter", "cache", "budget", "trim", "rerank", "prices", "parents",
+                   "timeout", "max_tokens")
+
+
+async def _until(deadline, awaitable):
+    """awaitable, cancelled with asyncio.TimeoutError once the loop's clock passes deadline (None: no limit)"""
+    if deadline is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, max(deadline - asyncio.get_running_loop().time(), 0))
+
+
+class RagService:
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT, max_pending: int = MAX_PENDING,
+                 embed_batch: int = EMBED_BATCH, embed_wait_ms: float = EMBED_WAIT_MS):
+        store = get_store(name=collection_name)
+        # The local index is searched in the worker threads, Qdrant through its async client
+        self.local = store if store.backend == "local" else None
+        self.local_children = get_store(name=children_collection) if self.local is not None else None
+        self.qdrant = async_qdrant_client() if self.local is None else None
+        self.llm = async_ollama_client()
+        self.max_pending = max_pending
+        self.embed_batch = embed_batch
+        self.embed_wait = embed_wait_ms / 1000
+        self.pending = 0
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._embed_queue = asyncio.Queue()
+        # Embedding and BM25 are CPU work, keep them off the event loop
+        self._workers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="service")
+        self._batcher = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        # Model, local index and BM25/chunk stores loaded before the first question, not during it
+        timings = await loop.run_in_executor(self._workers, lambda: preload(store=self.local is not None))
+        if self.qdrant is not None:
+            await with_retry_async(self.qdrant.get_collection, collection_name)
+            timings["vector_store"] = (time.perf_counter() - start) * 1000 - sum(timings.values())
+        print(f"Preloaded in {time.perf_counter() - start:.1f}s: " + ", ".join(f"{k} {v:.0f} ms" for k, v in timings.items()))
+        self._batcher = asyncio.create_task(self._embed_batches())
+
+    async def close(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+        if self.qdrant is not None:
+            await self.qdrant.close()
+        self._workers.shutdown(wait=False)
+
+    async def embed(self, question: str):
+        future = asyncio.get_running_loop().create_future()
+        await self._embed_queue.put((question, future))
+        return await future
+
+    async def _embed_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._embed_queue.get()]
+            deadline = loop.time() + self.embed_wait
+            while len(batch) < self.embed_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._embed_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                vectors = await loop.run_in_executor(self._workers, embed_queries, [q for q, _ in batch], model_name)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    async def _query(self, name: str, local, vector, limit: int, filters, with_payload):
+        if local is not None:
+            return await self._in_worker(local.search, vector, limit, filters, with_payload, SEARCH_PARAMS)
+        response = await with_retry_async(
+            self.qdrant.query_points,
+            collection_name=name,
+            query=vector.tolist(),
+            query_filter=to_qdrant_filter(filters),
+            search_params=SEARCH_PARAMS,
+            limit=limit,
+            with_payload=with_payload,
+        )
+        return response.points
+
+    async def dense_search(self, vector, n_points: int, filters, parents: bool = False):
+        if not parents:
+            return await self._query(collection_name, self.local, vector, n_points, filters, LIGHT_PAYLOAD)
+        # Same as retrieval.child_search: child hits, then their parents in one request
+        children = await self._query(children_collection, self.local_children, vector, n_points * CHILD_CANDIDATES,
+                                     filters, CHILD_PAYLOAD)
+        scores = {}
+        for child in children:
+            scores.setdefault(child.payload["parent_id"], child.score)
+        ranked = list(scores.items())[:n_points]
+        return _as_scored(await self.fetch_points([pid for pid, _ in ranked]), dict(ranked))
+
+    async def sparse_search(self, question: str, n_points: int, filters):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._workers, lambda: load_index().search(question, n_points, filters))
+
+    async def _in_worker(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._workers, fn, *args)
+
+    async def _retrieve(self, ids, with_payload):
+        if self.local is not None:
+            return await self._in_worker(self.local.retrieve, ids, with_payload)
+        return await with_retry_async(self.qdrant.retrieve, collection_name=collection_name, ids=ids, with_payload=with_payload)
+
+    async def fetch_points(self, ids):
+        records = await self._retrieve(list(ids), LIGHT_PAYLOAD)
+        records = {str(r.id): r for r in records}
+        return [records[pid] for pid in ids if pid in records]
+
+    async def load_content(self, points):
+        # Searches leave the text out, it comes from the chunk store or, failing that, from Qdrant
+        missing = fill_content(points)
+        if missing:
+            records = await self._retrieve([p.id for p in missing], ["content"])
+            records = {str(r.id): r for r in records}
+            for p in missing:
+                record = records.get(str(p.id))
+                p.payload["content"] = record.payload.get("content", "") if record is not None else ""
+        return points
+
+    async def _search(self, question: str, vector, n_points: int, mode: str, filters, parents: bool = False):
+        # Same as retrieval.retrieve, with both hybrid legs awaited together
+        if mode == "dense":
+            return await self.dense_search(vector, n_points, filters, parents)
+
+        if mode == "sparse":
+            hits = await self.sparse_search(question, n_points, filters)
+            return _as_scored(await self.fetch_points([pid for pid, _ in hits]), dict(hits))
+
+        if mode == "hybrid":
+            candidates = n_points * HYBRID_CANDIDATES
+            dense_points, sparse_hits = await asyncio.gather(
+                self.dense_search(vector, candidates, filters, parents),
+                self.sparse_search(question, candidates, filters),
+            )
+            fused = reciprocal_rank_fusion([[str(p.id) for p in dense_points], [pid for pid, _ in sparse_hits]])[:n_points]
+            payloads = {str(p.id): p for p in dense_points}
+            missing = [pid for pid, _ in fused if pid not in payloads]
+            if missing:
+                payloads.update((str(r.id), r) for r in await self.fetch_points(missing))
+            return _as_scored([payloads[pid] for pid, _ in fused if pid in payloads], dict(fused))
+
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(MODES)}")
+
+    async def retrieve(self, question: str, vector, n_points: int = 10, mode: str = "dense", filters=None,
+                       auto_filter: bool = True, rerank: bool = False, parents: bool = False):
+        fetch = max(n_points, RERANK_CANDIDATES) if rerank else n_points
+        resolved = resolve_filters(question, filters, auto_filter)
+        points = await self._search(question, vector, fetch, mode, resolved, parents)
+        explicit = resolve_filters(question, filters, auto_filter=False)
+        if not points and resolved != explicit:
+            points = await self._search(question, vector, fetch, mode, explicit, parents)
+        await self.load_content(points)
+        if rerank:
+            loop = asyncio.get_running_loop()
+            points = await loop.run_in_executor(self._workers, rerank_points, question, points, n_points)
+        return points
+
+    async def answer(self, question: str, n_points: int = 10, mode: str = "dense", filters=None,
+                     auto_filter: bool = True, cache: bool = True, budget: int = DEFAULT_TOKEN_BUDGET,
+                     trim: bool = False, rerank: bool = False, prices: bool = True, parents: bool = False,
+                     timeout: float = None, max_tokens: int = None):
+        """Async generator of (event, data) pairs, see the protocol at the top of this file"""
+        if self.pending >= self.max_pending:
+            raise RuntimeError(f"busy, {self.pending} questions waiting")
+        start = time.perf_counter()
+        timings = {}
+        # On the loop's clock, see _until()
+        deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+
+        self.pending += 1
+        try:
+            vector = await self.embed(question)
+            timings["embed_ms"] = (time.perf_counter() - start) * 1000
+
+            store = get_rag_cache() if cache else None
+            entry = None
+            cached_question = question
+            if store is not None:
+                scope = scope_for(mode=mode, n_points=n_points, model=model_name, rerank=rerank,
+                                  filters=resolve_filters(question, filters, auto_filter), parents=parents)
+                entry, normalized = store.get_points(question, scope, lambda: vector)
+            if entry is not None:
+                points = await self.load_content(entry["points"])
+                cached_question = entry["question"]
+            else:
+                points = await self.retrieve(question, vector, n_points, mode, filters, auto_filter, rerank, parents)
+                if store is not None:
+                    store.put_points(question, scope, normalized, points)
+            timings["retrieve_ms"] = (time.perf_counter() - start) * 1000 - timings["embed_ms"]
+
+            yield "sources", [
+                {"document": p.payload["document"], "part_index": p.payload["part_index"], "score": p.score}
+                for p in points
+            ]
+
+            loop = asyncio.get_running_loop()
+            context, stats = await loop.run_in_executor(self._workers, build_context, question, points, budget, trim)
+            if prices:
+                context, _ = add_prices(question, context, resolve_filters(question, filters, auto_filter))
+            answer = store.get_answer(cached_question, context, llm_name) if store is not None else None
+            if answer is not None:
+                timings["total_ms"] = (time.perf_counter() - start) * 1000
+                yield "done", {"answer": answer, "cached": True, "stopped": None, "timings": timings, "context": stats}
+                return
+
+            try:
+                await _until(deadline, self._slots.acquire())
+            except asyncio.TimeoutError:
+                timings["total_ms"] = (time.perf_counter() - start) * 1000
+                yield "done", {"answer": "", "cached": False, "stopped": "timeout", "timings": timings, "context": stats}
+                return
+        finally:
+            self.pending -= 1
+
+        pieces = []
+        stopped = None
+        stream = None
+        options = {"num_predict": max_tokens} if max_tokens else None
+        try:
+            timings["queued_ms"] = (time.perf_counter() - start) * 1000 - timings["embed_ms"] - timings["retrieve_ms"]
+            # Only the waits on Ollama are timed, never the caller's handling of a token
+            stream = await _until(deadline, self.llm.chat(model=llm_name, stream=True,
+                                                          messages=build_messages(question, context), options=options))
+            while True:
+                chunk = await _until(deadline, anext(stream, None))
+                if chunk is None:
+                    break
+                if not chunk.message.content:
+                    continue
+                if not pieces:
+                    first_token = time.perf_counter()
+                    timings["ttft_ms"] = (first_token - start) * 1000
+                pieces.append(chunk.message.content)
+                yield "token", chunk.message.content
+                if max_tokens and len(pieces) >= max_tokens:
+                    stopped = "max_tokens"
+                    break
+        except asyncio.TimeoutError:
+            stopped = "timeout"
+        finally:
+            if stream is not None:
+                # Drops the HTTP stream, Ollama stops generating
+                await stream.aclose()
+            self._slots.release()
+
+        if pieces:
+            timings["tokens"] = len(pieces)
+            timings["tokens_per_sec"] = len(pieces) / max(time.perf_counter() - first_token, 1e-9)
+        answer = "".join(pieces)
+        if store is not None and answer.strip() and stopped is None:
+            store.put_answer(cached_question, context, llm_name, answer)
+        timings["total_ms"] = (time.perf_counter() - start) * 1000
+        yield "done", {"answer": answer, "cached": False, "stopped": stopped, "timings": timings, "context": stats}
+
+    async def _reply(self, request, send):
+        request_id = request.get("id")
+        try:
+            options = {key: request[key] for key in REQUEST_OPTIONS if key in request}
+            async for event, data in self.answer(request["question"], **options):
+                if event == "token":
+                    await send({"id": request_id, "event": "token", "text": data})
+                elif event == "sources":
+                    await send({"id": request_id, "event": "sources", "sources": data})
+                else:
+                    await send({"id": request_id, "event": "done", **data})
+        except ConnectionError:
+            raise
+        except Exception as e:
+            await send({"id": request_id, "event": "error", "error": str(e)})
+
+    async def handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def send(message):
+            # One line per message, drain so a slow reader only slows down its own stream
+            async with lock:
+                writer.write((json.dumps(message) + "\n").encode("utf-8"))
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if not request.get("question"):
+                        raise ValueError("missing question")
+                except (ValueError, AttributeError) as e:
+                    await send({"id": None, "event": "error", "error": f"bad request: {e}"})
+                    continue
+                task = asyncio.create_task(self._reply(request, send))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, **options):
+    service = RagService(**options)
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"Serving on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+async def ask(question: str, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, **options):
+    """Client side: async generator of the reply messages for one question"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((json.dumps({"id": 1, "question": question, **options}) + "\n").encode("utf-8"))
+        await writer.drain()
+        while line := await reader.readline():
+            message = json.loads(line)
+            yield message
+            if message["event"] in ("done", "error"):
+                break
+    finally:
+        writer.close()
+
+
+async def _print_answer(question: str, host: str, port: int, **options):
+    async for message in ask(question, host, port, **options):
+        if message["event"] == "sources":
+            for i, source in enumerate(message["sources"]):
+                print(f"Relevant Document {i}, {source["document"]}, chunk index {source["part_index"]}")
+            print(f"User: {question.strip()}")
+        elif message["event"] == "token":
+            print(message["text"], end="", flush=True)
+        elif message["event"] == "done":
+            if message["cached"]:
+                print(message["answer"], end="")
+            stopped = f", stopped: {message["stopped"]}" if message.get("stopped") else ""
+            print(f"\n({", ".join(f"{name} {ms:.0f}" for name, ms in message["timings"].items())}{stopped})")
+        else:
+            print(f"ERROR: {message["error"]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve rag() to many concurrent callers")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT, help="Generations running at once")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING, help="Waiting questions before rejecting new ones")
+    parser.add_argument("--ask", metavar="QUESTION", help="Send one question to a running service and stream the answer")
+    parser.add_argument("--mode", choices=MODES, default="dense", help="With --ask: retrieval mode")
+    parser.add_argument("--n-points", type=int, default=10, help="With --ask: chunks to retrieve")
+    parser.add_argument("--timeout", type=float, help="With --ask: seconds before the answer is cut short")
+    parser.add_argument("--max-tokens", type=int, help="With --ask: tokens before the answer is cut short")
+    args = parser.parse_args()
+
+    try:
+        if args.ask:
+            limits = {key: value for key, value in (("timeout", args.timeout), ("max_tokens", args.max_tokens)) if value}
+            asyncio.run(_print_answer(args.ask, args.host, args.port, mode=args.mode, n_points=args.n_points, **limits))
+        else:
+            asyncio.run(serve(args.host, args.port, max_concurrent=args.max_concurrent, max_pending=args.max_pending))
+    except KeyboardInterrupt:
+        print("(QUIT)")
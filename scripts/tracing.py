@@ -0,0 +1,241 @@
+"""
+Lightweight spans and metrics for the RAG pipeline
+
+Off unless one of these is set (in the environment or .env):
+    RAG_TRACE=traces.jsonl     every finished span is appended as one JSON line
+    RAG_METRICS=metrics.prom   histograms and counters are written in Prometheus text format at exit
+
+When both are unset span() returns a shared no-op object, so instrumented code pays one function
+call and a `with` per span.
+
+Spans nest per thread/task: a span started inside another one records it as its parent, and
+all spans under the same root share a trace id. Every span's duration also goes into the
+rag_span_seconds histogram, labelled by span name.
+
+Usage:
+    from tracing import span, observe, count
+    with span("qdrant_query", limit=10) as s:
+        points = client.query_points(...)
+        s.set(points=len(points))
+    observe("prompt_tokens", 1800)
+    count("chunks_upserted", 128)
+
+    python scripts/tracing.py traces.jsonl      # per-span latency summary of a trace file
+"""
+import atexit
+import contextvars
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# Loads .env, which can set RAG_TRACE / RAG_METRICS
+import config
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+VALUE_BUCKETS = tuple(2 ** i for i in range(0, 21))    # 1 .. ~1M, for counts, bytes and tokens
+
+_lock = threading.Lock()
+_current = contextvars.ContextVar("span", default=None)
+_ids = itertools.count(1)
+_trace_file = None
+_metrics_path = None
+_enabled = False
+_histograms = {}   # (name, labels) -> Histogram
+_counters = {}     # (name, labels) -> float
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NoopSpan:
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    enabled = True
+
+    def __init__(self, name: str, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        parent = _current.get()
+        self.id = next(_ids)
+        self.parent = parent.id if parent else None
+        self.trace = parent.trace if parent else self.id
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._perf = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._perf
+        _current.reset(self._token)
+        record = {"trace": self.trace, "span": self.id, "parent": self.parent, "name": self.name,
+                  "start": self.start, "ms": seconds * 1000, "thread": threading.current_thread().name, **self.attrs}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        with _lock:
+            _observe("span_seconds", seconds, {"span": self.name}, SECONDS_BUCKETS)
+            if _trace_file is not None:
+                _trace_file.write(json.dumps(record, default=str) + "\n")
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def enable(trace_path=None, metrics_path=None):
+    """Turns tracing on, trace_path gets the JSONL spans, metrics_path the Prometheus text at exit"""
+    global _trace_file, _metrics_path, _enabled
+    with _lock:
+        if trace_path and _trace_file is None:
+            _trace_file = open(trace_path, "a", encoding="utf-8", buffering=1 << 16)
+        if metrics_path:
+            _metrics_path = metrics_path
+        _enabled = _trace_file is not None or _metrics_path is not None
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def span(name: str, **attrs):
+    if not _enabled:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def traced(name: str):
+    """Decorator, runs the function inside span(name)"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def payload_bytes(points) -> int:
+    """Approximate size of the payloads of points/records, only worth computing when tracing"""
+    return sum(len(json.dumps(p.payload, default=str)) for p in points if p.payload)
+
+
+def _observe(name, value, labels, buckets):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+
+def observe(name: str, value: float, buckets=VALUE_BUCKETS, **labels):
+    """Adds value to the histogram name (e.g. prompt_tokens, payload_bytes)"""
+    if not _enabled:
+        return
+    with _lock:
+        _observe(name, value, labels, buckets)
+
+
+def count(name: str, value: float = 1, **labels):
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def prometheus_text(prefix: str = "rag_"):
+    lines = []
+    with _lock:
+        for name in sorted({name for name, _ in _histograms}):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for (metric, labels), histogram in sorted(_histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    lines.append(f"{prefix}{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{prefix}{name}_bucket{_labels(labels, le='+Inf')} {histogram.count}")
+                lines.append(f"{prefix}{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{_labels(labels)} {histogram.count}")
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            for (metric, labels), value in sorted(_counters.items()):
+                if metric == name:
+                    lines.append(f"{prefix}{name}_total{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@atexit.register
+def flush():
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.flush()
+    if _metrics_path:
+        with open(_metrics_path, "w", encoding="utf-8") as f:
+            f.write(prometheus_text())
+
+
+if os.getenv("RAG_TRACE") or os.getenv("RAG_METRICS"):
+    enable(os.getenv("RAG_TRACE"), os.getenv("RAG_METRICS"))
+
+
+def summarize(path):
+    """Per-span count and latency percentiles from a trace file"""
+    durations = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                durations.setdefault(record["name"], []).append(record["ms"])
+    print(f"{'span':<24} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'total s':>10}")
+    for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        print(f"{name:<24} {len(values):>7} {pick(0.5):>10.2f} {pick(0.95):>10.2f} {pick(0.99):>10.2f} {sum(values) / 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python scripts/tracing.py traces.jsonl")
+        sys.exit(1)
+    summarize(sys.argv[1])
@@ -0,0 +1,612 @@
+"""
+Vector store backends behind embed.py, retrieval.py, rag.py and evaluate_documents.py
+
+    qdrant    a collection on the Qdrant server at QDRANT_URL (default), client settings in config.py
+    local     in-process NumPy index under .vector_store/<collection>/, no server needed
+
+The backend is picked with VECTOR_BACKEND=qdrant|local (environment or .env), or --backend on
+embed.py. Both return qdrant_client models (ScoredPoint, Record), so callers don't depend on
+which one they talk to. Filters are the dicts of retrieval.py, e.g. {"ticker": ["TSLA"]}.
+
+Local backend files:
+    vectors.npy         float32, one normalized row per point, memory-mapped
+    vectors.int8.npy    optional int8 copy (storage {"quantization": "scalar"}), searched first,
+                        the best candidates are rescored with the float32 rows
+    ivf.npz             optional IVF index (storage {"ivf": n_lists}): k-means centroids and the
+                        rows of each list, a search only scores the LOCAL_NPROBE closest lists
+    payloads.jsonl      one JSON payload per row, read through a memory map by byte offset
+    index.npz           point IDs, payload offsets, settings and the rows of every filter value
+
+Writes (upsert, delete, set_payloads) are kept in memory until flush(), which rewrites the
+files; searches, retrieve, find and count see the store as of the last flush(). Brute force over a few thousand 384-dim rows takes well under a millisecond.
+
+Usage:
+    from vector_store import get_store
+    store = get_store()                      # VECTOR_BACKEND decides
+    points = store.search(vector, 10, {"ticker": ["TSLA"]})
+"""
+import json
+import mmap
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from qdrant_client import models
+
+from bm25 import FILTER_FIELDS
+from config import collection_name, qdrant_client, with_retry
+
+BACKENDS = ("qdrant", "local")
+VECTOR_SIZE = 384                     # bge-small-en-v1.5
+LOCAL_STORE_PATH = Path(".vector_store")
+LOCAL_NPROBE = int(os.getenv("LOCAL_NPROBE", "8"))    # IVF lists scored per search
+LOCAL_OVERSAMPLING = 4.0              # int8 candidates rescored per result
+IVF_ITERATIONS = 10
+
+# Payload fields with a keyword index, used to pre-filter searches by company / year / filing
+INDEXED_FIELDS = ["ticker", "year", "document", "tickers", "years", "documents"]
+
+# Quantized copies of the vectors, kept in RAM even when the originals are on disk.
+# Searches run on these and rescore the best candidates with the original vectors.
+QUANTIZATION = {
+    "scalar": models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+    ),
+    "binary": models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True)),
+}
+
+
+def to_qdrant_filter(filters):
+    # Match against the list fields so chunks shared by several filings match any of them
+    conditions = [
+        models.FieldCondition(key=FILTER_FIELDS[key], match=models.MatchAny(any=list(values)))
+        for key, values in (filters or {}).items() if values
+    ]
+    return models.Filter(must=conditions) if conditions else None
+
+
+def collection_options(quantization: str = None, on_disk: bool = False, hnsw_m: int = None, ef_construct: int = None):
+    """
+    Keyword arguments of create_collection for the storage settings.
+    quantization is None, "scalar" (int8, 4x smaller) or "binary" (32x smaller, needs rescoring),
+    on_disk moves the original vectors and the payloads out of RAM.
+    """
+    options = {
+        "vectors_config": models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE, on_disk=on_disk or None),
+        "on_disk_payload": on_disk,
+    }
+    if hnsw_m is not None or ef_construct is not None:
+        options["hnsw_config"] = models.HnswConfigDiff(m=hnsw_m, ef_construct=ef_construct)
+    if quantization is not None:
+        options["quantization_config"] = QUANTIZATION[quantization]
+    return options
+
+
+def _as_list(vector):
+    return vector.tolist() if hasattr(vector, "tolist") else list(vector)
+
+
+def _batched(items, n: int):
+    items = list(items)
+    for start in range(0, len(items), n):
+        yield items[start:start + n]
+
+
+class VectorStore:
+    """Operations the scripts need from a vector database, see QdrantStore and LocalStore"""
+
+    backend: str
+    name: str
+
+    def exists(self) -> bool:
+        raise NotImplementedError
+
+    def create(self, rebuild: bool = False, storage=None):
+        """Creates the collection if missing (dropping it first with rebuild), storage as for collection_options,
+        also applied to an existing collection"""
+        raise NotImplementedError
+
+    def upsert(self, points):
+        """points: models.PointStruct with list vectors"""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+    def set_payloads(self, updates):
+        """updates: [(point id, payload fields to set)], other fields are kept"""
+        raise NotImplementedError
+
+    def search(self, vector, limit: int, filters=None, with_payload=True, params=None):
+        """[ScoredPoint] best first, params is a models.SearchParams or None"""
+        raise NotImplementedError
+
+    def search_batch(self, vectors, limit: int, filters_list, with_payload=True, params=None, batch_size: int = 64):
+        return [self.search(v, limit, f, with_payload, params) for v, f in zip(vectors, filters_list)]
+
+    def retrieve(self, ids, with_payload=True):
+        """[Record] for the ids that exist"""
+        raise NotImplementedError
+
+    def find(self, references):
+        """[Record] whose payload document / part_index is one of the (document, part_index) references"""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Makes writes durable and visible, a no-op for Qdrant. LocalStore reads don't see its
+        writes before this, callers flush after a batch of writes.
+        """
+
+
+class QdrantStore(VectorStore):
+    backend = "qdrant"
+
+    def __init__(self, client=None, name: str = collection_name):
+        self._client = client
+        self.name = name
+
+    @property
+    def client(self):
+        # The shared client of config.py, built on first use so importing a script doesn't need QDRANT_URL
+        if self._client is None:
+            self._client = qdrant_client()
+        return self._client
+
+    def exists(self):
+        return with_retry(self.client.collection_exists, self.name)
+
+    def create(self, rebuild: bool = False, storage=None):
+        if rebuild:
+            #WARNING DELETE
+            with_retry(self.client.delete_collection, collection_name=self.name)
+
+        if not self.exists():
+            print(f"Creating new collection: {self.name}")
+            with_retry(self.client.create_collection, collection_name=self.name, **collection_options(**(storage or {})))
+        else:
+            print(f"Collection '{self.name}' already exists — skipping creation.")
+            if storage:
+                print(f"Updating storage settings: {storage}")
+                self.update_storage(**storage)
+
+        # Creating an index that already exists is a no-op
+        for field in INDEXED_FIELDS:
+            with_retry(
+                self.client.create_payload_index,
+                collection_name=self.name,
+                field_name=field,
+                field_schema=models.PayloadSchemaType.KEYWORD,
+            )
+
+    def update_storage(self, quantization: str = None, on_disk: bool = None, hnsw_m: int = None, ef_construct: int = None):
+        # Qdrant rebuilds the affected indexes in the background
+        with_retry(
+            self.client.update_collection,
+            collection_name=self.name,
+            vectors_config={"": models.VectorParamsDiff(on_disk=on_disk)} if on_disk is not None else None,
+            collection_params=models.CollectionParamsDiff(on_disk_payload=on_disk) if on_disk is not None else None,
+            hnsw_config=models.HnswConfigDiff(m=hnsw_m, ef_construct=ef_construct) if hnsw_m or ef_construct else None,
+            quantization_config=QUANTIZATION[quantization] if quantization else None,
+        )
+
+    def upsert(self, points):
+        with_retry(self.client.upsert, collection_name=self.name, points=points, wait=True)
+
+    def delete(self, ids, batch_size: int = 1024):
+        for batch in _batched(ids, batch_size):
+            with_retry(self.client.delete, collection_name=self.name, points_selector=models.PointIdsList(points=batch),
+                       wait=True)
+
+    def set_payloads(self, updates, batch_size: int = 256):
+        for batch in _batched(updates, batch_size):
+            with_retry(
+                self.client.batch_update_points,
+                collection_name=self.name,
+                update_operations=[
+                    models.SetPayloadOperation(set_payload=models.SetPayload(payload=payload, points=[pid]))
+                    for pid, payload in batch
+                ],
+                wait=True,
+            )
+
+    def search(self, vector, limit: int, filters=None, with_payload=True, params=None):
+        return with_retry(
+            self.client.query_points,
+            collection_name=self.name,
+            query=_as_list(vector),
+            query_filter=to_qdrant_filter(filters),
+            search_params=params,
+            limit=limit,
+            with_payload=with_payload,
+        ).points
+
+    def search_batch(self, vectors, limit: int, filters_list, with_payload=True, params=None, batch_size: int = 64):
+        results = []
+        for start in range(0, len(vectors), batch_size):
+            requests = [
+                models.QueryRequest(query=_as_list(vector), filter=to_qdrant_filter(filters), params=params, limit=limit,
+                                    with_payload=with_payload)
+                for vector, filters in zip(vectors[start:start + batch_size], filters_list[start:start + batch_size])
+            ]
+            responses = with_retry(self.client.query_batch_points, collection_name=self.name, requests=requests)
+            results.extend(r.points for r in responses)
+        return results
+
+    def retrieve(self, ids, with_payload=True):
+        return with_retry(self.client.retrieve, collection_name=self.name, ids=list(ids), with_payload=with_payload)
+
+    def find(self, references):
+        references = list(references)
+        if not references:
+            return []
+        found, _ = with_retry(
+            self.client.scroll,
+            collection_name=self.name,
+            scroll_filter=models.Filter(should=[
+                models.Filter(must=[
+                    models.FieldCondition(key="document", match=models.MatchValue(value=document)),
+                    models.FieldCondition(key="part_index", match=models.MatchValue(value=part_index)),
+                ])
+                for document, part_index in references
+            ]),
+            limit=len(references),
+            with_payload=True,
+        )
+        return found
+
+    def count(self):
+        return with_retry(self.client.count, collection_name=self.name, exact=True).count
+
+
+def _select(payload, with_payload):
+    # Same payload selection as Qdrant's with_payload
+    if with_payload is True:
+        return payload
+    if not with_payload:
+        return None
+    if isinstance(with_payload, models.PayloadSelectorExclude):
+        return {k: v for k, v in payload.items() if k not in with_payload.exclude}
+    include = with_payload.include if isinstance(with_payload, models.PayloadSelectorInclude) else with_payload
+    return {k: v for k, v in payload.items() if k in include}
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _top(scores, k: int):
+    # Indices of the k highest scores, best first
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def train_ivf(vectors, n_lists: int, iterations: int = IVF_ITERATIONS, seed: int = 0):
+    """(centroids, rows sorted by list, start of every list in them) from spherical k-means"""
+    rng = np.random.default_rng(seed)
+    n_lists = max(1, min(n_lists, len(vectors)))
+    centroids = np.array(vectors[rng.choice(len(vectors), n_lists, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = vectors[assign == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    assign = np.argmax(vectors @ centroids.T, axis=1)
+    order = np.argsort(assign, kind="stable")
+    offsets = np.searchsorted(assign[order], np.arange(n_lists + 1))
+    return centroids, order, offsets
+
+
+class LocalStore(VectorStore):
+    """Brute-force (optionally int8 / IVF) search over memory-mapped NumPy files, see the top of this file"""
+
+    backend = "local"
+
+    def __init__(self, path: Path, size: int = VECTOR_SIZE):
+        self.path = Path(path)
+        self.name = self.path.name
+        self.size = size
+        self._lock = threading.RLock()
+        self._version = None
+        self._writes = None     # in-memory copy while there are unflushed writes
+        self._clear()
+
+    def _clear(self):
+        self.ids = []
+        self.rows = {}
+        self.vectors = np.empty((0, self.size), dtype=np.float32)
+        self.codes = self.scales = None
+        self.ivf = None
+        self.settings = {"quantization": None, "ivf": 0}
+        self.fields = {}
+        self.references = {}
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._payloads = None
+
+    # ---- reading ----
+
+    def _index_version(self):
+        index = self.path / "index.npz"
+        return index.stat().st_mtime_ns if index.exists() else None
+
+    def _load(self):
+        # (Re)loads the files if another process rewrote them, unless this one has unflushed writes
+        with self._lock:
+            if self._writes is not None or self._version == self._index_version():
+                return
+            self._clear()
+            self._version = self._index_version()
+            if self._version is None:
+                return
+            with np.load(self.path / "index.npz") as index:
+                self.ids = index["ids"].tolist()
+                self._offsets = index["offsets"]
+                meta = json.loads(str(index["meta"]))
+            self.settings = meta["settings"]
+            self.fields = {field: {value: np.asarray(rows, dtype=np.int64) for value, rows in values.items()}
+                           for field, values in meta["fields"].items()}
+            self.references = meta["references"]
+            self.rows = {pid: row for row, pid in enumerate(self.ids)}
+            if self.ids:
+                self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r")
+                if self.settings.get("quantization"):
+                    self.codes = np.load(self.path / "vectors.int8.npy", mmap_mode="r")
+                    self.scales = np.load(self.path / "scales.npy")
+                if self.settings.get("ivf"):
+                    with np.load(self.path / "ivf.npz") as ivf:
+                        self.ivf = (ivf["centroids"], ivf["order"], ivf["offsets"])
+                with open(self.path / "payloads.jsonl", "rb") as f:
+                    self._payloads = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _payload(self, row: int):
+        # As of the last flush
+        return json.loads(self._payloads[int(self._offsets[row]):int(self._offsets[row + 1])])
+
+    def _filter_rows(self, filters):
+        # Sorted rows matching every filter key (any of its values), None for no filter
+        rows = None
+        for key, values in (filters or {}).items():
+            if not values:
+                continue
+            index = self.fields.get(FILTER_FIELDS[key], {})
+            matches = [index[str(v)] for v in values if str(v) in index]
+            matched = np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        return rows
+
+    def exists(self):
+        return (self.path / "index.npz").exists() or self._writes is not None
+
+    def count(self):
+        self._load()
+        return len(self.ids)
+
+    def search(self, vector, limit: int, filters=None, with_payload=True, params=None):
+        self._load()
+        with self._lock:
+            if not self.ids or limit <= 0:
+                return []
+            query = _normalize(vector)
+            rows = self._filter_rows(filters)
+            exact = params is not None and params.exact
+            quantization = params.quantization if params is not None else None
+
+            if self.ivf is not None and not exact:
+                centroids, order, offsets = self.ivf
+                probe = _top(centroids @ query, LOCAL_NPROBE)
+                listed = np.sort(np.concatenate([order[offsets[i]:offsets[i + 1]] for i in probe]))
+                rows = listed if rows is None else np.intersect1d(rows, listed, assume_unique=True)
+            if rows is not None and not len(rows):
+                return []
+
+            if self.codes is not None and not exact:
+                oversampling = (quantization.oversampling if quantization and quantization.oversampling else LOCAL_OVERSAMPLING)
+                codes = self.codes if rows is None else self.codes[rows]
+                coarse = codes.astype(np.float32) @ (query * self.scales)
+                keep = _top(coarse, int(limit * oversampling))
+                candidates = keep if rows is None else rows[keep]
+                if quantization is not None and quantization.rescore is False:
+                    scores = coarse[keep]
+                else:
+                    scores = np.asarray(self.vectors[candidates]) @ query
+                top = _top(scores, limit)
+                found, scores = candidates[top], scores[top]
+            else:
+                vectors = self.vectors if rows is None else self.vectors[rows]
+                scores = np.asarray(vectors) @ query
+                top = _top(scores, limit)
+                found, scores = (top if rows is None else rows[top]), scores[top]
+
+            return [
+                models.ScoredPoint(id=self.ids[row], version=0, score=float(score),
+                                   payload=_select(self._payload(row), with_payload))
+                for row, score in zip(found.tolist(), scores.tolist())
+            ]
+
+    def retrieve(self, ids, with_payload=True):
+        self._load()
+        with self._lock:
+            return [
+                models.Record(id=str(pid), payload=_select(self._payload(self.rows[str(pid)]), with_payload))
+                for pid in ids if str(pid) in self.rows
+            ]
+
+    def find(self, references):
+        self._load()
+        with self._lock:
+            rows = [self.references.get(f"{document}#{part_index}") for document, part_index in references]
+            return [models.Record(id=self.ids[row], payload=self._payload(row)) for row in rows if row is not None]
+
+    # ---- writing ----
+
+    def _writable(self):
+        # Copies everything into memory, writes go there until flush()
+        self._load()
+        if self._writes is None:
+            self._writes = {
+                "ids": list(self.ids),
+                "rows": dict(self.rows),
+                "vectors": [np.array(self.vectors, dtype=np.float32)],
+                "updated": {},      # row -> new vector of an existing point, applied in flush()
+                "payloads": [self._payload(row) for row in range(len(self.ids))],
+                "dead": set(),
+                "settings": dict(self.settings),
+            }
+        return self._writes
+
+    def create(self, rebuild: bool = False, storage=None):
+        with self._lock:
+            if rebuild and self.path.exists():
+                for f in self.path.iterdir():
+                    f.unlink()
+                self._writes = None
+                self._version = None
+                self._clear()
+            storage = dict(storage or {})
+            ignored = {k: storage.pop(k) for k in ("on_disk", "hnsw_m", "ef_construct") if k in storage}
+            if ignored:
+                print(f"Local store: ignoring {ignored}, vectors are memory-mapped and searched by brute force or IVF")
+            if storage.get("quantization") not in (None, "scalar"):
+                raise ValueError(f"Local store only supports scalar (int8) quantization, not {storage['quantization']}")
+            if not self.exists():
+                print(f"Creating new local store: {self.path}")
+                self.path.mkdir(parents=True, exist_ok=True)
+                self._writable()["settings"].update(storage)
+                self.flush()
+            else:
+                print(f"Local store '{self.path}' already exists — skipping creation.")
+                if storage:
+                    print(f"Updating storage settings: {storage}")
+                    self._writable()["settings"].update(storage)
+                    self.flush()
+
+    def upsert(self, points):
+        with self._lock:
+            writes = self._writable()
+            vectors = _normalize([p.vector for p in points])
+            added = []
+            for point, vector in zip(points, vectors):
+                pid = str(point.id)
+                row = writes["rows"].get(pid)
+                if row is None:
+                    row = len(writes["ids"])
+                    writes["ids"].append(pid)
+                    writes["rows"][pid] = row
+                    writes["payloads"].append(dict(point.payload or {}))
+                    added.append(vector)
+                else:
+                    writes["payloads"][row] = dict(point.payload or {})
+                    writes["dead"].discard(row)
+                    writes["updated"][row] = vector
+            if added:
+                writes["vectors"].append(np.stack(added))
+
+    def delete(self, ids):
+        with self._lock:
+            writes = self._writable()
+            for pid in ids:
+                row = writes["rows"].get(str(pid))
+                if row is not None:
+                    writes["dead"].add(row)
+
+    def set_payloads(self, updates):
+        with self._lock:
+            writes = self._writable()
+            for pid, payload in updates:
+                row = writes["rows"].get(str(pid))
+                if row is not None:
+                    writes["payloads"][row].update(payload)
+
+    def flush(self):
+        with self._lock:
+            writes = self._writes
+            if writes is None:
+                return
+            keep = [row for row in range(len(writes["ids"])) if row not in writes["dead"]]
+            vectors = np.concatenate(writes["vectors"])
+            if writes["updated"]:
+                # Every replaced vector in one assignment
+                vectors[np.fromiter(writes["updated"], dtype=np.int64)] = np.stack(list(writes["updated"].values()))
+            vectors = vectors[keep] if keep else np.empty((0, self.size), dtype=np.float32)
+            ids = [writes["ids"][row] for row in keep]
+            payloads = [writes["payloads"][row] for row in keep]
+            settings = writes["settings"]
+            self._write(ids, vectors, payloads, settings)
+            self._writes = None
+            self._version = None
+            self._load()
+
+    def _write(self, ids, vectors, payloads, settings):
+        self.path.mkdir(parents=True, exist_ok=True)
+        fields = {field: {} for field in FILTER_FIELDS.values()}
+        references = {}
+        offsets = [0]
+        with open(self.path / "payloads.jsonl.tmp", "wb") as f:
+            for row, payload in enumerate(payloads):
+                line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+                for field in fields:
+                    for value in payload.get(field) or []:
+                        fields[field].setdefault(str(value), []).append(row)
+                if "document" in payload:
+                    references[f"{payload['document']}#{payload.get('part_index')}"] = row
+
+        files = {"payloads.jsonl": None}
+        np.save(self.path / "vectors.tmp.npy", vectors)
+        files["vectors.npy"] = "vectors.tmp.npy"
+        if settings.get("quantization") and len(vectors):
+            # Per-dimension scale, int8 codes times query * scale approximate the dot product
+            scales = np.maximum(np.quantile(np.abs(vectors), 0.99, axis=0), 1e-6).astype(np.float32) / 127
+            np.save(self.path / "vectors.int8.tmp.npy", np.clip(np.round(vectors / scales), -127, 127).astype(np.int8))
+            np.save(self.path / "scales.tmp.npy", scales)
+            files["vectors.int8.npy"] = "vectors.int8.tmp.npy"
+            files["scales.npy"] = "scales.tmp.npy"
+        if settings.get("ivf") and len(vectors):
+            centroids, order, list_offsets = train_ivf(vectors, int(settings["ivf"]))
+            np.savez(self.path / "ivf.tmp.npz", centroids=centroids, order=order, offsets=list_offsets)
+            files["ivf.npz"] = "ivf.tmp.npz"
+
+        meta = {"settings": settings, "fields": fields, "references": references}
+        np.savez(self.path / "index.tmp.npz", ids=np.array(ids, dtype=str), offsets=np.array(offsets, dtype=np.int64),
+                 meta=np.array(json.dumps(meta)))
+        # Everything else first, index.npz last: readers reload when it changes
+        if self._payloads is not None:
+            self._payloads.close()
+            self._payloads = None
+        self.vectors = np.empty((0, self.size), dtype=np.float32)
+        self.codes = None
+        (self.path / "payloads.jsonl.tmp").replace(self.path / "payloads.jsonl")
+        for name, tmp in files.items():
+            if tmp is not None:
+                (self.path / tmp).replace(self.path / name)
+        (self.path / "index.tmp.npz").replace(self.path / "index.npz")
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(backend: str = None, name: str = collection_name):
+    """The process-wide store for backend (default: VECTOR_BACKEND, else qdrant)"""
+    backend = backend or os.getenv("VECTOR_BACKEND", "qdrant")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown vector backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    with _stores_lock:
+        if (backend, name) not in _stores:
+            if backend == "local":
+                _stores[(backend, name)] = LocalStore(Path(os.getenv("VECTOR_STORE_PATH", LOCAL_STORE_PATH)) / name)
+            else:
+                _stores[(backend, name)] = QdrantStore(name=name)
+        return _stores[(backend, name)]
@@ -0,0 +1,117 @@
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from bm25 import BM25Index, load_index, tokenize
+from retrieval import reciprocal_rank_fusion
+
+TEXTS = [
+    "Tesla energy generation and storage revenue grew in 2023.",
+    "Energy storage deployments, energy storage margins and energy costs.",
+    "Microsoft cloud revenue grew, Azure grew 29%.",
+    "Total revenues were $96,773 million.",
+]
+IDS = ["a", "b", "c", "d"]
+METADATA = [
+    {"tickers": ["TSLA"], "years": ["2023"], "documents": ["NASDAQ_TSLA_2023.txt"]},
+    {"tickers": ["TSLA"], "years": ["2022"], "documents": ["NASDAQ_TSLA_2022.txt"]},
+    {"tickers": ["MSFT"], "years": ["2023"], "documents": ["NASDAQ_MSFT_2023.txt"]},
+    {"tickers": ["TSLA", "MSFT"], "years": [], "documents": ["shared.txt"]},
+]
+
+
+@pytest.fixture
+def index():
+    return BM25Index.build(IDS, TEXTS, METADATA)
+
+
+def test_tokenize_keeps_numbers_and_drops_stopwords():
+    assert tokenize("What was the revenue of $96,773.5 million in 2023?") == ["revenue", "96,773.5", "million", "2023"]
+
+
+def test_postings_are_csr(index):
+    assert list(index.vocab) == sorted(index.vocab)
+    assert index.indptr[0] == 0 and index.indptr[-1] == len(index.docs) == len(index.tfs)
+    energy = index.terms["energy"]
+    postings = dict(zip(index.docs[index.indptr[energy]:index.indptr[energy + 1]],
+                        index.tfs[index.indptr[energy]:index.indptr[energy + 1]]))
+    assert postings == {0: 1, 1: 3}
+    assert list(index.doc_len) == [len(tokenize(t)) for t in TEXTS]
+
+
+def test_save_load_round_trip(index, tmp_path):
+    path = tmp_path / "bm25.npz"
+    index.save(path)
+    loaded = BM25Index.load(path)
+    for name in ("vocab", "indptr", "docs", "tfs", "doc_len", "ids"):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(index, name))
+    assert set(loaded.fields) == set(index.fields)
+    for field, (values, bits) in index.fields.items():
+        np.testing.assert_array_equal(loaded.fields[field][0], values)
+        np.testing.assert_array_equal(loaded.fields[field][1], bits)
+    assert loaded.search("energy storage", 4) == index.search("energy storage", 4)
+
+
+def test_load_index_reloads_a_changed_file(tmp_path):
+    path = tmp_path / "bm25.npz"
+    BM25Index.build(IDS[:2], TEXTS[:2]).save(path)
+    assert len(load_index(path)) == 2
+    BM25Index.build(IDS, TEXTS).save(path)
+    # Make sure the modification time differs on coarse file systems
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert len(load_index(path)) == 4
+
+
+def test_scores_match_the_bm25_formula(index):
+    k1, b = index.k1, index.b
+    docs = [Counter(tokenize(t)) for t in TEXTS]
+    avg_len = sum(sum(d.values()) for d in docs) / len(docs)
+    expected = []
+    for doc in docs:
+        score = 0.0
+        for term in tokenize("energy revenue"):
+            df = sum(term in d for d in docs)
+            idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            tf = doc[term]
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * sum(doc.values()) / avg_len))
+        expected.append(score)
+    np.testing.assert_allclose(index.scores("energy revenue"), expected, rtol=1e-5)
+
+
+def test_search_ranks_and_limits(index):
+    hits = index.search("energy storage", 10)
+    assert [pid for pid, _ in hits] == ["b", "a"]
+    assert hits[0][1] > hits[1][1] > 0
+    assert index.search("energy storage", 1) == hits[:1]
+    assert index.search("unknown words", 10) == []
+
+
+def test_filters(index):
+    assert {pid for pid, _ in index.search("revenue grew", 10, {"ticker": ["MSFT"]})} == {"c"}
+    assert {pid for pid, _ in index.search("revenue", 10, {"ticker": ["TSLA"], "year": ["2023"]})} == {"a"}
+    # Any of the listed values
+    assert {pid for pid, _ in index.search("revenue", 10, {"year": ["2022", "2023"]})} == {"a", "c"}
+    assert index.mask({"ticker": []}) is None
+
+
+def test_filters_past_64_values():
+    ids = [str(i) for i in range(100)]
+    index = BM25Index.build(ids, ["revenue"] * 100, [{"documents": [f"doc{i:03d}.txt"]} for i in range(100)])
+    assert index.fields["documents"][1].shape == (100, 2)
+    hits = index.search("revenue", 10, {"document": ["doc070.txt", "doc099.txt"]})
+    assert {pid for pid, _ in hits} == {"70", "99"}
+
+
+def test_filter_without_metadata():
+    with pytest.raises(ValueError):
+        BM25Index.build(IDS, TEXTS).search("energy", 10, {"ticker": ["TSLA"]})
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+    assert [pid for pid, _ in fused] == ["b", "a", "d", "c"]
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chunk_store import ChunkStore, byte_offsets, fill_content, normalize_newlines
+from chunking import chunk_document
+
+TEXT = (
+    "--- Page 1 ---\r\n"
+    "Item 7. Management’s Discussion — résumé of 2023.\r\n"
+    "Revenue grew 19% to €96.8 billion. Energy storage deployments doubled.\r\n"
+    "\r\n"
+    "--- Page 2 ---\n"
+    "[TABLE START]\nSegment | 2023\nEnergy | 6,035\n[TABLE END]\n"
+    "Plain ASCII sentence at the end.\n"
+)
+
+
+@pytest.mark.parametrize("data", [
+    b"plain ascii\nlines\n",
+    TEXT.encode("utf-8"),
+    "a\r\nb\r\n\r\nc€d\r\n".encode("utf-8"),
+])
+def test_byte_offsets(data):
+    normalized = normalize_newlines(data.decode("utf-8"))
+    positions = list(range(len(normalized) + 1))
+    offsets = byte_offsets(data, positions)
+    for a, b in zip(positions, positions[1:]):
+        assert normalize_newlines(data[offsets[a]:offsets[b]].decode("utf-8")) == normalized[a:b]
+
+
+def build(tmp_path, files, size=60):
+    entries = []
+    chunks = {}
+    for name, text in files.items():
+        path = tmp_path / name
+        path.write_bytes(text.encode("utf-8"))
+        data = path.read_bytes()
+        doc_chunks = list(chunk_document(normalize_newlines(data.decode("utf-8")), "table", size))
+        chunks[name] = [c.text for c in doc_chunks]
+        entries.append((path, data, [(c.start, c.end) for c in doc_chunks]))
+    return ChunkStore.build(entries), chunks
+
+
+def test_round_trip(tmp_path):
+    files = {"NASDAQ_TSLA_2023.txt": TEXT, "NASDAQ_MSFT_2023.txt": "Azure grew. " * 20, "empty.txt": ""}
+    store, chunks = build(tmp_path, files)
+    store.save(tmp_path / "store.npz")
+    loaded = ChunkStore.load(tmp_path / "store.npz")
+    assert len(loaded) == sum(len(c) for c in chunks.values())
+    for name, texts in chunks.items():
+        for part_index, text in enumerate(texts):
+            assert loaded.text(name, part_index) == text
+    loaded.close()
+
+
+def test_missing_chunks(tmp_path):
+    store, chunks = build(tmp_path, {"NASDAQ_TSLA_2023.txt": TEXT})
+    assert store.text("NASDAQ_TSLA_2023.txt", len(chunks["NASDAQ_TSLA_2023.txt"])) is None
+    assert store.text("NASDAQ_NVDA_2023.txt", 0) is None
+
+
+def test_changed_file_is_missing(tmp_path):
+    store, _ = build(tmp_path, {"NASDAQ_TSLA_2023.txt": TEXT})
+    (tmp_path / "NASDAQ_TSLA_2023.txt").write_text(TEXT + "One more line.\n", encoding="utf-8")
+    assert store.text("NASDAQ_TSLA_2023.txt", 0) is None
+
+
+def test_fill_content(tmp_path):
+    store, chunks = build(tmp_path, {"NASDAQ_TSLA_2023.txt": TEXT})
+    points = [
+        SimpleNamespace(payload={"document": "NASDAQ_TSLA_2023.txt", "part_index": 1}),
+        SimpleNamespace(payload={"document": "NASDAQ_TSLA_2023.txt", "part_index": 0, "content": "kept"}),
+        SimpleNamespace(payload={"document": "NASDAQ_NVDA_2023.txt", "part_index": 0}),
+    ]
+    missing = fill_content(points, store)
+    assert points[0].payload["content"] == chunks["NASDAQ_TSLA_2023.txt"][1]
+    assert points[1].payload["content"] == "kept"
+    assert missing == [points[2]]
@@ -0,0 +1,95 @@
+import pytest
+
+from chunking import STRATEGIES, chunk_document, fixed_chunks
+
+FILING = """--- Page 1 ---
+PART I
+Item 1. Business
+We design and sell electric vehicles. Our energy segment sells storage systems. Demand grew in every region.
+
+--- Page 2 ---
+Item 7. Management's Discussion and Analysis
+Revenue grew in 2023. Margins fell as prices were cut.
+[TABLE START]
+Segment | 2023 | 2022
+Automotive | 82,419 | 71,462
+Energy | 6,035 | 3,909
+[TABLE END]
+Operating expenses rose with research and development spending.
+"""
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_offsets_point_into_the_source(strategy):
+    for chunk in chunk_document(FILING, strategy, size=80, overlap=20):
+        assert FILING[chunk.start:chunk.end] == chunk.text
+
+
+def test_page_and_section():
+    chunks = list(chunk_document(FILING, "sentence", size=120))
+    # The heading seen last before the chunk starts
+    assert chunks[0].page == 1
+    assert chunks[0].section == "PART I"
+    first = next(c for c in chunks if c.text.startswith("Demand grew"))
+    assert first.page == 1
+    assert first.section == "Item 1. Business"
+    later = next(c for c in chunks if "Margins fell" in c.text)
+    assert later.page == 2
+    assert later.section == "Item 7. Management's Discussion and Analysis"
+
+
+def test_chunks_never_cross_a_page_marker():
+    for strategy in ("sentence", "table"):
+        for chunk in chunk_document(FILING, strategy, size=1024):
+            assert "--- Page" not in chunk.text
+
+
+def test_table_kept_whole_when_it_fits():
+    chunks = list(chunk_document(FILING, "table", size=120))
+    tables = [c for c in chunks if "[TABLE START]" in c.text]
+    assert len(tables) == 1
+    assert "[TABLE END]" in tables[0].text
+    assert not any("[TABLE END]" in c.text for c in chunks if c is not tables[0])
+
+
+def test_big_table_split_between_rows():
+    table = "[TABLE START]\n" + "".join(f"Row {i} | {i * 100:,}\n" for i in range(40)) + "[TABLE END]"
+    chunks = list(chunk_document(table, "table", size=100))
+    assert len(chunks) > 1
+    assert all(len(c.text) <= 100 for c in chunks)
+    # Every piece ends at the end of a row
+    assert all(c.end == len(table) or table[c.end] == "\n" for c in chunks)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_chunks_respect_the_size(strategy):
+    assert all(len(c.text) <= 80 for c in chunk_document(FILING, strategy, size=80, overlap=20))
+
+
+def test_fixed_overlap():
+    text = "".join(chr(ord("a") + i % 26) for i in range(100))
+    chunks = list(fixed_chunks(text, size=40, overlap=10))
+    assert [c.start for c in chunks] == [0, 30, 60]
+    assert chunks[-1].end == len(text)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous.text[-10:] == chunk.text[:10]
+
+
+def test_sentence_overlap_repeats_the_last_sentences():
+    text = " ".join(f"Sentence number {i} ends here." for i in range(20))
+    chunks = list(chunk_document(text, "sentence", size=120, overlap=40))
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.start < previous.end
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+@pytest.mark.parametrize("overlap", [100, 150, -1])
+def test_bad_overlap_rejected(strategy, overlap):
+    with pytest.raises(ValueError):
+        chunk_document(FILING, strategy, size=100, overlap=overlap)
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        chunk_document(FILING, "words")
@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import pytest
+
+from prices import PriceStore, is_price_question, price_context, read_price_csv
+
+HEADER = "Date,Close/Last,Volume,Open,High,Low\n"
+
+
+def write_csv(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Newest first, with the "$" and the padding of the dataset's files
+    path.write_text(HEADER + "".join(
+        f"{date},${close} ,{volume},${close - 1} ,${close + 2} ,${close - 2} \n" for date, close, volume in rows
+    ), encoding="utf-8")
+
+
+@pytest.fixture
+def store(tmp_path):
+    write_csv(tmp_path / "dataset" / "tesla" / "TSLA-2022.csv", [
+        ("12/30/2022", 100.0, 1000),
+        ("12/29/2022", 110.0, 2000),
+        ("01/03/2022", 400.0, 3000),
+    ])
+    # Overlaps the 2022 file by one day
+    write_csv(tmp_path / "dataset" / "tesla" / "TSLA-2023.csv", [
+        ("12/29/2023", 250.0, 4000),
+        ("01/03/2023", 108.0, 5000),
+        ("12/30/2022", 100.0, 1000),
+    ])
+    write_csv(tmp_path / "dataset" / "meta" / "META-2023.csv", [
+        ("12/29/2023", 353.96, 100),
+        ("01/03/2023", 124.74, 100),
+    ])
+    return PriceStore(tmp_path / "dataset", tmp_path / "cache")
+
+
+def test_read_price_csv(tmp_path):
+    path = tmp_path / "TSLA-2022.csv"
+    path.write_text(HEADER + "12/30/2022,$1,123.18 ,157777300,$119.95 ,$124.48 ,$119.75\n", encoding="utf-8")
+    # Rows with the wrong number of fields are skipped
+    assert len(read_price_csv(path)) == 0
+    path.write_text(HEADER + "12/30/2022,$123.18 ,157777300,$119.95 ,$124.48 ,$119.75\n\n", encoding="utf-8")
+    row = read_price_csv(path)[0]
+    assert row["date"] == np.datetime64("2022-12-30")
+    assert (row["close"], row["open"], row["high"], row["low"]) == (123.18, 119.95, 124.48, 119.75)
+    assert row["volume"] == 157777300
+
+
+def test_empty_csv(tmp_path):
+    path = tmp_path / "TSLA-2022.csv"
+    path.write_text("", encoding="utf-8")
+    assert len(read_price_csv(path)) == 0
+
+
+def test_sorted_and_deduplicated(store):
+    tsla = store["TSLA"]
+    assert len(tsla) == 5
+    assert list(tsla.dates.astype(str)) == ["2022-01-03", "2022-12-29", "2022-12-30", "2023-01-03", "2023-12-29"]
+    assert store.tickers() == ["META", "TSLA"]
+
+
+def test_range_is_inclusive(store):
+    tsla = store["TSLA"]
+    assert len(tsla.range("2022-12-29", "2022-12-30")) == 2
+    assert len(tsla.range("2022-12-31", "2023-01-02")) == 0
+    assert len(tsla.range(end="2022-12-31")) == 3
+
+
+def test_close_on_uses_the_last_trading_day(store):
+    tsla = store["TSLA"]
+    assert tsla.close_on("2022-12-31") == 100.0
+    assert tsla.close_on("2023-01-03") == 108.0
+    assert tsla.close_on("2021-12-31") is None
+
+
+def test_returns(store):
+    tsla = store["TSLA"]
+    assert tsla.total_return("2022-01-01", "2022-12-31") == pytest.approx(100 / 400 - 1)
+    assert tsla.total_return("2023-01-03", "2023-01-03") is None
+    np.testing.assert_allclose(tsla.daily_returns("2022-12-29", "2023-01-03"), [100 / 110 - 1, 108 / 100 - 1])
+
+
+def test_summary(store):
+    summary = store["TSLA"].summary("2023-01-01", "2023-12-31")
+    assert summary["days"] == 2
+    assert summary["return"] == pytest.approx(250 / 108 - 1)
+    assert (summary["high"], summary["high_date"]) == (252.0, "2023-12-29")
+    assert (summary["low"], summary["low_date"]) == (106.0, "2023-01-03")
+    assert summary["total_volume"] == 9000
+    # One daily return isn't enough for a volatility
+    assert summary["volatility"] is None
+    assert store["TSLA"].summary("2024-01-01", "2024-12-31") is None
+
+
+def test_cache_rebuilt_when_a_csv_changes(store, tmp_path):
+    path = tmp_path / "dataset" / "meta" / "META-2023.csv"
+    write_csv(path, [("12/29/2023", 353.96, 100)])
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    reloaded = PriceStore(tmp_path / "dataset", tmp_path / "cache")
+    assert len(reloaded["META"]) == 1
+    assert len(reloaded["TSLA"]) == 5
+
+
+@pytest.mark.parametrize("question", [
+    "How did Tesla stock perform in 2022?",
+    "What was Apple's closing price at the end of 2023?",
+    "How did the price of MSFT change over 2022, what was the return?",
+    "What was NVDA's share price in 2023?",
+])
+def test_price_questions(question):
+    assert is_price_question(question)
+
+
+@pytest.mark.parametrize("question", [
+    "What was the average selling price of an iPhone for Apple in 2022?",
+    "How much stock-based compensation did Meta record in 2023?",
+    "How did Tesla's energy segment grow in 2023?",
+])
+def test_not_price_questions(question):
+    assert not is_price_question(question)
+
+
+def test_price_context(store):
+    context = price_context("How did Tesla stock perform in 2023?", store=store)
+    assert context.startswith("TSLA daily prices 2023-01-03 to 2023-12-29")
+    assert price_context("How did Tesla's energy segment grow in 2023?", store=store) is None
+
+
+def test_price_context_filter_aliases(store):
+    # resolve_filters turns FB into META before prices see it
+    assert "META daily prices" in price_context("How did the stock perform in 2023?", {"ticker": ["META"]}, store)
+    assert price_context("How did Amazon stock perform in 2023?", store=store) is None
@@ -0,0 +1,42 @@
+import time
+from types import SimpleNamespace
+
+import rag
+
+
+class StubResponse:
+    """Stream of empty chunks, what gpt-oss sends while it is thinking"""
+
+    def __init__(self, chunks: int, delay: float):
+        self.chunks = chunks
+        self.delay = delay
+        self.closed = False
+        self.sent = 0
+
+    def __iter__(self):
+        for _ in range(self.chunks):
+            time.sleep(self.delay)
+            self.sent += 1
+            yield SimpleNamespace(message=SimpleNamespace(content=""))
+
+    def close(self):
+        self.closed = True
+
+
+def test_deadline_stops_a_thinking_model(monkeypatch):
+    response = StubResponse(chunks=200, delay=0.01)
+    client = SimpleNamespace(chat=lambda **kwargs: response)
+    monkeypatch.setattr(rag, "ollama_client", lambda timeout=None: client)
+    monkeypatch.setattr(rag, "retrieve", lambda *args, **kwargs: [])
+    monkeypatch.setattr(rag, "load_content", lambda points: points)
+    monkeypatch.setattr(rag, "build_context", lambda *args: ("", {"tokens_out": 0}))
+
+    events = list(rag.stream_rag("What did Tesla earn in 2023?", cache=False, prices=False, timeout=0.1))
+
+    event, done = events[-1]
+    assert event == "done"
+    assert done["stopped"] == "timeout"
+    assert done["answer"] == ""
+    assert response.closed
+    # Stopped close to the deadline, not after the whole stream
+    assert response.sent < 100
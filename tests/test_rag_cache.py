@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from qdrant_client import models
+
+from rag_cache import RagCache, normalize_question, scope_for
+
+
+def point(pid, content="chunk text"):
+    return models.ScoredPoint(id=pid, version=0, score=0.5,
+                              payload={"document": "NASDAQ_TSLA_2023.txt", "part_index": pid, "content": content})
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text('{"files": {}}', encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path, manifest):
+    return RagCache(tmp_path / "cache.pkl", manifest=manifest)
+
+
+def never_embed():
+    raise AssertionError("an exact hit doesn't embed")
+
+
+def test_normalize_question():
+    assert normalize_question("  What  was Tesla's revenue?? ") == "what was tesla's revenue"
+
+
+def test_exact_hit(cache):
+    cache.put_points("What was Tesla's revenue?", "s", unit(1, 0), [point(1)])
+    entry, vector = cache.get_points("what was tesla's revenue", "s", never_embed)
+    assert vector is None
+    assert [p.id for p in entry["points"]] == [1]
+    assert cache.hits["exact"] == 1
+
+
+def test_semantic_hit_needs_the_same_scope(cache):
+    cache.put_points("Tesla revenue 2023", "2023", unit(1, 0), [point(1)])
+    entry, _ = cache.get_points("Revenue of Tesla in 2023", "2023", lambda: unit(1, 0.01))
+    assert entry is not None and entry["question"] == "tesla revenue 2023"
+    entry, _ = cache.get_points("Revenue of Tesla in 2023", "2022", lambda: unit(1, 0.01))
+    assert entry is None
+    entry, _ = cache.get_points("Microsoft cloud growth", "2023", lambda: unit(0, 1))
+    assert entry is None
+    assert cache.hits["semantic"] == 1 and cache.misses["points"] == 2
+
+
+def test_cached_points_stay_lean(cache):
+    points = [point(1, "full text")]
+    cache.put_points("q", "s", unit(1, 0), points)
+    assert points[0].payload["content"] == "full text"
+    entry, _ = cache.get_points("q", "s", never_embed)
+    assert "content" not in entry["points"][0].payload
+    # Filling in the copy, as load_content does, leaves the cache alone
+    entry["points"][0].payload["content"] = "loaded"
+    entry, _ = cache.get_points("q", "s", never_embed)
+    assert "content" not in entry["points"][0].payload
+
+
+def test_answers_are_keyed_by_context_and_llm(cache):
+    cache.put_answer("q", "context one", "llm", "answer")
+    assert cache.get_answer("Q?", "context one", "llm") == "answer"
+    assert cache.get_answer("q", "context two", "llm") is None
+    assert cache.get_answer("q", "context one", "other-llm") is None
+
+
+@pytest.mark.parametrize("change", ["rewrite", "delete"])
+def test_manifest_change_clears_everything(cache, manifest, change):
+    cache.put_points("q", "s", unit(1, 0), [point(1)])
+    cache.put_answer("q", "context", "llm", "answer")
+    if change == "rewrite":
+        manifest.write_text('{"files": {"NASDAQ_TSLA_2023.txt": {}}}', encoding="utf-8")
+    else:
+        manifest.unlink()
+    assert cache.get_answer("q", "context", "llm") is None
+    assert cache.get_points("q", "s", lambda: unit(1, 0))[0] is None
+    assert len(cache) == 0
+
+
+def test_put_after_a_manifest_change_is_kept(cache, manifest):
+    cache.put_points("old", "s", unit(1, 0), [point(1)])
+    manifest.write_text('{"files": {"changed": {}}}', encoding="utf-8")
+    # The put sees the new index first, so its answer survives the next lookup
+    cache.put_answer("q", "context", "llm", "answer")
+    assert cache.get_answer("q", "context", "llm") == "answer"
+    assert len(cache) == 0
+
+
+def test_persisted_with_the_manifest_version(tmp_path, manifest, cache):
+    cache.put_points("q", "s", unit(1, 0), [point(1)])
+    cache.flush()
+    reloaded = RagCache(tmp_path / "cache.pkl", manifest=manifest)
+    assert reloaded.get_points("q", "s", never_embed)[0] is not None
+    manifest.write_text('{"files": {"changed": {}}}', encoding="utf-8")
+    reloaded = RagCache(tmp_path / "cache.pkl", manifest=manifest)
+    assert reloaded.get_points("q", "s", lambda: unit(1, 0))[0] is None
+
+
+def test_ttl_and_max_entries(tmp_path, manifest):
+    cache = RagCache(tmp_path / "cache.pkl", max_entries=2, ttl=-1, manifest=manifest)
+    cache.put_answer("q", "context", "llm", "answer")
+    assert cache.get_answer("q", "context", "llm") is None
+
+    cache = RagCache(tmp_path / "cache.pkl", max_entries=2, manifest=manifest)
+    for i in range(3):
+        cache.put_points(f"question {i}", "s", unit(1, i), [point(i)])
+    assert len(cache) == 2
+    assert cache.get_points("question 0", "s", lambda: unit(-1, 0))[0] is None
+
+
+def test_scope_for_is_stable():
+    assert scope_for(mode="dense", filters={"ticker": ["TSLA"]}) == scope_for(filters={"ticker": ["TSLA"]}, mode="dense")
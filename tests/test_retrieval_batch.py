@@ -0,0 +1,117 @@
+import io
+import json
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from qdrant_client import models
+
+import retrieval
+from bm25 import BM25Index
+from embed import point_id, source_payload
+from vector_store import VECTOR_SIZE, LocalStore
+
+CHUNKS = {
+    "NASDAQ_TSLA_2023.txt": [
+        "Energy generation and storage revenue grew in 2023.",
+        "Automotive margins fell as prices were cut.",
+        "Risk factors include supply chain constraints.",
+    ],
+    "NASDAQ_TSLA_2022.txt": [
+        "Energy storage deployments grew in 2022.",
+        "Automotive revenue grew with deliveries.",
+    ],
+    "NASDAQ_MSFT_2023.txt": [
+        "Azure and other cloud services revenue grew 29%.",
+        "Risk factors include competition in cloud services.",
+    ],
+}
+QUESTIONS = [
+    "How did Tesla energy storage revenue grow?",
+    "What are the risk factors?",
+    "Cloud services revenue",
+    "Nothing matches these words",
+]
+
+
+def fake_embed(texts):
+    # Bag of words, enough to make similar texts close
+    vectors = np.zeros((len(texts), VECTOR_SIZE), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for word in text.lower().split():
+            vectors[i, zlib.crc32(word.strip("?.,%").encode()) % VECTOR_SIZE] += 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+@pytest.fixture
+def indexed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = LocalStore(tmp_path / "knowledge_base")
+    store.create()
+    points = []
+    for document, texts in CHUNKS.items():
+        for part_index, text in enumerate(texts):
+            points.append(models.PointStruct(id=point_id(document, text), vector=fake_embed([text])[0].tolist(),
+                                             payload={"content": text, **source_payload([(document, part_index)])}))
+    store.upsert(points)
+    store.flush()
+    BM25Index.build([str(p.id) for p in points], [p.payload["content"] for p in points],
+                    [p.payload for p in points]).save(tmp_path / ".bm25_index.npz")
+
+    monkeypatch.setattr(retrieval, "store", store)
+    monkeypatch.setattr(retrieval, "embed_queries", lambda questions, name=None: fake_embed(questions))
+    monkeypatch.setattr(retrieval, "embed_query", lambda question, name=None: fake_embed([question])[0].tolist())
+    return store
+
+
+def ranked(points):
+    return [(str(p.id), round(p.score, 5)) for p in points]
+
+
+@pytest.mark.parametrize("mode", retrieval.MODES)
+@pytest.mark.parametrize("auto_filter", [True, False])
+def test_batch_matches_one_by_one(indexed, mode, auto_filter):
+    timings = {}
+    batch = retrieval.retrieve_batch(QUESTIONS, 3, mode, auto_filter=auto_filter, batch_size=2, timings=timings)
+    assert len(batch) == len(QUESTIONS)
+    assert batch[0] and batch[1]
+    for question, points in zip(QUESTIONS, batch):
+        assert ranked(points) == ranked(retrieval.retrieve(question, 3, mode, auto_filter=auto_filter))
+    assert timings
+
+
+def test_auto_filter_and_lazy_payloads(indexed):
+    points = retrieval.retrieve_batch(["How did Tesla energy storage revenue grow?"], 5, lazy=True)[0]
+    assert points and {p.payload["ticker"] for p in points} == {"TSLA"}
+    assert all("content" not in p.payload for p in points)
+
+
+def test_unknown_mode(indexed):
+    with pytest.raises(ValueError):
+        retrieval.retrieve_batch(QUESTIONS, 3, "semantic")
+
+
+def test_read_questions(tmp_path):
+    text = tmp_path / "questions.txt"
+    text.write_text("What are the risk factors?\n\n  Cloud revenue  \n", encoding="utf-8")
+    assert retrieval.read_questions(text) == ["What are the risk factors?", "Cloud revenue"]
+    records = tmp_path / "questions.jsonl"
+    records.write_text('{"question": "What are the risk factors?", "gold": []}\n\n{"question": "Cloud revenue"}\n',
+                       encoding="utf-8")
+    assert retrieval.read_questions(records) == ["What are the risk factors?", "Cloud revenue"]
+
+
+def test_write_results():
+    points = [SimpleNamespace(id=7, score=0.5, payload={"document": "a.txt", "part_index": 3, "content": "text"})]
+    out = io.StringIO()
+    retrieval.write_results(["q1", "q2"], [points, []], out)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert lines == [
+        {"question": "q1", "results": [{"id": "7", "score": 0.5, "document": "a.txt", "part_index": 3}]},
+        {"question": "q2", "results": []},
+    ]
+    out = io.StringIO()
+    retrieval.write_results(["q1"], [points], out, with_content=True)
+    assert json.loads(out.getvalue())["results"][0]["content"] == "text"